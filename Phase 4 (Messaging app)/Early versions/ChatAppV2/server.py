@@ -1,43 +1,287 @@
 import threading
-import socket 
+import socket
 import argparse
 import os
+import queue
+import selectors
+from collections import deque
+
+# One selector thread waits for sockets to become ready and hands each
+# ready connection to a fixed pool of worker threads, so the number of
+# threads stays the same however many clients connect. A connection is
+# taken out of the selector while a worker has it, so only one worker at a
+# time reads from it and its messages are handled in order.
+WORKERS = 4
+MAX_CONNECTIONS = 1000  # Beyond this, new clients wait in the listen backlog
+LISTEN_BACKLOG = 128
+RECV_SIZE = 4096
+MAX_MESSAGE = 64 * 1024      # Longest line a client may send
+MAX_OUTBOUND = 1024 * 1024   # Bytes queued for a slow client before it is dropped
+
+class ServerSocket:
+    """A client connection. It has no thread of its own: workers read from it when it is ready."""
+
+    def __init__(self, sc, sockname, server):
+        self.sc = sc
+        self.sockname = sockname
+        self.server = server
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.lock = threading.Lock()  # Any worker may send to any connection
+        self.busy = False    # Handed to a worker (only used by the selector thread)
+        self.closed = False
+
+    def send(self, message):
+        """Queue one message and write as much of it as the socket takes without blocking"""
+        with self.lock:
+            if self.closed:
+                return
+            self.outbound += message.encode('utf-8') + b"\n"
+            if len(self.outbound) > MAX_OUTBOUND:
+                print(f"Dropping {self.sockname}: it is not reading its messages")
+                self.server.request("close", self)
+                return
+            try:
+                self.flush_locked()
+            except OSError:
+                self.server.request("close", self)
+                return
+            if self.outbound:
+                self.server.request("update", self)  # Finish the write when the socket is writable
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.flush_locked()
+
+    def flush_locked(self):
+        try:
+            sent = self.sc.send(self.outbound)
+        except BlockingIOError:
+            return
+        del self.outbound[:sent]
+
+    def receive(self):
+        """Read what has arrived and return the complete messages, or None once the client has gone"""
+        try:
+            data = self.sc.recv(RECV_SIZE)
+        except BlockingIOError:
+            return []
+        if not data:
+            return None
+        self.inbound += data
+        *lines, rest = self.inbound.split(b"\n")
+        if len(rest) > MAX_MESSAGE:
+            print(f"Dropping {self.sockname}: message too long")
+            return None
+        self.inbound = bytearray(rest)
+        return [line.decode('utf-8', 'replace').rstrip("\r") for line in lines]
+
+    def interest(self):
+        """Events the selector should watch this connection for"""
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outbound else 0)
+
+def broadcast_message(server, connection, message):
+    """Default handler: pass the message on to every other client"""
+    server.broadcast(message, connection.sockname)
+
+def quit_command(server, connection, message):
+    server.request("close", connection)
 
 class Server(threading.Thread):
-    def __init__(self, host, port):
-        super().__init__()
+    """Chat server core: a selector thread, a fixed pool of workers and a bounded number of clients.
+
+    Each line a client sends is one message. Messages starting with a
+    command registered with add_handler() ("/quit") go to its handler,
+    everything else to on_message. Handlers are called on a worker thread
+    as handler(server, connection, message).
+    """
+
+    def __init__(self, host, port, workers=WORKERS, max_connections=MAX_CONNECTIONS, on_message=broadcast_message):
+        super().__init__(daemon=True)
         self.connections = []
         self.host = host
         self.port = port
+        self.workers = workers
+        self.max_connections = max_connections
+        self.on_message = on_message
+        self.handlers = {"/quit": quit_command}
+        self.lock = threading.Lock()  # Guards connections
+        self.selector = selectors.DefaultSelector()
+        self.ready = queue.Queue()    # (connection, events) for the workers
+        self.changes = deque()        # (action, connection) for the selector thread, see request()
+        self.wake_read, self.wake_write = socket.socketpair()
+        self.wake_read.setblocking(False)
+        self.wake_write.setblocking(False)
+        self.listener = None
+        self.accepting = False
+
+    def add_handler(self, command, handler):
+        """Send messages starting with command (e.g. "/nick") to handler instead of on_message"""
+        self.handlers[command] = handler
 
     def run(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((self.host, self.port))
 
-        sock.listen(1)
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        self.listener = sock
         print("Listening at ",sock.getsockname())
 
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        self.start_accepting()
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
         while True:
-            #Accepting new connection
-            sc, sockname = sock.accept()
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wake_read:
+                    self.drain_wake()
+                else:
+                    # Hand it to a worker; it comes back to the selector through a "rearm" request
+                    connection = key.data
+                    self.selector.unregister(connection.sc)
+                    connection.busy = True
+                    self.ready.put((connection, events))
+            self.apply_changes()
+
+    def accept(self):
+        """Accept waiting clients up to the connection limit"""
+        while len(self.connections) < self.max_connections:
+            try:
+                sc, sockname = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print(f"Accept error: {e}")
+                return
+            sc.setblocking(False)
             print(f"Accepting a new connection from {sc.getpeername()} to {sc.getsockname()}")
 
-            #Create a new thread
             server_socket = ServerSocket(sc, sockname, self)
+            with self.lock:
+                self.connections.append(server_socket)
+            self.selector.register(sc, selectors.EVENT_READ, server_socket)
+
+        # Backpressure: leave new clients in the listen backlog until someone leaves
+        print(f"Connection limit of {self.max_connections} reached, not accepting for now")
+        self.selector.unregister(self.listener)
+        self.accepting = False
+
+    def start_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.listener, selectors.EVENT_READ)
+            self.accepting = True
+
+    def work(self):
+        """Worker thread: read from and write to connections the selector found ready"""
+        while True:
+            connection, events = self.ready.get()
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.flush()
+                messages = connection.receive() if events & selectors.EVENT_READ else []
+            except OSError:
+                messages = None
+            if messages is None:
+                self.request("close", connection)
+                continue
+            for message in messages:
+                self.handle(connection, message)
+            self.request("rearm", connection)
+
+    def handle(self, connection, message):
+        """Pass one message to its handler"""
+        handler = self.handlers.get(message.split(" ", 1)[0], self.on_message)
+        try:
+            handler(self, connection, message)
+        except Exception as e:
+            print(f"Error handling a message from {connection.sockname}: {e}")
+
+    def request(self, action, connection):
+        """Ask the selector thread to "rearm", "update" or "close" a connection.
+
+        Only that thread touches the selector, so workers queue what they
+        need and wake it up.
+        """
+        self.changes.append((action, connection))
+        try:
+            self.wake_write.send(b"x")
+        except BlockingIOError:
+            pass  # Already plenty of wake-ups pending
+
+    def drain_wake(self):
+        try:
+            while self.wake_read.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def apply_changes(self):
+        while self.changes:
+            action, connection = self.changes.popleft()
+            if action == "close":
+                self.close(connection)
+            elif connection.closed:
+                continue
+            elif action == "rearm":
+                # Back from a worker: watch it again
+                connection.busy = False
+                self.selector.register(connection.sc, connection.interest(), connection)
+            elif not connection.busy:
+                # Something was queued for it; its worker rearms it anyway if busy
+                self.selector.modify(connection.sc, connection.interest(), connection)
+
+    def close(self, connection):
+        with connection.lock:
+            if connection.closed:
+                return
+            connection.closed = True
+        if not connection.busy:
+            self.selector.unregister(connection.sc)
+        connection.sc.close()
+        self.remove_connection(connection)
+        print(f"Connection from {connection.sockname} closed")
+        if len(self.connections) < self.max_connections:
+            self.start_accepting()
+
+    def broadcast(self, message, source):
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+
+            if connection.sockname != source:
+                connection.send(message)
 
-            #start new thread
-            server_socket.start()
+    def remove_connection(self, connection):
+        with self.lock:
+            self.connections.remove(connection)
 
-            #add thread to active connection
-            self.connections.append(server_socket)
-            print("Ready to receive messages from ", sc.getpeername())
+def exit(server):
+    """Shut the server down when "q" is typed"""
+    while True:
+        ipt = input("")
+        if ipt == "q":
+            print("Closing all connections...")
+            for connection in list(server.connections):
+                connection.sc.close()
+            print("Shutting down the server...")
+            os._exit(0)
 
-def broadcast(self, message, source):
-    for connection in self.connections:
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chatroom Server")
+    parser.add_argument("host", help="Interface the server listens at")
+    parser.add_argument("-p", metavar="PORT", type=int, default=1060, help="TCP port (default 1060)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker threads handling client sockets")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="clients served at once; more wait until someone leaves")
+    args = parser.parse_args()
 
-        if connection.sockname != source:
-            connection.send(message)
+    server = Server(args.host, args.p, args.workers, args.max_connections)
+    server.start()
 
-def remove_connection(self, connection):
-    self.connections.remove(connection)
+    exit(server)
@@ -2,10 +2,25 @@ import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 from tkinter import simpledialog, messagebox, ttk
 import threading
+import os
 import socket
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 import time
 
+import discovery
+from codec import (ACK, CHAT, INFO, JOIN, LEAVE, NOTICE, PRIVATE, ROOM, decode_history, decode_message,
+                   dispatch, encode_message)
+from protocol import (FRAME_HELLO, FRAME_HISTORY, FRAME_MESSAGE, FRAME_PING, FRAME_PONG, FRAME_PRESENCE,
+                      FRAME_RESYNC, FRAME_ROOM, FRAME_SESSION, FRAME_USERS, GROUP_CHAT, FrameReader, decode_hello,
+                      decode_presence, decode_room, decode_session, decode_users, encode_history_request,
+                      encode_resume, recv_frame, send_encoded, send_frame)
+
+HISTORY_PAGE = 50  # Messages fetched from the server per history request
+ANNOUNCEMENT_WAIT = 2  # Seconds spent hearing announcements between rounds of probes
+SEND_WINDOW = 32  # Messages that may wait for the server's ACK before sending is refused
+RESEND_AFTER = 10  # Seconds without an ACK before a message is sent again
+RECONNECT_DELAY = 2  # Seconds between attempts to reconnect and resume the session
+
 class ClientClientGUI:
     def __init__(self, master):
         self.master = master
@@ -13,7 +28,6 @@ class ClientClientGUI:
         
         self.server_ip = None
         self.server_port = 12345
-        self.broadcast_port = 12346
         
         # Create a frame for connection options
         self.connect_frame = tk.Frame(master)
@@ -66,11 +80,13 @@ class ClientClientGUI:
         self.servers_frame = tk.Frame(self.connect_frame)
         self.servers_label = tk.Label(self.servers_frame, text="Discovered Servers:")
         self.servers_label.pack(anchor=tk.W)
-        self.servers_listbox = tk.Listbox(self.servers_frame, height=5, width=40)
+        self.servers_listbox = tk.Listbox(self.servers_frame, height=5, width=50)
         self.servers_listbox.pack(fill='both', expand=True)
+        self.servers_listbox.bind('<<ListboxSelect>>', self.choose_server)
         
-        # Store discovered servers
-        self.discovered_servers = {}  # {display_name: (ip, port)}
+        # Discovered servers, best first, in the same order as the listbox
+        self.discovered_servers = []
+        self.chosen_server = None  # (ip, port) the user picked, otherwise the best one is selected
         
         # Auto-discover as default
         self.toggle_connect_options()
@@ -96,7 +112,8 @@ class ClientClientGUI:
         
         # Clear server list
         self.servers_listbox.delete(0, tk.END)
-        self.discovered_servers.clear()
+        self.discovered_servers = []
+        self.chosen_server = None
         
         # Start discovery thread
         self.discovery_thread = threading.Thread(target=self.discover_servers, daemon=True)
@@ -109,50 +126,55 @@ class ClientClientGUI:
         self.progress.pack_forget()
     
     def discover_servers(self):
-        """Listen for server broadcasts"""
+        """Probe for servers until discovery stops, hearing announcements from older servers in between"""
+        try:
+            announcements = discovery.open_announcement_socket()
+        except OSError as e:
+            print(f"Discovery socket error: {e}")
+            announcements = None
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(('', self.broadcast_port))
-            sock.settimeout(1)  # 1 second timeout for checking discovery_active flag
-            
             while self.discovery_active:
                 try:
-                    data, addr = sock.recvfrom(1024)
-                    message = data.decode('utf-8')
-                    
-                    # Parse server info (format: "CHAT_SERVER:IP:PORT")
-                    if message.startswith("CHAT_SERVER:"):
-                        parts = message.split(":")
-                        if len(parts) >= 3:
-                            server_ip = parts[1]
-                            server_port = int(parts[2])
-                            
-                            # Add to discovered servers list if not already there
-                            display_name = f"{server_ip}:{server_port}"
-                            if display_name not in self.discovered_servers:
-                                self.discovered_servers[display_name] = (server_ip, server_port)
-                                self.master.after(0, lambda: self.add_server_to_list(display_name))
-                except socket.timeout:
-                    continue  # Just check the discovery_active flag
-                except Exception as e:
+                    servers = discovery.probe_servers()
+                    if announcements is not None:
+                        probed = {(server.ip, server.port) for server in servers}
+                        announced = discovery.receive_announcements(announcements, ANNOUNCEMENT_WAIT)
+                        servers += [server for server in announced if (server.ip, server.port) not in probed]
+                    else:
+                        time.sleep(ANNOUNCEMENT_WAIT)
+                except OSError as e:
                     print(f"Discovery error: {e}")
-        except Exception as e:
-            print(f"Discovery socket error: {e}")
+                    time.sleep(ANNOUNCEMENT_WAIT)
+                    continue
+                self.master.after(0, lambda servers=servers: self.show_servers(servers))
         finally:
-            sock.close()
+            if announcements is not None:
+                announcements.close()
     
-    def add_server_to_list(self, server_name):
-        """Add discovered server to the listbox"""
-        # Check if already in list
-        for i in range(self.servers_listbox.size()):
-            if self.servers_listbox.get(i) == server_name:
-                return
-        
-        self.servers_listbox.insert(tk.END, server_name)
-        # Select first server if this is the first one
-        if self.servers_listbox.size() == 1:
-            self.servers_listbox.selection_set(0)
+    def show_servers(self, servers):
+        """List discovered servers best first and select the user's choice, or else the best one"""
+        if not self.discovery_active:
+            return
+        self.discovered_servers = servers
+        self.servers_listbox.delete(0, tk.END)
+        selected = 0
+        for i, server in enumerate(servers):
+            if server.rtt is None:
+                self.servers_listbox.insert(tk.END, f"{server.ip}:{server.port}  (announced)")
+            else:
+                self.servers_listbox.insert(tk.END, f"{server.ip}:{server.port}  {server.rtt * 1000:.0f} ms, "
+                                                    f"{server.connections} connected, load {server.load:.2f}")
+            if (server.ip, server.port) == self.chosen_server:
+                selected = i
+        if servers:
+            self.servers_listbox.selection_set(selected)
+    
+    def choose_server(self, event):
+        """Remember the server the user picked so refreshing the list keeps it selected"""
+        selection = self.servers_listbox.curselection()
+        if selection:
+            server = self.discovered_servers[selection[0]]
+            self.chosen_server = (server.ip, server.port)
     
     def start_connection(self):
         """Start connection based on selected method"""
@@ -170,8 +192,8 @@ class ClientClientGUI:
                 messagebox.showerror("Error", "Please select a server or wait for discovery")
                 return
             
-            server_name = self.servers_listbox.get(selection[0])
-            self.server_ip, self.server_port = self.discovered_servers[server_name]
+            server = self.discovered_servers[selection[0]]
+            self.server_ip, self.server_port = server.ip, server.port
         else:
             # Manual IP entry
             self.server_ip = self.ip_entry.get().strip()
@@ -204,6 +226,17 @@ class ClientClientGUI:
         self.chat_listbox.select_set(0)
         self.chat_listbox.bind('<<ListboxSelect>>', self.change_chat)
 
+        # Room buttons
+        self.rooms_frame = tk.Frame(self.users_frame)
+        self.rooms_frame.pack(fill='x')
+        self.join_button = tk.Button(self.rooms_frame, text="Join room", command=self.join_room)
+        self.join_button.pack(side='left', fill='x', expand=True)
+        self.leave_button = tk.Button(self.rooms_frame, text="Leave room", command=self.leave_room)
+        self.leave_button.pack(side='right', fill='x', expand=True)
+
+        # Rooms we are in, listed right after "Group Chat" and before the users
+        self.joined_rooms = []
+
         # Current chat target
         self.current_chat = "Group Chat"
 
@@ -224,6 +257,8 @@ class ClientClientGUI:
         # Chat box
         self.chat_box = ScrolledText(self.right_panel, state="disabled")
         self.chat_box.pack(fill='both', expand=True)
+        # Fetch older messages when the user scrolls to the top
+        self.chat_box.configure(yscrollcommand=self.on_chat_scroll)
 
         # Entry with send button in a frame
         self.input_frame = tk.Frame(self.right_panel)
@@ -245,9 +280,58 @@ class ClientClientGUI:
 
         # Initialize unread message counter
         self.unread_messages = defaultdict(int)
-        
-        # Flag to prevent double processing of sent messages
-        self.message_sent = False
+
+        # What each frame type, and each kind of chat message, is handled by
+        self.frame_handlers = {
+            FRAME_HELLO: self.on_hello,
+            FRAME_USERS: self.on_users,
+            FRAME_PRESENCE: self.on_presence,
+            FRAME_HISTORY: self.on_history,
+            FRAME_ROOM: self.on_room,
+            FRAME_MESSAGE: self.on_message,
+            FRAME_PING: self.on_ping,
+            FRAME_SESSION: self.on_session,
+        }
+        self.message_handlers = {
+            CHAT: self.show_chat,
+            PRIVATE: self.show_private,
+            ROOM: self.show_room,
+            NOTICE: self.show_notice,
+            INFO: self.show_info,
+            ACK: self.on_ack,
+        }
+
+        # Our messages the server has not acknowledged yet, by id. They are
+        # shown once acknowledged and sent again until then; the server
+        # delivers each id only once. Ids start at a random base so they do
+        # not repeat ids of an earlier run.
+        self.unacked = OrderedDict()  # msg_id: (kind, body, target, when it was last sent)
+        self.unacked_lock = threading.Lock()  # ACKs arrive on the receive thread
+        self.last_msg_id = int.from_bytes(os.urandom(4), "big") << 32
+
+        # Online users and the sequence number of the last presence change applied
+        self.online_users = set()
+        self.presence_seq = None
+        self.resync_requested = False
+
+        # Server history paging per chat: id of the oldest message shown,
+        # whether the server has older ones, and requests still in flight.
+        # Until the first page arrives we also remember the ids of messages
+        # received live, so the page starts before them and never repeats them.
+        self.history_oldest = {}
+        self.history_more = {}
+        self.history_pending = set()
+        self.live_ids = defaultdict(set)
+
+        # Messages at least this big are sent compressed, once the server agrees
+        self.compress_threshold = None
+
+        # If the connection drops we reconnect and resume our session with
+        # its token, telling the server the sequence number of the last
+        # message we got in each conversation so it sends only what we missed
+        self.session_token = None
+        self.seen_seqs = {}  # GROUP_CHAT, "#room" or username: last sequence number received
+        self.resuming = False
 
         # Initialize chat history with welcome messages
         self.chat_histories["Group Chat"].append("--- Welcome to Group Chat ---")
@@ -279,6 +363,8 @@ class ClientClientGUI:
                 
                 # Load this chat's history
                 self.load_chat_history(clean_name)
+                if clean_name not in self.history_more:
+                    self.request_history(clean_name)
     
     def load_chat_history(self, chat_name):
         """Load the chat history for the specified chat into the chat box"""
@@ -302,39 +388,137 @@ class ClientClientGUI:
             self.sock.connect((self.server_ip, self.server_port))
             self.sock.settimeout(None)
 
-            self.sock.sendall(self.name.encode('utf-8'))
+            send_frame(self.sock, "zlib", FRAME_HELLO)  # Offer compression before logging in
+            send_frame(self.sock, self.name)
 
             self.status_var.set(f"Connected to {self.server_ip}:{self.server_port} as {self.name}")
             threading.Thread(target=self.receive_message, daemon=True).start()
+            self.request_history("Group Chat")
+            self.master.after(RESEND_AFTER * 1000, self.resend_unacked)
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect: {e}")
             self.status_var.set("Disconnected")
             self.master.after(2000, self.master.destroy)
 
+    def join_room(self):
+        """Ask for a room name and join it (the server creates it if needed)"""
+        room = simpledialog.askstring("Join room", "Room name", parent=self.master)
+        if room and room.strip():
+            self.send_typed(JOIN, target=f"#{room.strip().lstrip('#')}")
+
+    def leave_room(self):
+        """Leave the room that is open"""
+        if self.current_chat in self.joined_rooms:
+            self.send_typed(LEAVE, target=self.current_chat)
+
+    def apply_room(self, room, joined):
+        """Add or remove the list entry of a room we joined or left"""
+        if joined:
+            if room in self.joined_rooms:
+                return
+            self.joined_rooms.append(room)
+            if not self.chat_histories[room]:
+                self.chat_histories[room].append(f"--- Room {room} ---")
+            self.chat_listbox.insert(len(self.joined_rooms), room)
+            return
+
+        if room not in self.joined_rooms:
+            return
+        self.joined_rooms.remove(room)
+        for i in range(1, self.chat_listbox.size()):
+            if self.clean_chat_name(self.chat_listbox.get(i)) == room:
+                self.chat_listbox.delete(i)
+                break
+        # Forget its history so a later join fetches it again
+        self.chat_histories.pop(room, None)
+        self.unread_messages.pop(room, None)
+        self.history_oldest.pop(room, None)
+        self.history_more.pop(room, None)
+        self.live_ids.pop(room, None)
+        if self.current_chat == room:
+            self.chat_listbox.selection_clear(0, tk.END)
+            self.chat_listbox.selection_set(0)
+            self.change_chat()
+
+    def reconnect(self):
+        """Keep trying to connect again until it works, then ask to resume our session"""
+        while True:
+            self.status_var.set("Connection lost, reconnecting...")
+            time.sleep(RECONNECT_DELAY)
+            try:
+                sock = socket.create_connection((self.server_ip, self.server_port), timeout=5)
+                sock.settimeout(None)
+                send_frame(sock, "zlib", FRAME_HELLO)
+                sock.sendall(encode_resume(self.session_token, self.presence_seq, self.seen_seqs))
+            except OSError:
+                continue
+            self.sock = sock
+            self.compress_threshold = None
+            self.resync_requested = False
+            self.history_pending.clear()  # Answers to those were lost with the old connection
+            self.resuming = True
+            return
+
+    def request_history(self, chat_name):
+        """Ask the server for the page of messages before the oldest one shown"""
+        if chat_name in self.history_pending or self.history_more.get(chat_name) is False:
+            return
+        conversation = GROUP_CHAT if chat_name == "Group Chat" else chat_name
+        before_id = self.history_oldest.get(chat_name)
+        if before_id is None and self.live_ids[chat_name]:
+            before_id = min(self.live_ids[chat_name])  # Only what came before we were here
+        try:
+            self.sock.sendall(encode_history_request(conversation, before_id, HISTORY_PAGE))
+            self.history_pending.add(chat_name)
+        except OSError as e:
+            print(f"History request error: {e}")
+
+    def apply_history(self, conversation, messages, more):
+        """Put a page of older messages above what the chat already shows"""
+        chat_name = "Group Chat" if conversation == GROUP_CHAT else conversation
+        self.history_pending.discard(chat_name)
+        self.history_more[chat_name] = more
+        live_ids = self.live_ids.pop(chat_name, ())
+        if not messages:
+            return
+        first_page = chat_name not in self.history_oldest
+        self.history_oldest[chat_name] = messages[0].msg_id
+
+        # A page asked for before anything arrived live may overlap what arrived since
+        lines = [self.format_message(message) for message in messages if message.msg_id not in live_ids]
+        history = self.chat_histories[chat_name]
+        start = 1 if history and history[0].startswith("--- ") else 0  # Keep the banner on top
+        history[start:start] = lines
+
+        if chat_name == self.current_chat:
+            self.load_chat_history(chat_name)
+            if not first_page:
+                # Keep the message that was at the top in view
+                self.chat_box.yview(f"{start + len(lines) + 1}.0")
+
+    def on_chat_scroll(self, first, last):
+        """Scrollbar update from the chat box; at the top, load the previous page"""
+        self.chat_box.vbar.set(first, last)
+        if float(first) == 0.0 and self.current_chat in self.history_more:
+            self.request_history(self.current_chat)
+
     def send_message(self, event=None):
         message_text = self.entry.get().strip()
         if not message_text:
             return
 
+        if len(self.unacked) >= SEND_WINDOW:
+            self.status_var.set("Waiting for the server to confirm earlier messages...")
+            return "break"
+
         try:
-            if self.current_chat == "Group Chat":
-                # Mark that we're sending a message to prevent doubling
-                self.message_sent = True
-                
-                # Send to server
-                msg = f"{self.name}: {message_text}"
-                self.sock.sendall(msg.encode('utf-8'))
-                
-                # Don't add to history here - it will come back from the server
+            # The message is shown when the server acknowledges it, so nothing is added here
+            if self.current_chat in self.joined_rooms:
+                self.send_numbered(ROOM, message_text, self.current_chat)
+            elif self.current_chat == "Group Chat":
+                self.send_numbered(CHAT, message_text)
             else:
-                # Format for private message
-                msg = f"@{self.current_chat}: {message_text}"
-                self.sock.sendall(msg.encode('utf-8'))
-                
-                # For private messages, we need to manually add our outgoing message
-                # to the chat history since the server confirmation comes in a different format
-                display_msg = f"You: {message_text}"
-                self.add_message_to_history(self.current_chat, display_msg)
+                self.send_numbered(PRIVATE, message_text, self.current_chat)
             
             self.entry.delete(0, tk.END)
         except Exception as e:
@@ -342,14 +526,51 @@ class ClientClientGUI:
             self.add_message_to_history(self.current_chat, error_msg)
             self.status_var.set("Disconnected")
         
-        # Reset the message sent flag after a short delay
-        self.master.after(100, self.reset_message_sent_flag)
-        
         return "break"  # Stops default Enter key behavior
-    
-    def reset_message_sent_flag(self):
-        """Reset the message sent flag after a delay"""
-        self.message_sent = False
+
+    def send_typed(self, kind, body="", target="", msg_id=0):
+        """Send one typed message, compressed if it is big and the server agreed"""
+        send_encoded(self.sock, encode_message(kind, body, target=target, msg_id=msg_id), self.compress_threshold)
+
+    def send_numbered(self, kind, body, target=""):
+        """Send a chat message under a new id and keep it until the server acknowledges it"""
+        self.last_msg_id += 1
+        with self.unacked_lock:
+            self.unacked[self.last_msg_id] = (kind, body, target, time.monotonic())
+        try:
+            self.send_typed(kind, body, target, self.last_msg_id)
+        except OSError:
+            if self.session_token is None:
+                raise
+            # We are reconnecting; it is sent again once the session is resumed
+
+    def resend_unacked(self):
+        """Send every message that has waited too long for its ACK again, under the same id"""
+        now = time.monotonic()
+        due = []
+        with self.unacked_lock:
+            for msg_id, (kind, body, target, sent) in self.unacked.items():
+                if now - sent >= RESEND_AFTER:
+                    self.unacked[msg_id] = (kind, body, target, now)
+                    due.append((msg_id, kind, body, target))
+        try:
+            for msg_id, kind, body, target in due:
+                self.send_typed(kind, body, target, msg_id)
+        except OSError as e:
+            print(f"Resend error: {e}")
+            if self.session_token is None:
+                return  # Disconnected for good
+        self.master.after(RESEND_AFTER * 1000, self.resend_unacked)
+
+    def resend_all(self):
+        """Send every unacknowledged message again straight away, after reconnecting"""
+        with self.unacked_lock:
+            now = time.monotonic()
+            due = [(msg_id, kind, body, target) for msg_id, (kind, body, target, _) in self.unacked.items()]
+            for msg_id, kind, body, target in due:
+                self.unacked[msg_id] = (kind, body, target, now)
+        for msg_id, kind, body, target in due:
+            self.send_typed(kind, body, target, msg_id)
 
     def add_message_to_history(self, chat_name, message):
         """Add a message to the specified chat history and update display if it's the current chat"""
@@ -399,57 +620,31 @@ class ClientClientGUI:
                     break
 
     def receive_message(self):
+        reader = FrameReader()
+        pending = deque()
         while True:
             try:
-                msg = self.sock.recv(1024).decode('utf-8')
-                if not msg:
+                frame = recv_frame(self.sock, reader, pending)
+                if frame is None:
                     self.status_var.set("Server connection closed")
-                    break
-
-                # Check if it's a user list update
-                if msg.startswith("/users "):
-                    user_list = msg[len("/users "):].split(",")
-                    self.update_user_list(user_list)
-                    continue
+                    if self.session_token is None:
+                        break
+                    raise ConnectionError("Server connection closed")
 
-                # Handle private messages - messages received from others
-                if msg.startswith("[Private from "):
-                    # Extract sender name
-                    end_idx = msg.find("]")
-                    if end_idx != -1:
-                        sender = msg[len("[Private from "):]
-                        sender = sender[:sender.find("]")]
-                        
-                        # Message without the prefix
-                        content = msg[end_idx + 2:]  # +2 to skip "] "
-                        
-                        # Add message to the private chat history
-                        display_msg = f"{sender}: {content}"
-                        self.add_message_to_history(sender, display_msg)
-                    continue
-                
-                # Handle private message confirmations - our messages sent to others
-                if msg.startswith("[Private to "):
-                    # We already added this message in the send_message method
-                    # So we don't need to process it again here
-                    continue
-
-                # Handle system messages (join/leave notifications)
-                if msg.startswith("*** "):
-                    # Add to group chat
-                    self.add_message_to_history("Group Chat", msg)
-                    continue
-                
-                # Handle our own messages in group chat - avoid duplication
-                if msg.startswith(f"{self.name}: ") and self.message_sent:
-                    # Replace with "You: " format for consistency
-                    display_msg = "You: " + msg[len(f"{self.name}: "):]
-                    self.add_message_to_history("Group Chat", display_msg)
-                    continue
-                
-                # Normal group message from others
-                self.add_message_to_history("Group Chat", msg)
+                frame_type, payload = frame
+                handler = self.frame_handlers.get(frame_type)
+                if handler is not None:
+                    handler(payload)
 
+            except OSError as e:
+                if self.session_token is None:
+                    self.add_message_to_history(self.current_chat, f"[Error receiving] {e}")
+                    break
+                # Our session is kept for a while: connect again and pick up where we left off
+                self.sock.close()
+                self.reconnect()
+                reader = FrameReader()
+                pending.clear()
             except Exception as e:
                 error_msg = f"[Error receiving] {e}"
                 self.add_message_to_history(self.current_chat, error_msg)
@@ -457,6 +652,163 @@ class ClientClientGUI:
         
         self.status_var.set("Disconnected from server")
 
+    def on_hello(self, payload):
+        """The server's answer to our compression offer"""
+        self.compress_threshold = decode_hello(payload)[1]
+
+    def on_users(self, payload):
+        """Full user list (on connect and after a resync)"""
+        seq, user_list = decode_users(payload)
+        self.presence_seq = seq
+        self.resync_requested = False
+        self.update_user_list(user_list)
+
+    def on_presence(self, payload):
+        """A single user joined or left"""
+        self.apply_presence(*decode_presence(payload))
+
+    def on_history(self, payload):
+        """A page of older messages we asked for"""
+        self.apply_history(*decode_history(payload))
+
+    def on_room(self, payload):
+        """We joined or left a room"""
+        self.apply_room(*decode_room(payload))
+
+    def on_message(self, payload):
+        """A typed chat message, handled according to its kind"""
+        message = decode_message(payload)
+        if message.seq and message.kind in (CHAT, PRIVATE, ROOM):
+            self.note_seq(message.kind, message.sender, message.target, message.seq)
+            if message.sender == self.name:
+                return  # Replayed after a reconnect; ours are shown when they are acknowledged
+        dispatch(self.message_handlers, message)
+
+    def note_seq(self, kind, sender, target, seq):
+        """Remember how far we got in the conversation a numbered message belongs to"""
+        if kind == CHAT:
+            conversation = GROUP_CHAT
+        elif kind == ROOM:
+            conversation = target
+        else:
+            conversation = target if sender == self.name else sender
+        if seq > self.seen_seqs.get(conversation, 0):
+            self.seen_seqs[conversation] = seq
+
+    def on_session(self, payload):
+        """Our resume token after logging in, or the answer to a resume"""
+        token, _ = decode_session(payload)
+        resumed, self.resuming = self.resuming, False
+        if token != self.session_token:
+            # A new session (e.g. the server restarted with --handoff) numbers every
+            # conversation from 1 again: our old counts would hide its messages on resume
+            self.seen_seqs.clear()
+        if token is None:
+            # The session ended while we were away: log in again and rejoin our rooms
+            self.session_token = None
+            send_frame(self.sock, self.name)
+            for room in self.joined_rooms:
+                self.send_typed(JOIN, target=room)
+            self.resend_all()
+            self.add_message_to_history(self.current_chat,
+                                        "[Reconnected] Your session had ended, some messages may be missing")
+        elif resumed:
+            self.session_token = token
+            self.resend_all()
+        else:
+            self.session_token = token
+        self.status_var.set(f"Connected to {self.server_ip}:{self.server_port} as {self.name}")
+
+    def on_ping(self, payload):
+        """The server checking we are still here; it disconnects us if we do not answer"""
+        send_frame(self.sock, b"", FRAME_PONG)
+
+    def on_ack(self, message):
+        """The server handled one of our messages: show it, or why it was refused"""
+        with self.unacked_lock:
+            sent = self.unacked.pop(message.msg_id, None)
+        if sent is None:
+            return  # The ACK of a resend we had already had an ACK for
+        kind, body, target, _ = sent
+        if message.seq:
+            self.note_seq(kind, self.name, target, message.seq)
+        chat_name = "Group Chat" if kind == CHAT else target
+        if message.body:
+            self.add_message_to_history(chat_name, f"[Not sent] {body} ({message.body})")
+        else:
+            self.add_message_to_history(chat_name, f"You: {body}")
+
+    def format_message(self, message):
+        """How a chat line looks in the chat box"""
+        if message.sender == self.name:
+            return f"You: {message.body}"
+        return f"{message.sender}: {message.body}"
+
+    def show_live(self, chat_name, message):
+        """Show a message that arrived live, remembering its id until the chat's first history page"""
+        if message.msg_id and chat_name not in self.history_more:
+            self.live_ids[chat_name].add(message.msg_id)
+        self.add_message_to_history(chat_name, self.format_message(message))
+
+    def show_chat(self, message):
+        self.show_live("Group Chat", message)
+
+    def show_private(self, message):
+        # Our own private messages only come back like this from history
+        chat_name = message.target if message.sender == self.name else message.sender
+        self.show_live(chat_name, message)
+
+    def show_room(self, message):
+        if message.target in self.joined_rooms:
+            self.show_live(message.target, message)
+
+    def show_notice(self, message):
+        """Join and leave announcements, for the group chat or a room"""
+        if not message.target:
+            self.add_message_to_history("Group Chat", f"*** {message.body} ***")
+        elif message.target in self.joined_rooms:
+            self.add_message_to_history(message.target, f"*** {message.body} ***")
+
+    def show_info(self, message):
+        """Answers and errors from the server go to whichever chat is open"""
+        self.add_message_to_history(self.current_chat, f"[Server] {message.body}")
+
+    def apply_presence(self, seq, user, online):
+        """Apply one presence change, or ask for a full list if one was missed"""
+        if self.presence_seq is None or self.resync_requested or seq <= self.presence_seq:
+            return  # Waiting for a snapshot, or already covered by one
+        if seq != self.presence_seq + 1:
+            # Gap in the sequence: our list is out of date
+            self.resync_requested = True
+            send_frame(self.sock, b"", FRAME_RESYNC)
+            return
+
+        self.presence_seq = seq
+        if online:
+            self.add_user_to_list(user)
+        else:
+            self.remove_user_from_list(user)
+
+    def add_user_to_list(self, user):
+        """Add one user to the chat list without rebuilding it"""
+        if not user or user == self.name or user in self.online_users:
+            return
+        self.online_users.add(user)
+        if not self.chat_histories[user]:
+            self.chat_histories[user].append(f"--- Beginning of conversation with {user} ---")
+        unread = self.unread_messages[user]
+        self.chat_listbox.insert(tk.END, f"{user} ({unread})" if unread > 0 else user)
+
+    def remove_user_from_list(self, user):
+        """Remove one user from the chat list without rebuilding it"""
+        if user not in self.online_users:
+            return
+        self.online_users.discard(user)
+        for i in range(1 + len(self.joined_rooms), self.chat_listbox.size()):  # Skip "Group Chat" and rooms
+            if self.clean_chat_name(self.chat_listbox.get(i)) == user:
+                self.chat_listbox.delete(i)
+                break
+
     def update_user_list(self, usernames):
         # Remember currently selected item
         selected_index = self.chat_listbox.curselection()
@@ -465,13 +817,16 @@ class ClientClientGUI:
             current_selection = self.clean_chat_name(self.chat_listbox.get(selected_index[0]))
         
         # Store existing users for comparison
+        first_user = 1 + len(self.joined_rooms)  # Skip "Group Chat" and the rooms
         existing_users = set()
-        for i in range(1, self.chat_listbox.size()):  # Skip "Group Chat"
+        for i in range(first_user, self.chat_listbox.size()):
             existing_users.add(self.clean_chat_name(self.chat_listbox.get(i)))
         
-        # Clear all except Group Chat
-        self.chat_listbox.delete(1, tk.END)
+        # Clear all except Group Chat and the rooms
+        self.chat_listbox.delete(first_user, tk.END)
         
+        self.online_users = {user for user in usernames if user and user != self.name}
+
         # Add all users except self
         for user in usernames:
             if user and user != self.name:
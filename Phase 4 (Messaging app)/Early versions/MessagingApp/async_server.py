@@ -0,0 +1,218 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from connection import Connection, apply_nodelay, bytes_received, open_connections
+from jsonlog import error, info, warning
+from protocol import HEADER_SIZE, FrameReader, ProtocolError
+
+LISTEN_BACKLOG = 4096
+WRITE_BUFFER_HIGH = 64 * 1024  # Bytes buffered in a transport before we stop writing to it
+
+
+def raise_open_file_limit():
+    """Allow as many sockets as the OS hard limit permits (one fd per client)"""
+    try:
+        import resource
+    except ImportError:  # Windows has no RLIMIT_NOFILE
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            warning("open_file_limit", error=str(e))
+
+
+class TransportConnection(Connection):
+    """A client connection driven by the event loop instead of threads.
+
+    Frames go from the bounded queue into the transport until the transport's
+    own buffer passes its high-water mark; then they wait in the queue (where
+    the overflow policy applies) until the socket drains. Transports may only
+    be used from the loop's thread, so frames queued from other threads (the
+    worker bus) are handed over by a callback scheduled on the loop. With a
+    flush window the first frame starts a timer instead of being written.
+    """
+
+    def __init__(self, transport, addr):
+        super().__init__(addr)
+        self.transport = transport
+        self.paused = False
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wake_pending = False
+        self.flush_timer = None
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        apply_nodelay(transport.get_extra_info("socket"))
+
+    def wake_writer(self):
+        if threading.get_ident() != self.loop_thread:
+            if not self.wake_pending:
+                self.wake_pending = True
+                self.loop.call_soon_threadsafe(self.wake_from_thread)
+            return
+        if self.paused:
+            return  # resume_writing() flushes
+        if self.flush_window and not self.closing and self.queued_bytes < self.flush_bytes:
+            if self.flush_timer is None:
+                self.flush_timer = self.loop.call_later(self.flush_window, self.timed_flush)
+            return
+        self.flush()
+
+    def wake_from_thread(self):
+        with self.lock:
+            self.wake_pending = False
+            if self.outbound or self.closing:
+                self.wake_writer()
+
+    def timed_flush(self):
+        with self.lock:
+            self.flush_timer = None
+            if not self.paused:
+                self.flush()
+
+    def flush(self):
+        """Move queued frames into the transport while it is accepting writes"""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        outbound = self.outbound
+        transport = self.transport
+        while outbound and not self.paused:
+            if transport.is_closing():
+                # The socket failed or was closed, connection_lost() is on its way
+                self.clear_outbound()
+                return
+            transport.writelines(self.take_batch())  # May call pause_writing()
+        if self.closing and not outbound:
+            transport.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        with self.lock:
+            self.flush()
+
+    def abort(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.transport.abort)
+        else:
+            self.transport.abort()
+
+    def connection_lost(self):
+        with self.lock:
+            self.closing = True
+            self.clear_outbound()
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+
+class ChatProtocol(asyncio.Protocol):
+    """Per-connection state for the asyncio server.
+
+    No task or stack is kept per client: an idle connection is just this
+    object, its transport and an empty read buffer. The chat logic itself
+    lives in server.py and is passed in as callbacks. A client over its
+    rate limit has reading paused; frames that already arrived wait in
+    backlog until it is resumed.
+    """
+    __slots__ = ("client", "reader", "transport", "backlog", "throttled", "on_login", "on_frame",
+                 "on_disconnect")
+
+    def __init__(self, on_login, on_frame, on_disconnect):
+        self.client = None
+        self.backlog = deque()
+        self.throttled = False
+        self.on_login = on_login
+        self.on_frame = on_frame
+        self.on_disconnect = on_disconnect
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info("peername")
+        self.transport = transport
+        self.client = TransportConnection(transport, addr)
+        self.reader = FrameReader(self.client.compression_stats, bytes_received)
+        info("new_connection", addr=addr)
+        info("active_connections", count=open_connections.inc())
+
+    def data_received(self, data):
+        client = self.client
+        client.last_seen = time.monotonic()
+        try:
+            frames = self.reader.feed(data)
+        except ProtocolError as e:
+            warning("protocol_error", addr=client.addr, error=str(e))
+            client.close()
+            return
+        self.backlog.extend(frames)
+        if not self.throttled:
+            self.handle_backlog()
+
+    def handle_backlog(self):
+        """Handle received frames until there are none left or the client goes over its rate limit"""
+        client = self.client
+        backlog = self.backlog
+        while backlog:
+            if client.closing:
+                backlog.clear()
+                return
+            frame_type, payload = backlog.popleft()
+            try:
+                if client.username is None:
+                    # A hello, then the username or a resume token; None means not logged in yet
+                    if self.on_login(client, frame_type, payload) is False:
+                        client.close()
+                        return
+                else:
+                    self.on_frame(client, frame_type, payload)
+            except Exception as e:
+                error("client_error", username=client.username, error=str(e))
+                client.close()
+                return
+            delay = client.charge(HEADER_SIZE + len(payload))
+            if delay:
+                # Backpressure: leave the client's data in its socket until it is under its limits again
+                self.throttled = True
+                self.transport.pause_reading()
+                client.loop.call_later(delay, self.resume)
+                return
+
+    def resume(self):
+        self.throttled = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+            self.handle_backlog()
+
+    def pause_writing(self):
+        self.client.pause_writing()
+
+    def resume_writing(self):
+        self.client.resume_writing()
+
+    def connection_lost(self, exc):
+        self.backlog.clear()
+        self.client.connection_lost()
+        open_connections.dec()
+        self.on_disconnect(self.client)
+        info("disconnect", addr=self.client.addr)
+
+
+async def serve(host, port, on_login, on_frame, on_disconnect, reuse_port=False):
+    loop = asyncio.get_running_loop()
+    factory = partial(ChatProtocol, on_login, on_frame, on_disconnect)
+    listener = await loop.create_server(factory, host, port, reuse_address=True,
+                                        reuse_port=reuse_port or None, backlog=LISTEN_BACKLOG)
+    async with listener:
+        await listener.serve_forever()
+
+
+def run_async_server(host, port, on_login, on_frame, on_disconnect, reuse_port=False):
+    """Serve every client from a single event loop thread"""
+    raise_open_file_limit()
+    asyncio.run(serve(host, port, on_login, on_frame, on_disconnect, reuse_port))
@@ -0,0 +1,70 @@
+import argparse
+import json
+import time
+
+from codec import CHAT, PRIVATE, decode_message, dispatch, encode_message
+from protocol import HEADER_SIZE, FRAME_TEXT, encode_frame
+
+# Microbenchmarks for codec.py: how many messages per second can be encoded
+# into frames and decoded and dispatched again. The text lines and JSON
+# objects the codec replaced are measured the same way for comparison.
+#   python bench_codec.py [--count N]
+
+SAMPLES = {
+    "short": ("alice", "bob", "hey, are you coming to the lab later?"),
+    "1 KB": ("alice", "bob", "log line 0123456789 " * 51),
+}
+
+
+def text_decode(line):
+    """The old way: work out the kind of a text line from how it starts"""
+    if line.startswith("[Private from "):
+        end = line.find("]")
+        return PRIVATE, line[len("[Private from "):end], line[end + 2:]
+    if line.startswith("[Private to "):
+        return None
+    if line.startswith("*** "):
+        return None
+    return CHAT, line
+
+
+def measure(label, count, payload_size, encode, decode):
+    started = time.perf_counter()
+    frames = [encode() for _ in range(count)]
+    encode_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    decode_time = time.perf_counter() - started
+
+    print(f"{label:<22} {len(frames[0]):>6} B  encode {count / encode_time:>11,.0f} msg/s  "
+          f"decode {count / decode_time:>11,.0f} msg/s  "
+          f"({count * payload_size / decode_time / 1e6:,.1f} MB/s body)")
+
+
+def run(count):
+    handled = []
+    handlers = {CHAT: handled.append, PRIVATE: handled.append}
+
+    for name, (sender, target, body) in SAMPLES.items():
+        size = len(body.encode('utf-8'))
+        print(f"--- {name} message, {count:,} times")
+        measure("codec", count, size,
+                lambda: encode_message(PRIVATE, body, sender, target, 12345, 1715420000.0),
+                lambda frame: dispatch(handlers, decode_message(memoryview(frame)[HEADER_SIZE:])))
+        measure("text (old)", count, size,
+                lambda: encode_frame(FRAME_TEXT, f"[Private from {sender}] {body}"),
+                lambda frame: text_decode(frame[HEADER_SIZE:].decode('utf-8')))
+        measure("json", count, size,
+                lambda: encode_frame(FRAME_TEXT, json.dumps(
+                    {"kind": PRIVATE, "id": 12345, "ts": 1715420000.0,
+                     "sender": sender, "target": target, "body": body})),
+                lambda frame: json.loads(frame[HEADER_SIZE:]))
+        handled.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode/decode throughput of the message codec")
+    parser.add_argument("--count", type=int, default=200000, help="messages per measurement")
+    run(parser.parse_args().count)
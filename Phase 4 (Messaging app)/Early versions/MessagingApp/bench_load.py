@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+from async_server import raise_open_file_limit
+from codec import CHAT, PRIVATE, decode_message, encode_message
+from protocol import FRAME_HELLO, FRAME_MESSAGE, FRAME_TEXT, FrameReader, encode_frame
+
+# Load generator for server.py: N simulated clients in one asyncio process
+# register, send group and private ("@user") messages at a fixed rate and
+# time every delivery. The result is printed as JSON so runs against
+# different server modes or commits can be compared:
+#   python bench_load.py --clients 200 --rate 1 --duration 30
+#   python bench_load.py --spawn "--mode async" --label async
+#   python bench_load.py --clients 1000 --processes 4
+# Each message body carries its send time (time.monotonic_ns()); all clients
+# use the same monotonic clock, so latency is measured end to end.
+
+HOST = "127.0.0.1"
+PORT = 12345
+
+
+class Stats:
+    def __init__(self):
+        self.sent = {CHAT: 0, PRIVATE: 0}
+        self.latencies = {CHAT: [], PRIVATE: []}  # Milliseconds
+        self.errors = 0
+        self.recording = False
+
+
+class BenchClient:
+    def __init__(self, index, prefix, stats):
+        self.username = f"{prefix}{index}"
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port, compress):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        if compress:
+            self.writer.write(encode_frame(FRAME_HELLO, "zlib"))
+        self.writer.write(encode_frame(FRAME_TEXT, self.username))
+        await self.writer.drain()
+
+    async def receive(self):
+        frames = FrameReader()
+        latencies = self.stats.latencies
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                now = time.monotonic_ns()
+                for frame_type, payload in frames.feed(data):
+                    if frame_type != FRAME_MESSAGE:
+                        continue
+                    message = decode_message(payload)
+                    if message.kind not in latencies or not message.body.startswith("bench "):
+                        continue
+                    if message.kind == PRIVATE and message.sender == self.username:
+                        continue  # The sender's own copy; the target's is the delivery
+                    if self.stats.recording:
+                        sent_at = int(message.body.split(" ", 2)[1])
+                        latencies[message.kind].append((now - sent_at) / 1e6)
+        except (OSError, ValueError) as e:
+            self.stats.errors += 1
+            print(f"[BENCH ERROR] {self.username} | {e}", file=sys.stderr)
+
+    async def send_loop(self, usernames, rate, private_ratio, deadline):
+        interval = 1 / rate
+        next_send = time.monotonic() + random.uniform(0, interval)  # Spread clients over the interval
+        while next_send < deadline:
+            await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+            body = f"bench {time.monotonic_ns()}"
+            if random.random() < private_ratio:
+                target = random.choice(usernames)
+                while target == self.username and len(usernames) > 1:
+                    target = random.choice(usernames)
+                frame, kind = encode_message(PRIVATE, body, target=target), PRIVATE
+            else:
+                frame, kind = encode_message(CHAT, body), CHAT
+            try:
+                self.writer.write(frame)
+                await self.writer.drain()
+            except OSError:
+                self.stats.errors += 1
+                return
+            self.stats.sent[kind] += 1
+            next_send += interval
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        "deliveries": len(ordered),
+        "p50_ms": percentile(ordered, 0.50),
+        "p99_ms": percentile(ordered, 0.99),
+        "p999_ms": percentile(ordered, 0.999),
+        "max_ms": round(ordered[-1], 3) if ordered else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def spawn_server(port, server_args):
+    """Start server.py on port with extra arguments and wait until it accepts connections"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    process = subprocess.Popen([sys.executable, script, "--port", str(port), *shlex.split(server_args)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit(f"[ERROR] Server did not start on port {port}")
+
+
+async def run(args, first, last, barrier=None):
+    """Drive users first..last-1 of the run and return what they sent and received"""
+    stats = Stats()
+    usernames = [f"{args.prefix}{i}" for i in range(args.clients)]
+    clients = [BenchClient(i, args.prefix, stats) for i in range(first, last)]
+
+    started = time.monotonic()
+    for batch in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*(client.connect(args.host, args.port, args.compress)
+                               for client in clients[batch:batch + args.connect_batch]))
+    connect_time = time.monotonic() - started
+    receivers = [asyncio.create_task(client.receive()) for client in clients]
+    if barrier is not None:
+        # Wait for the other processes' users, they may be sent private messages
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    await asyncio.sleep(args.settle)  # Let the join notices and user lists go by
+
+    stats.recording = True
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(client.send_loop(usernames, args.rate, args.private_ratio, deadline)
+                           for client in clients))
+    send_time = time.monotonic() - started
+    await asyncio.sleep(args.drain)  # Wait for messages still on their way
+    stats.recording = False
+
+    for client in clients:
+        client.close()
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return {"sent": stats.sent, "latencies": stats.latencies, "errors": stats.errors,
+            "connect_time": connect_time, "send_time": send_time}
+
+
+def run_process(args, first, last, barrier, results):
+    """Entry point of one load generating process"""
+    random.seed(None if args.seed is None else args.seed + first)
+    results.put(asyncio.run(run(args, first, last, barrier)))
+
+
+def run_processes(args):
+    """Split the users over args.processes processes and return their results"""
+    if args.processes == 1:
+        random.seed(args.seed)
+        return [asyncio.run(run(args, 0, args.clients))]
+    import multiprocessing
+    barrier = multiprocessing.Barrier(args.processes)
+    results = multiprocessing.Queue()
+    bounds = [args.clients * i // args.processes for i in range(args.processes + 1)]
+    processes = [multiprocessing.Process(target=run_process, args=(args, bounds[i], bounds[i + 1], barrier, results))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return collected
+
+
+def report(args, runs):
+    """Combine the runs of every process into the JSON result"""
+    sent = {kind: sum(run["sent"][kind] for run in runs) for kind in (CHAT, PRIVATE)}
+    group = [latency for run in runs for latency in run["latencies"][CHAT]]
+    private = [latency for run in runs for latency in run["latencies"][PRIVATE]]
+    send_time = max(run["send_time"] for run in runs)
+    expected = sent[CHAT] * args.clients + sent[PRIVATE]
+    delivered = len(group) + len(private)
+    return {
+        "label": args.label,
+        "commit": git_commit(),
+        "server": f"{args.host}:{args.port}",
+        "clients": args.clients,
+        "processes": args.processes,
+        "rate_per_client": args.rate,
+        "private_ratio": args.private_ratio,
+        "seed": args.seed,
+        "compress": args.compress,
+        "duration_s": round(send_time, 3),
+        "connect_s": round(max(run["connect_time"] for run in runs), 3),
+        "sent": {"group": sent[CHAT], "private": sent[PRIVATE]},
+        "sent_per_s": round(sum(sent.values()) / send_time, 1),
+        "delivered": delivered,
+        "expected": expected,
+        "delivered_per_s": round(delivered / send_time, 1),
+        "lost": expected - delivered,
+        "errors": sum(run["errors"] for run in runs),
+        "latency": summarize(group + private),
+        "group_latency": summarize(group),
+        "private_latency": summarize(private),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the chat server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--clients", type=int, default=50, help="simulated users")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second sent by each user")
+    parser.add_argument("--private-ratio", type=float, default=0.5,
+                        help="share of messages sent as @user private messages instead of to the group")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait after everyone has connected")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for late deliveries")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="load generating processes; use more when one cannot keep up with the deliveries")
+    parser.add_argument("--connect-batch", type=int, default=100, help="connections opened at once")
+    parser.add_argument("--compress", action="store_true", help="offer zlib compression in a FRAME_HELLO")
+    parser.add_argument("--seed", type=int, help="random seed, for the same traffic mix in every run")
+    parser.add_argument("--label", help="name for this run in the output, e.g. the server mode")
+    parser.add_argument("--spawn", metavar="SERVER_ARGS",
+                        help='start server.py on --port with these arguments (e.g. "--mode async") and stop it after')
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.clients < 1 or not 1 <= args.processes <= args.clients:
+        parser.error("--rate and --clients must be positive, --processes between 1 and --clients")
+    args.prefix = f"b{os.getpid() % 10000}x"  # Usernames unlikely to clash with a previous run's
+
+    raise_open_file_limit()
+    server = spawn_server(args.port, args.spawn) if args.spawn is not None else None
+    try:
+        result = report(args, run_processes(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
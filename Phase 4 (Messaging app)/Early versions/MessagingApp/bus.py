@@ -0,0 +1,553 @@
+import argparse
+import itertools
+import socket
+import threading
+from collections import deque
+
+from jsonlog import error, info
+from protocol import FrameReader, ProtocolError, encode_frame, recv_frame
+
+# Frames exchanged between chat server nodes (pre-fork workers or cluster
+# hosts) and the broker. They use the same length-prefixed framing as the
+# chat protocol.
+BUS_HELLO = 0x01      # node -> broker: node id
+BUS_SNAPSHOT = 0x02   # broker -> node: "seq keeps_history" line (1 or 0), then one username per line
+BUS_CLAIM = 0x03      # node -> broker: "request id" line, then username
+BUS_CLAIMED = 0x04    # broker -> node: "request id" line, then "1" (ok) or "0" (taken)
+BUS_RELEASE = 0x05    # node -> broker: username
+BUS_PRESENCE = 0x06   # broker -> nodes: same payload as FRAME_PRESENCE
+BUS_BROADCAST = 0x07  # both ways: an encoded client frame for every user
+BUS_DIRECT = 0x08     # both ways: target username line, then an encoded client frame
+BUS_SUBSCRIBE = 0x09    # node -> broker: room (the node has its first member in it)
+BUS_UNSUBSCRIBE = 0x0A  # node -> broker: room (the node's last member left it)
+BUS_ROOM = 0x0B         # both ways: room line, then an encoded client frame for its members
+BUS_RECORD = 0x0C       # node -> broker: "request id", conversation, sender and timestamp lines, then body
+BUS_RECORDED = 0x0D     # broker -> node: "request id" line, then the message's id in the log (0 if not kept)
+BUS_HISTORY = 0x0E      # node -> broker: "request id", before id ("" for the newest) and limit lines, then conversation
+BUS_PAGE = 0x0F         # broker -> node: "request id" and "more" (1 or 0) lines, then msglog records, oldest first
+
+CLAIM_TIMEOUT = 5  # Seconds a node waits for the broker to answer a claim
+REQUEST_TIMEOUT = 5  # Seconds a node waits for the broker to answer any other request
+BROKER_PORT = 12350  # Default TCP port of a standalone cluster broker
+PEER_QUEUE_BYTES = 64 * 1024 * 1024  # Frames queued for a node before it is dropped as stalled
+
+
+def parse_address(address):
+    """Return (family, address) for "host:port" (TCP) or a Unix socket path"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+def split_line(payload):
+    """Split a payload into its first line (str) and the rest (bytes)"""
+    head, _, rest = payload.partition(b"\n")
+    return head.decode('utf-8'), rest
+
+
+class PresenceDirectory:
+    """Maps every online username to the node serving it.
+
+    It is the single place a username is claimed, so a name is unique across
+    the whole cluster, and it numbers each change so every client sees the
+    same presence sequence. The broker calls it with its lock held.
+    """
+
+    def __init__(self):
+        self.owners = {}  # username: node id
+        self.seq = 0
+
+    def claim(self, username, node_id):
+        """Give username to node_id. Returns the change's sequence number, or None if taken."""
+        if username in self.owners:
+            return None
+        self.owners[username] = node_id
+        self.seq += 1
+        return self.seq
+
+    def release(self, username, node_id):
+        """Free username if node_id owns it. Returns the sequence number, or None."""
+        if self.owners.get(username) != node_id:
+            return None
+        del self.owners[username]
+        self.seq += 1
+        return self.seq
+
+    def release_node(self, node_id):
+        """Free every username on node_id. Returns a list of (seq, username)."""
+        released = []
+        for username in [name for name, owner in self.owners.items() if owner == node_id]:
+            released.append((self.release(username, node_id), username))
+        return released
+
+    def lookup(self, username):
+        """Node id serving username, or None"""
+        return self.owners.get(username)
+
+    def snapshot(self):
+        """(seq, usernames) at this moment"""
+        return self.seq, list(self.owners)
+
+
+class Peer:
+    """A node connected to the broker and the frames waiting to be written to it.
+
+    The broker only queues frames here, often with its lock held, and a
+    writer thread per node sends them in order, so a node that stops
+    reading holds up nobody but itself. One that falls PEER_QUEUE_BYTES
+    behind is disconnected.
+    """
+
+    def __init__(self, node_id, sock):
+        self.node_id = node_id
+        self.sock = sock
+        self.queue = deque()
+        self.queued = 0  # Bytes in queue
+        self.ready = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, frame):
+        with self.ready:
+            if self.closed:
+                return
+            if self.queued + len(frame) > PEER_QUEUE_BYTES:
+                error("bus_error", node_id=self.node_id, error="node is not reading, disconnecting it")
+                self.closed = True
+                self.ready.notify()
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)  # handle_node then drops the node
+                except OSError:
+                    pass
+                return
+            self.queue.append(frame)
+            self.queued += len(frame)
+            self.ready.notify()
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                frames = list(self.queue)
+                self.queue.clear()
+                self.queued = 0
+            try:
+                self.sock.sendall(b"".join(frames))
+            except OSError:
+                return  # handle_node cleans up when its read fails
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class BusBroker:
+    """Connects chat server nodes to each other.
+
+    In pre-fork mode it runs inside the master process on a Unix socket; for
+    a cluster it runs on its own (python bus.py) and nodes connect over TCP.
+    Group frames are relayed to every other node, private frames only to the
+    node the presence directory lists for the target user, and room frames
+    only to the nodes subscribed to the room. With a history (a
+    msglog.MessageLog) the broker keeps the one message log for all nodes,
+    so every message gets the same id everywhere.
+    """
+
+    def __init__(self, listener, history=None):
+        self.listener = listener
+        self.history = history
+        self.lock = threading.Lock()
+        self.nodes = {}  # node id: Peer
+        self.directory = PresenceDirectory()
+        self.rooms = {}  # room: set of subscribed node ids
+
+    def serve_forever(self):
+        while True:
+            sock, _ = self.listener.accept()
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.handle_node, args=(sock,), daemon=True).start()
+
+    def user_count(self):
+        """Users online on every node"""
+        return len(self.directory.owners)
+
+    def send(self, node_id, frame_type, payload):
+        """Queue a frame for a node; never blocks, so it is safe with the lock held"""
+        peer = self.nodes.get(node_id)
+        if peer is not None:
+            peer.send(encode_frame(frame_type, payload))
+
+    def send_all(self, frame_type, payload, exclude=None):
+        frame = encode_frame(frame_type, payload)
+        for node_id, peer in list(self.nodes.items()):
+            if node_id != exclude:
+                peer.send(frame)
+
+    def handle_node(self, sock):
+        reader = FrameReader()
+        pending = deque()
+        node_id = None
+        try:
+            frame = recv_frame(sock, reader, pending)
+            if frame is None or frame[0] != BUS_HELLO:
+                return
+            with self.lock:
+                if frame[1].decode('utf-8') in self.nodes:
+                    error("bus_error", node_id=frame[1].decode('utf-8'), error="node id is already connected")
+                    return
+                node_id = frame[1].decode('utf-8')
+                self.nodes[node_id] = Peer(node_id, sock)
+                seq, usernames = self.directory.snapshot()
+                self.send(node_id, BUS_SNAPSHOT,
+                          "\n".join([f"{seq} {int(self.history is not None)}", *usernames]))
+            info("bus_node_connected", node_id=node_id)
+
+            while True:
+                frame = recv_frame(sock, reader, pending)
+                if frame is None:
+                    break
+                self.handle_frame(node_id, *frame)
+        except (OSError, ProtocolError) as e:
+            error("bus_error", node_id=node_id, error=str(e))
+        finally:
+            if node_id is not None:
+                self.drop_node(node_id)
+                info("bus_node_disconnected", node_id=node_id)
+            sock.close()
+
+    def handle_frame(self, node_id, frame_type, payload):
+        if frame_type == BUS_CLAIM:
+            request_id, username = split_line(payload)
+            username = username.decode('utf-8')
+            with self.lock:
+                seq = self.directory.claim(username, node_id)
+                self.send(node_id, BUS_CLAIMED, f"{request_id}\n{int(seq is not None)}")
+                if seq is not None:
+                    self.announce(seq, username, True)
+        elif frame_type == BUS_RELEASE:
+            username = payload.decode('utf-8')
+            with self.lock:
+                seq = self.directory.release(username, node_id)
+                if seq is not None:
+                    self.announce(seq, username, False)
+        elif frame_type == BUS_BROADCAST:
+            self.send_all(BUS_BROADCAST, payload, exclude=node_id)
+        elif frame_type == BUS_DIRECT:
+            target, _ = split_line(payload)
+            target_node = self.directory.lookup(target)
+            if target_node is not None:
+                self.send(target_node, BUS_DIRECT, payload)
+        elif frame_type == BUS_SUBSCRIBE:
+            with self.lock:
+                self.rooms.setdefault(payload.decode('utf-8'), set()).add(node_id)
+        elif frame_type == BUS_UNSUBSCRIBE:
+            with self.lock:
+                self.unsubscribe(payload.decode('utf-8'), node_id)
+        elif frame_type == BUS_ROOM:
+            room, _ = split_line(payload)
+            with self.lock:
+                subscribers = list(self.rooms.get(room, ()))
+            for subscriber in subscribers:
+                if subscriber != node_id:
+                    self.send(subscriber, BUS_ROOM, payload)
+        elif frame_type == BUS_RECORD:
+            request_id, rest = split_line(payload)
+            conversation, sender, timestamp, body = rest.split(b"\n", 3)
+            msg_id = self.record(conversation.decode('utf-8'), sender.decode('utf-8'), body.decode('utf-8'),
+                                 float(timestamp))
+            self.send(node_id, BUS_RECORDED, f"{request_id}\n{msg_id}")
+        elif frame_type == BUS_HISTORY:
+            request_id, rest = split_line(payload)
+            before_id, limit, conversation = rest.decode('utf-8').split("\n", 2)
+            self.send(node_id, BUS_PAGE, f"{request_id}\n".encode('utf-8')
+                      + self.page(conversation, int(before_id) if before_id else None, int(limit)))
+
+    def page(self, conversation, before_id, limit):
+        """BUS_PAGE answer (without the request id) for one page of conversation"""
+        if self.history is None:
+            return b"0\n"
+        from msglog import encode_record
+        records, more = self.history.page(conversation, before_id, limit)
+        return f"{int(more)}\n".encode('utf-8') + b"".join(
+            encode_record(r.msg_id, r.timestamp, r.conversation, r.sender, r.body) for r in records)
+
+    def record(self, conversation, sender, body, timestamp):
+        """Append a message to the log and return its id, 0 if there is no log"""
+        if self.history is None:
+            return 0
+        try:
+            return self.history.append(conversation, sender, body, timestamp)
+        except OSError as e:
+            error("history_error", error=str(e))
+            return 0
+
+    def unsubscribe(self, room, node_id):
+        """Stop sending room's frames to node_id (lock held)"""
+        subscribers = self.rooms.get(room)
+        if subscribers is not None:
+            subscribers.discard(node_id)
+            if not subscribers:
+                del self.rooms[room]
+
+    def announce(self, seq, username, online):
+        """Send a numbered presence change to every node (lock held)"""
+        self.send_all(BUS_PRESENCE, f"{seq}\n{'+' if online else '-'}{username}")
+
+    def drop_node(self, node_id):
+        """Forget a node and sign out every user it was serving"""
+        with self.lock:
+            self.nodes.pop(node_id).close()
+            for room in list(self.rooms):
+                self.unsubscribe(room, node_id)
+            for seq, username in self.directory.release_node(node_id):
+                self.announce(seq, username, False)
+
+
+class ClusterBackend:
+    """What server.py needs from whatever links it to the other nodes.
+
+    A backend delivers what it receives to the server through callbacks:
+      on_snapshot(seq, usernames)         directory when the node connects
+      on_claimed(username, client)        a claim succeeded (runs before its presence change)
+      on_presence(seq, username, online)  a user joined or left on any node
+      on_broadcast(frame)                 a group frame from another node
+      on_direct(target, frame)            a frame for one of this node's users
+      on_room(room, frame)                a frame for this node's members of room
+      on_lost()                           the backend went away
+    Register new backends in BACKENDS so server.py --cluster-backend can use them.
+    """
+
+    def claim(self, username, client):
+        """Reserve username on every node. Returns True if it was free."""
+        raise NotImplementedError
+
+    def release(self, username):
+        """Give username back after its user left this node"""
+        raise NotImplementedError
+
+    def publish(self, frame):
+        """Send an encoded client frame to the users on every other node"""
+        raise NotImplementedError
+
+    def direct(self, target, frame):
+        """Send an encoded client frame to the node serving target"""
+        raise NotImplementedError
+
+    def subscribe(self, room):
+        """Start receiving room's frames (this node has members in it)"""
+        raise NotImplementedError
+
+    def unsubscribe(self, room):
+        """Stop receiving room's frames (this node has no members left in it)"""
+        raise NotImplementedError
+
+    def publish_room(self, room, frame):
+        """Send an encoded client frame to room's members on every other node"""
+        raise NotImplementedError
+
+    def record(self, conversation, sender, body, timestamp):
+        """Add a delivered message to the shared history. Returns its id, the same on every node (0 if not kept)."""
+        raise NotImplementedError
+
+    def history(self, conversation, before_id, limit):
+        """(records, more) for one page of the shared history, like msglog.MessageLog.page()"""
+        raise NotImplementedError
+
+
+class BrokerBackend(ClusterBackend):
+    """Links a node to a BusBroker over a Unix socket or TCP.
+
+    A background thread reads from the broker and passes what it receives
+    to the server callbacks described in ClusterBackend.
+    """
+
+    def __init__(self, address, node_id, on_snapshot, on_claimed, on_presence,
+                 on_broadcast, on_direct, on_room, on_lost):
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.claims_lock = threading.Lock()  # Answering a claim and giving up on it exclude each other
+        self.claims = {}  # request id: [event, username, client, result]; client None once abandoned
+        self.requests = {}  # request id: [event, answer payload]
+        self.keeps_history = False  # Whether the broker keeps a message log, from its snapshot
+        self.on_snapshot = on_snapshot
+        self.on_claimed = on_claimed
+        self.on_presence = on_presence
+        self.on_broadcast = on_broadcast
+        self.on_direct = on_direct
+        self.on_room = on_room
+        self.on_lost = on_lost
+        self.send(BUS_HELLO, str(node_id))
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def send(self, frame_type, payload):
+        try:
+            with self.send_lock:
+                self.sock.sendall(encode_frame(frame_type, payload))
+        except OSError as e:
+            error("bus_error", error=f"could not reach the broker: {e}")
+
+    def claim(self, username, client):
+        """Reserve username on every node. Blocks for one round trip to the broker."""
+        request_id = next(self.request_ids)
+        claim = [threading.Event(), username, client, False]
+        self.claims[request_id] = claim
+        self.send(BUS_CLAIM, f"{request_id}\n{username}")
+        if not claim[0].wait(CLAIM_TIMEOUT):
+            with self.claims_lock:
+                if request_id in self.claims:
+                    # Leave the claim for the reader so a late "ok" gives the name back
+                    error("bus_error", username=username, error="no answer to claim")
+                    claim[2] = None
+                    return False
+            claim[0].wait()  # The answer came just now and is being applied
+        return claim[3]
+
+    def release(self, username):
+        self.send(BUS_RELEASE, username)
+
+    def publish(self, frame):
+        self.send(BUS_BROADCAST, frame)
+
+    def direct(self, target, frame):
+        self.send(BUS_DIRECT, target.encode('utf-8') + b"\n" + frame)
+
+    def subscribe(self, room):
+        self.send(BUS_SUBSCRIBE, room)
+
+    def unsubscribe(self, room):
+        self.send(BUS_UNSUBSCRIBE, room)
+
+    def publish_room(self, room, frame):
+        self.send(BUS_ROOM, room.encode('utf-8') + b"\n" + frame)
+
+    def request(self, frame_type, payload):
+        """Send a request to the broker and wait for its answer; None if it does not come in time"""
+        request_id = next(self.request_ids)
+        waiting = [threading.Event(), None]
+        self.requests[request_id] = waiting
+        self.send(frame_type, f"{request_id}\n".encode('utf-8') + payload)
+        if waiting[0].wait(REQUEST_TIMEOUT):
+            return waiting[1]
+        self.requests.pop(request_id, None)
+        error("bus_error", error="no answer to request", frame_type=frame_type)
+        return None
+
+    def record(self, conversation, sender, body, timestamp):
+        """Have the broker log a message. Blocks for one round trip to the broker."""
+        if not self.keeps_history:
+            return 0
+        answer = self.request(BUS_RECORD, f"{conversation}\n{sender}\n{timestamp!r}\n{body}".encode('utf-8'))
+        return 0 if answer is None else int(answer)
+
+    def history(self, conversation, before_id, limit):
+        """Fetch one page of history from the broker. Blocks for one round trip to the broker."""
+        if not self.keeps_history:
+            return [], False
+        answer = self.request(BUS_HISTORY, f"{before_id or ''}\n{limit}\n{conversation}".encode('utf-8'))
+        if answer is None:
+            return [], False
+        from msglog import decode_record
+        more, data = split_line(answer)
+        records, offset = [], 0
+        while offset < len(data):
+            record, offset = decode_record(data, offset)
+            records.append(record)
+        return records, more == "1"
+
+    def read_loop(self):
+        reader = FrameReader()
+        pending = deque()
+        try:
+            while True:
+                frame = recv_frame(self.sock, reader, pending)
+                if frame is None:
+                    break
+                self.handle_frame(*frame)
+        except (OSError, ProtocolError) as e:
+            error("bus_error", error=str(e))
+        error("bus_lost")
+        self.on_lost()
+
+    def handle_frame(self, frame_type, payload):
+        if frame_type == BUS_PRESENCE:
+            seq, change = split_line(payload)
+            change = change.decode('utf-8')
+            self.on_presence(int(seq), change[1:], change[0] == "+")
+        elif frame_type == BUS_BROADCAST:
+            self.on_broadcast(payload)
+        elif frame_type == BUS_DIRECT:
+            target, frame = split_line(payload)
+            self.on_direct(target, frame)
+        elif frame_type == BUS_ROOM:
+            room, frame = split_line(payload)
+            self.on_room(room, frame)
+        elif frame_type == BUS_CLAIMED:
+            request_id, ok = split_line(payload)
+            with self.claims_lock:
+                claim = self.claims.pop(int(request_id), None)
+            if claim is None:
+                return
+            event, username, client, _ = claim
+            if ok == b"1":
+                if client is None:
+                    self.release(username)  # Nobody is waiting for it any more
+                else:
+                    claim[3] = True
+                    self.on_claimed(username, client)
+            event.set()
+        elif frame_type in (BUS_RECORDED, BUS_PAGE):
+            request_id, answer = split_line(payload)
+            waiting = self.requests.pop(int(request_id), None)
+            if waiting is not None:
+                waiting[1] = answer
+                waiting[0].set()
+        elif frame_type == BUS_SNAPSHOT:
+            first, *usernames = payload.decode('utf-8').split("\n")
+            seq, _, keeps_history = first.partition(" ")
+            self.keeps_history = keeps_history == "1"
+            self.on_snapshot(int(seq), usernames)
+
+
+BACKENDS = {
+    "broker": BrokerBackend,
+}
+
+
+def run_broker(address, history_dir=None):
+    """Run a standalone broker for a multi-host cluster, keeping the message log in history_dir if given"""
+    family, bind_address = parse_address(address)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family != socket.AF_UNIX:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(bind_address)
+    listener.listen()
+    history = None
+    if history_dir is not None:
+        from msglog import MessageLog
+        history = MessageLog(history_dir)
+        info("history", directory=history_dir)
+    info("bus_listening", address=address)
+    BusBroker(listener, history).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster broker for MessagingApp server nodes")
+    parser.add_argument("--listen", default=f"0.0.0.0:{BROKER_PORT}",
+                        help="host:port (or a Unix socket path) to accept nodes on")
+    parser.add_argument("--history-dir", help="keep the message log of the whole cluster in this directory")
+    args = parser.parse_args()
+    try:
+        run_broker(args.listen, args.history_dir)
+    except KeyboardInterrupt:
+        pass
@@ -3,15 +3,89 @@
 # client.py
 import socket
 import threading
+from collections import deque
+
+from codec import (CHAT, INFO, JOIN, LEAVE, LIST_ROOMS, NOTICE, PRIVATE, ROOM, decode_message,
+                   dispatch, encode_message)
+from protocol import (FRAME_HELLO, FRAME_MESSAGE, FRAME_PING, FRAME_PONG, FRAME_PRESENCE, FRAME_ROOM,
+                      FRAME_USERS, FrameReader, decode_hello, decode_presence, decode_room, decode_users,
+                      recv_frame, send_encoded, send_frame)
 
 SERVER_IP = '127.0.0.1'  # Die is net sodat ek con toets ons moet n actuall ip dink ek kry
 PORT = 12345
+compress_threshold = None  # Messages at least this big are sent compressed, once the server agrees
+
+def print_chat(message):
+	print(f"[MESSAGE] {message.sender}: {message.body}")
+
+def print_private(message):
+	print(f"[PRIVATE] {message.sender} -> {message.target}: {message.body}")
+
+def print_room(message):
+	print(f"[{message.target}] {message.sender}: {message.body}")
+
+def print_notice(message):
+	print(f"[{message.target or 'NOTICE'}] *** {message.body} ***")
+
+def print_info(message):
+	print(f"[SERVER] {message.body}")
+
+MESSAGE_HANDLERS = {
+	CHAT: print_chat,
+	PRIVATE: print_private,
+	ROOM: print_room,
+	NOTICE: print_notice,
+	INFO: print_info,
+}
+
+def parse_input(text):
+	"""Turn a typed line into (kind, body, target), or None if it is not a valid command"""
+	if text.startswith("/"):
+		command, _, argument = text.partition(" ")
+		if command == "/join":
+			return JOIN, "", argument.strip()
+		if command == "/leave":
+			return LEAVE, "", argument.strip()
+		if command == "/rooms":
+			return LIST_ROOMS, "", ""
+		return None
+	if text.startswith("@") or text.startswith("#"):
+		target, sep, body = text[1:].partition(":")
+		if not sep:
+			return None
+		kind = PRIVATE if text[0] == "@" else ROOM
+		return kind, body.strip(), target.strip() if kind == PRIVATE else "#" + target.strip()
+	return CHAT, text, ""
 
 def receive_messages(sock):
+	global compress_threshold
+	reader = FrameReader()
+	pending = deque()
 	while True:
 		try:
-			msg = sock.recv(1024).decode('utf-8')
-			print(f"[MESSAGE] {msg}")
+			frame = recv_frame(sock, reader, pending)
+			if frame is None:
+				print("[DISCONNECTED] Server closed the connection.")
+				break
+			frame_type, payload = frame
+			if frame_type == FRAME_MESSAGE:
+				dispatch(MESSAGE_HANDLERS, decode_message(payload))
+			elif frame_type == FRAME_USERS:
+				seq, users = decode_users(payload)
+				print(f"[USERS] {', '.join(users)}")
+			elif frame_type == FRAME_PRESENCE:
+				seq, user, online = decode_presence(payload)
+				print(f"[USERS] {user} {'joined' if online else 'left'}")
+			elif frame_type == FRAME_HELLO:
+				codec, threshold = decode_hello(payload)
+				compress_threshold = threshold
+				if codec is not None:
+					print(f"[COMPRESSION] {codec} for messages of {threshold} bytes or more")
+			elif frame_type == FRAME_ROOM:
+				room, joined = decode_room(payload)
+				print(f"[ROOMS] {'Joined' if joined else 'Left'} {room}")
+			elif frame_type == FRAME_PING:
+				send_frame(sock, b"", FRAME_PONG)  # Still here
 		except:
 			print("[ERROR] Connection lost.")
 			break
@@ -20,13 +94,19 @@ def start_client():
 	client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 	client.connect((SERVER_IP, PORT))
 	print("[CONNECTED] You are now connected to the server.")
+	send_frame(client, "zlib", FRAME_HELLO)  # Ask for large messages to be compressed
 	
 	threading.Thread(target=receive_messages, args=(client,), daemon=True).start()
 	
+	send_frame(client, input("Username: "))
+	print("[HELP] @user: message, #room: message, /join #room, /leave #room, /rooms")
 	while True:
-		msg = input()
-		client.sendall(msg.encode('utf-8'))
+		parsed = parse_input(input())
+		if parsed is None:
+			print("[ERROR] Use @user: message, #room: message, /join #room, /leave #room or /rooms")
+			continue
+		kind, body, target = parsed
+		send_encoded(client, encode_message(kind, body, target=target), compress_threshold)
 		
 if __name__ == "__main__":
 	start_client()
-	
\ No newline at end of file
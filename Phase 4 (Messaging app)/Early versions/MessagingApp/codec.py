@@ -0,0 +1,117 @@
+import struct
+from collections import namedtuple
+
+from protocol import FRAME_HISTORY, FRAME_MESSAGE, ProtocolError, encode_frame
+
+# Chat traffic travels as typed messages inside FRAME_MESSAGE frames, so
+# neither side has to guess what a line of text is from how it starts.
+# A message is a fixed header followed by three UTF-8 strings:
+#   kind | message id | sequence | timestamp | sender length | target length | body length
+#   sender | target | body
+# The sequence is the server's number for a delivered message within its
+# conversation (0 for none), which a resuming client reports back (FRAME_RESUME).
+MESSAGE_HEADER = struct.Struct(">BQQdHHI")
+HISTORY_HEADER = struct.Struct(">?H")  # more, conversation length
+
+# Message kinds. Which fields are used depends on the kind and direction.
+# A client may number its CHAT, PRIVATE and ROOM messages in msg_id (0 for
+# none). The server then answers each with an ACK instead of echoing the
+# message back, and handles a resent id only once.
+CHAT = 1        # Group chat line: body (server adds sender, id and timestamp)
+PRIVATE = 2     # Private message to target; the sender gets a copy as confirmation
+ROOM = 3        # Message to the members of room target
+NOTICE = 4      # Server -> client: somebody joined or left; target is "" or a room
+INFO = 5        # Server -> one client: an answer or error meant only for it
+JOIN = 6        # Client -> server: join room target
+LEAVE = 7       # Client -> server: leave room target
+LIST_ROOMS = 8  # Client -> server: ask for the open rooms (answered with INFO)
+ACK = 9         # Server -> client: message msg_id was handled; body is "" or why it was refused
+
+KIND_NAMES = {CHAT: "chat", PRIVATE: "private", ROOM: "room", NOTICE: "notice", INFO: "info",
+              JOIN: "join", LEAVE: "leave", LIST_ROOMS: "list_rooms", ACK: "ack"}
+
+Message = namedtuple("Message", "kind msg_id timestamp sender target body seq", defaults=(0,))
+
+
+def pack_message(kind, body="", sender="", target="", msg_id=0, timestamp=0.0, seq=0):
+    """Encode one message without a frame header"""
+    if kind not in KIND_NAMES:
+        raise ValueError(f"Unknown message kind {kind}")
+    sender = sender.encode('utf-8')
+    target = target.encode('utf-8')
+    body = body.encode('utf-8')
+    return b"".join((MESSAGE_HEADER.pack(kind, msg_id, seq, timestamp, len(sender), len(target), len(body)),
+                     sender, target, body))
+
+
+def unpack_message(buffer, offset=0):
+    """Return (message, next offset) for the message starting at offset in bytes buffer"""
+    try:
+        kind, msg_id, seq, timestamp, sender_len, target_len, body_len = MESSAGE_HEADER.unpack_from(buffer, offset)
+    except struct.error:
+        raise ProtocolError("Truncated message header") from None
+    start = offset + MESSAGE_HEADER.size
+    target = start + sender_len
+    body = target + target_len
+    end = body + body_len
+    if end > len(buffer):
+        raise ProtocolError("Truncated message")
+    try:
+        return Message(kind, msg_id, timestamp, buffer[start:target].decode('utf-8'),
+                       buffer[target:body].decode('utf-8'), buffer[body:end].decode('utf-8'), seq), end
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f"Bad message text: {e}") from None
+
+
+def encode_message(kind, body="", sender="", target="", msg_id=0, timestamp=0.0, seq=0):
+    """Build a FRAME_MESSAGE"""
+    return encode_frame(FRAME_MESSAGE, pack_message(kind, body, sender, target, msg_id, timestamp, seq))
+
+
+def decode_message(payload):
+    """Return the Message in a FRAME_MESSAGE payload"""
+    payload = bytes(payload)
+    message, end = unpack_message(payload)
+    if end != len(payload):
+        raise ProtocolError("Trailing bytes after message")
+    return message
+
+
+def dispatch(handlers, message, *args):
+    """Call the handler registered for message.kind with (*args, message).
+
+    Returns False if the table has no handler for that kind.
+    """
+    handler = handlers.get(message.kind)
+    if handler is None:
+        return False
+    handler(*args, message)
+    return True
+
+
+def encode_history(conversation, messages, more):
+    """Build a FRAME_HISTORY page.
+
+    messages are Message tuples, oldest first; more says whether the
+    conversation has older messages.
+    """
+    conversation = conversation.encode('utf-8')
+    parts = [HISTORY_HEADER.pack(more, len(conversation)), conversation]
+    parts.extend(pack_message(m.kind, m.body, m.sender, m.target, m.msg_id, m.timestamp, m.seq) for m in messages)
+    return encode_frame(FRAME_HISTORY, b"".join(parts))
+
+
+def decode_history(payload):
+    """Return (conversation, messages, more) from a FRAME_HISTORY payload"""
+    payload = bytes(payload)
+    try:
+        more, conversation_len = HISTORY_HEADER.unpack_from(payload)
+    except struct.error:
+        raise ProtocolError("Truncated history page") from None
+    offset = HISTORY_HEADER.size + conversation_len
+    conversation = payload[HISTORY_HEADER.size:offset].decode('utf-8')
+    messages = []
+    while offset < len(payload):
+        message, offset = unpack_message(payload, offset)
+        messages.append(message)
+    return conversation, messages, more
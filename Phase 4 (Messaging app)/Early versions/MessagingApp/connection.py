@@ -0,0 +1,383 @@
+import socket
+import threading
+import time
+from collections import deque
+
+from jsonlog import warning
+from metrics import Counter, CounterFunction, Gauge
+from ratelimit import RateLimiter
+from protocol import (FRAME_HELLO, HEADER_SIZE, CompressionStats, compress_frame,
+                      compression_totals, encode_frame)
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = "drop_oldest"  # Throw away the oldest queued frame
+DISCONNECT = "disconnect"    # Kick the slow client off the server
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+MAX_BATCH = 512  # Frames per vectored write (kept below the usual IOV_MAX of 1024)
+
+# Defaults used for every new connection, see configure_outbound()
+queue_size = 1024  # Frames
+overflow_policy = DROP_OLDEST
+
+# Write coalescing, see configure_writes(). A writer that wakes up for a
+# frame waits up to flush_window seconds for more (or until flush_bytes are
+# queued) and sends them all in one write: fewer, fuller packets for a few
+# milliseconds of latency. 0 writes as soon as a frame is queued.
+flush_window = 0.0
+flush_bytes = 64 * 1024
+tcp_nodelay = True  # Disable Nagle's algorithm, we do our own batching
+
+# Compression offered to clients that ask for it in a FRAME_HELLO, see
+# configure_compression(). Payloads below the threshold are sent as they are.
+compression_threshold = 1024  # Bytes, None to never compress
+compression_level = 6
+
+# Inbound rate limits per connection, see configure_rate_limits(). A client
+# over its limit is not read from until it is back under it, so TCP flow
+# control holds it up instead of the server buffering or fanning out its
+# flood. None for no limit.
+rate_messages = 20.0            # Frames per second
+rate_message_burst = 50         # Frames
+rate_bytes = 256 * 1024         # Bytes per second
+rate_byte_burst = 1024 * 1024   # Bytes
+
+# The last frame compressed and its compressed form (None if it did not
+# shrink). A fan-out queues the same frame object for every client, so it
+# is compressed once rather than once per client.
+last_compressed = (None, None)
+
+
+def configure_outbound(size=None, policy=None):
+    """Change the outbound queue size and overflow policy for new connections"""
+    global queue_size, overflow_policy
+    if size is not None:
+        if size < 1:
+            raise ValueError("Outbound queue size must be at least 1")
+        queue_size = size
+    if policy is not None:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        overflow_policy = policy
+
+
+def configure_writes(window=None, max_bytes=None, nodelay=None):
+    """Change the coalescing window (seconds), its byte limit and TCP_NODELAY for new connections"""
+    global flush_window, flush_bytes, tcp_nodelay
+    if window is not None:
+        if window < 0:
+            raise ValueError("Flush window cannot be negative")
+        flush_window = window
+    if max_bytes is not None:
+        if max_bytes < 1:
+            raise ValueError("Flush size must be at least 1 byte")
+        flush_bytes = max_bytes
+    if nodelay is not None:
+        tcp_nodelay = nodelay
+
+
+def configure_compression(threshold=None, level=None, enabled=True):
+    """Change when and how hard frames are compressed for clients that negotiated it"""
+    global compression_threshold, compression_level
+    if not enabled:
+        compression_threshold = None
+    elif threshold is not None:
+        if threshold < 0:
+            raise ValueError("Compression threshold cannot be negative")
+        compression_threshold = threshold
+    if level is not None:
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9")
+        compression_level = level
+
+
+def configure_rate_limits(messages=None, message_burst=None, nbytes=None, byte_burst=None):
+    """Change the inbound limits for new connections; 0 turns a limit off"""
+    global rate_messages, rate_message_burst, rate_bytes, rate_byte_burst
+    for value in (messages, message_burst, nbytes, byte_burst):
+        if value is not None and value < 0:
+            raise ValueError("Rate limits cannot be negative")
+    if messages is not None:
+        rate_messages = messages or None
+    if message_burst is not None:
+        rate_message_burst = message_burst or None
+    if nbytes is not None:
+        rate_bytes = nbytes or None
+    if byte_burst is not None:
+        rate_byte_burst = byte_burst or None
+
+
+def apply_nodelay(sock):
+    """Set TCP_NODELAY on a client socket as configured"""
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(tcp_nodelay))
+
+
+class WriteStats:
+    """Totals over all connections of how well frames are being coalesced"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def record(self, frames, nbytes):
+        with self.lock:
+            self.writes += 1
+            self.frames += frames
+            self.bytes += nbytes
+
+    def snapshot(self):
+        """Dict of the totals and the average frames and bytes per write"""
+        with self.lock:
+            writes, frames, nbytes = self.writes, self.frames, self.bytes
+        return {
+            "writes": writes,
+            "frames": frames,
+            "bytes": nbytes,
+            "frames_per_write": frames / writes if writes else 0.0,
+            "bytes_per_write": nbytes / writes if writes else 0.0,
+        }
+
+
+write_stats = WriteStats()
+
+# Transport figures for the metrics endpoint. Reading write_stats only at
+# scrape time keeps the per-frame cost at the one lock take_batch() already takes.
+open_connections = Gauge("chat_open_connections", "Client sockets currently open, logged in or not")
+bytes_received = Counter("chat_received_bytes_total", "Bytes read from client sockets")
+frames_sent = CounterFunction("chat_sent_frames_total", "Frames written to client sockets",
+                              lambda: write_stats.snapshot()["frames"])
+bytes_sent = CounterFunction("chat_sent_bytes_total", "Bytes written to client sockets (after compression)",
+                             lambda: write_stats.snapshot()["bytes"])
+writes = CounterFunction("chat_writes_total", "Batched writes to client sockets; chat_sent_frames_total divided "
+                         "by this is frames per write", lambda: write_stats.snapshot()["writes"])
+# The coalescing settings in effect, to read the figures above against
+Gauge("chat_flush_window_seconds", "How long a writer waits to batch more frames into one write",
+      lambda: flush_window)
+Gauge("chat_flush_bytes", "Queued bytes that make a writer write straight away", lambda: flush_bytes)
+Gauge("chat_tcp_nodelay", "1 if TCP_NODELAY is set on client sockets, 0 if Nagle's algorithm is on",
+      lambda: int(tcp_nodelay))
+# Compression in both directions, over every connection (see protocol.CompressionStats)
+compressed_frames = CounterFunction("chat_compression_frames_total", "Frames compressed or inflated",
+                                    lambda: compression_totals.frames)
+compression_raw_bytes = CounterFunction("chat_compression_raw_bytes_total",
+                                        "Payload bytes of those frames before compression",
+                                        lambda: compression_totals.raw_bytes)
+compression_wire_bytes = CounterFunction("chat_compression_wire_bytes_total",
+                                         "Payload bytes of those frames as sent (raw / wire = compression ratio)",
+                                         lambda: compression_totals.wire_bytes)
+compression_cpu = CounterFunction("chat_compression_cpu_seconds_total", "Time spent compressing and inflating",
+                                  lambda: compression_totals.cpu_time)
+dropped_frames = Counter("chat_dropped_frames_total",
+                         "Frames thrown away because a client's outbound queue was full", ("policy",))
+
+
+def send_buffers(sock, buffers):
+    """Write several frames with as few system calls as possible.
+
+    Uses one vectored sendmsg() per batch where the platform has it and falls
+    back to a single joined sendall() elsewhere (Windows).
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b) for b in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_BATCH])
+        # Skip the buffers that went out completely, trim a partly sent one
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+class Connection:
+    """A client connection with its own bounded queue of outgoing frames.
+
+    send() never waits for the network: it only queues the frame and wakes
+    the connection's writer, so one slow client cannot hold up a broadcast.
+    The writer is only woken for the first frame in an empty queue or once
+    flush_bytes are waiting, so it can coalesce everything in between.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.username = None
+        self.session = None  # sessions.Session once logged in, if resuming is enabled
+        self.outbound = deque()
+        self.queued_bytes = 0
+        self.max_queue = queue_size
+        self.policy = overflow_policy
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        self.dropped_frames = 0
+        self.closing = False
+        self.last_seen = time.monotonic()  # When a frame last arrived, see heartbeat.py
+        self.limiter = RateLimiter(rate_messages, rate_message_burst, rate_bytes, rate_byte_burst)
+        self.lock = threading.Condition()
+        self.compress_threshold = None  # Set once the client negotiates compression
+        self.compression_stats = CompressionStats(compression_totals)
+
+    def send(self, data):
+        """Queue an already encoded frame for this client.
+
+        The same bytes object may be queued for many clients; it is never
+        modified here, but large frames are swapped for a compressed copy if
+        this client negotiated compression.
+        """
+        if self.compress_threshold is not None and len(data) - HEADER_SIZE >= self.compress_threshold:
+            data = self.compress(data)
+        with self.lock:
+            if self.closing:
+                return
+            if len(self.outbound) >= self.max_queue:
+                self.dropped_frames += 1
+                dropped_frames.inc(1, (self.policy,))
+                if self.policy == DISCONNECT:
+                    warning("slow_client", username=self.username, action="disconnecting",
+                            reason="outbound queue full")
+                    self.clear_outbound()
+                    self.closing = True
+                    self.abort()
+                    return
+                self.queued_bytes -= len(self.outbound.popleft())
+            self.outbound.append(data)
+            self.queued_bytes += len(data)
+            if len(self.outbound) == 1 or self.queued_bytes >= self.flush_bytes:
+                self.wake_writer()
+
+    def negotiate(self, offer):
+        """Answer a client's FRAME_HELLO, turning compression on if we both support zlib"""
+        codecs = offer.decode('utf-8').split(",")
+        if "zlib" in codecs and compression_threshold is not None:
+            self.compress_threshold = compression_threshold
+            self.send(encode_frame(FRAME_HELLO, f"zlib\n{compression_threshold}"))
+        else:
+            self.send(encode_frame(FRAME_HELLO, b""))
+
+    def compress(self, frame):
+        """Compressed copy of frame, or frame itself if it does not shrink"""
+        global last_compressed
+        source, compressed = last_compressed
+        cpu_time = 0.0
+        if source is not frame:
+            started = time.perf_counter()
+            compressed = compress_frame(frame, compression_level)
+            cpu_time = time.perf_counter() - started
+            last_compressed = (frame, compressed)
+        if compressed is None:
+            self.compression_stats.add(len(frame), len(frame), cpu_time)
+            return frame
+        self.compression_stats.add(len(frame), len(compressed), cpu_time)
+        return compressed
+
+    def charge(self, frame_size):
+        """Count a received frame against the rate limits; returns seconds to stop reading for"""
+        delay = self.limiter.charge(frame_size)
+        if delay:
+            # It is us not reading, so the heartbeat must not take the pause for silence
+            self.last_seen = time.monotonic() + delay
+        return delay
+
+    def queue_depth(self):
+        """Number of frames waiting to be written to this client"""
+        return len(self.outbound)
+
+    def take_batch(self):
+        """Remove up to MAX_BATCH frames from the queue for one write (lock held)"""
+        outbound = self.outbound
+        batch = [outbound.popleft() for _ in range(min(len(outbound), MAX_BATCH))]
+        nbytes = sum(map(len, batch))
+        self.queued_bytes -= nbytes
+        write_stats.record(len(batch), nbytes)
+        return batch
+
+    def clear_outbound(self):
+        """Throw away every queued frame (lock held)"""
+        self.outbound.clear()
+        self.queued_bytes = 0
+
+    def close(self):
+        """Stop accepting frames and close once the queue has been written"""
+        with self.lock:
+            self.closing = True
+            self.wake_writer()
+
+    def wake_writer(self):
+        raise NotImplementedError
+
+    def abort(self):
+        """Close straight away, dropping anything still queued"""
+        raise NotImplementedError
+
+
+class SocketConnection(Connection):
+    """A client connection served by a reader thread and a writer thread"""
+
+    def __init__(self, sock, addr):
+        super().__init__(addr)
+        self.sock = sock
+        self.detached = False  # Handed to another process: write out the queue but leave the socket open
+        apply_nodelay(sock)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def wake_writer(self):
+        self.lock.notify()
+
+    def write_loop(self):
+        while True:
+            with self.lock:
+                while not self.outbound and not self.closing:
+                    self.lock.wait()
+                if not self.outbound:
+                    break  # Closing and everything has been written
+                if self.flush_window:
+                    # Give other frames the window to join this write
+                    deadline = time.monotonic() + self.flush_window
+                    while not self.closing and self.queued_bytes < self.flush_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.lock.wait(remaining)
+                # Take everything that piled up so it goes out in one write
+                batch = self.take_batch()
+            try:
+                send_buffers(self.sock, batch)
+            except OSError:
+                with self.lock:
+                    self.clear_outbound()
+                    self.closing = True
+                break
+        if not self.detached:
+            self.abort()
+
+    def detach(self, timeout=None):
+        """Write out the queue and stop the writer, then return the socket without closing it.
+
+        Returns None if the queue could not be written within timeout seconds
+        or the socket has already failed.
+        """
+        with self.lock:
+            self.detached = True
+            self.closing = True
+            self.wake_writer()
+        self.writer.join(timeout)
+        if self.writer.is_alive() or self.sock.fileno() < 0:
+            return None
+        return self.sock
+
+    def abort(self):
+        # shutdown() also wakes the reader thread blocked in recv()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
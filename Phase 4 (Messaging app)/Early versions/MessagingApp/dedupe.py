@@ -0,0 +1,41 @@
+import threading
+from collections import OrderedDict
+
+MAX_IDS_PER_USER = 1024  # Well above any client's resend window
+MAX_USERS = 10000        # Users whose ids are remembered, most recently active first
+
+
+class SeenMessages:
+    """The answer the server gave to each client message id it handled recently.
+
+    A client resends a message until it is acknowledged, so the same id can
+    arrive again, on the same connection or after a reconnect. Looking it up
+    here lets the server answer the resend without delivering it twice.
+    Ids are kept per username, oldest dropped first, and the users that
+    have been quiet longest are forgotten first.
+    """
+
+    def __init__(self, per_user=MAX_IDS_PER_USER, users=MAX_USERS):
+        self.per_user = per_user
+        self.users = users
+        self.lock = threading.Lock()
+        self.by_user = OrderedDict()  # username: OrderedDict(msg_id: (answer, seq))
+
+    def answer(self, username, msg_id):
+        """(answer, seq) msg_id from username got ("" and its sequence number if delivered), or None if it is new"""
+        with self.lock:
+            seen = self.by_user.get(username)
+            return None if seen is None else seen.get(msg_id)
+
+    def record(self, username, msg_id, answer, seq=0):
+        with self.lock:
+            seen = self.by_user.get(username)
+            if seen is None:
+                seen = self.by_user[username] = OrderedDict()
+                if len(self.by_user) > self.users:
+                    self.by_user.popitem(last=False)
+            else:
+                self.by_user.move_to_end(username)
+            seen[msg_id] = (answer, seq)
+            if len(seen) > self.per_user:
+                seen.popitem(last=False)
@@ -0,0 +1,177 @@
+import os
+import socket
+import time
+from collections import namedtuple
+
+from jsonlog import error, info
+
+# LAN discovery, UDP datagrams on DISCOVERY_PORT:
+#   client -> broadcast: "CHAT_PROBE:nonce"
+#   server -> client:    "CHAT_SERVER:ip:port:nonce:connections:load", the answer to one probe
+#   server -> broadcast: "CHAT_SERVER:ip:port", an optional low-rate announcement
+# Clients time each answer against the probe with the same nonce and rank
+# the servers by round-trip time and load. Announcements are only for
+# clients that do not probe, or servers whose answers do not get through.
+DISCOVERY_PORT = 12346
+PROBE_PREFIX = "CHAT_PROBE:"
+SERVER_PREFIX = "CHAT_SERVER:"
+PROBE_TIMEOUT = 1.0  # Seconds a client collects answers for
+PROBES = 3           # Probes sent in that time, in case some are lost
+
+# What a server's load is worth in round-trip milliseconds when ranking
+LOAD_COST_MS = 50.0        # Per unit of load average per CPU
+CONNECTION_COST_MS = 0.05  # Per open connection
+
+DiscoveredServer = namedtuple("DiscoveredServer", "ip port connections load rtt")  # rtt None if only announced
+
+
+def host_load():
+    """One-minute load average per CPU, 0.0 where the OS does not report one"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):  # Windows has no load average
+        return 0.0
+
+
+def encode_answer(ip, port, nonce, connections, load):
+    return f"{SERVER_PREFIX}{ip}:{port}:{nonce}:{connections}:{load:.2f}".encode('utf-8')
+
+
+def decode_server(data):
+    """Return (ip, port, nonce, connections, load) from a CHAT_SERVER datagram, or None if it is not one.
+
+    An announcement has no nonce, connections or load; those are None.
+    """
+    message = data.decode('utf-8', 'replace')
+    if not message.startswith(SERVER_PREFIX):
+        return None
+    parts = message[len(SERVER_PREFIX):].split(":")
+    try:
+        if len(parts) == 2:
+            return parts[0], int(parts[1]), None, None, None
+        if len(parts) == 5:
+            return parts[0], int(parts[1]), parts[2], int(parts[3]), float(parts[4])
+    except ValueError:
+        pass
+    return None
+
+
+def answer_probes(ip, port, connections, announce_interval=None, discovery_port=DISCOVERY_PORT):
+    """Answer discovery probes with this server's address and load until the process stops.
+
+    connections() returns the current number of open connections. With
+    announce_interval the server is also announced that often (seconds).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Several servers on one host all hear probes
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    announcement = f"{SERVER_PREFIX}{ip}:{port}".encode('utf-8')
+    try:
+        sock.bind(('', discovery_port))
+        info("discovery", ip=ip, port=port, discovery_port=discovery_port, announce_interval=announce_interval)
+        next_announcement = time.monotonic()
+        while True:
+            if announce_interval:
+                now = time.monotonic()
+                if now >= next_announcement:
+                    sock.sendto(announcement, ('<broadcast>', discovery_port))
+                    next_announcement = now + announce_interval
+                sock.settimeout(next_announcement - now)
+            try:
+                data, addr = sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            message = data.decode('utf-8', 'replace')
+            if message.startswith(PROBE_PREFIX):
+                nonce = message[len(PROBE_PREFIX):]
+                try:
+                    sock.sendto(encode_answer(ip, port, nonce, connections(), host_load()), addr)
+                except OSError as e:
+                    error("discovery_answer_error", addr=addr, error=str(e))
+    except Exception as e:
+        error("discovery_stopped", error=str(e))
+    finally:
+        sock.close()
+
+
+def server_cost(server):
+    """Round-trip milliseconds, plus what the server's load is worth; announced-only servers come last"""
+    if server.rtt is None:
+        return float("inf")
+    return server.rtt * 1000 + LOAD_COST_MS * server.load + CONNECTION_COST_MS * server.connections
+
+
+def rank_servers(servers):
+    """List of servers, best first"""
+    return sorted(servers, key=server_cost)
+
+
+def probe_servers(timeout=PROBE_TIMEOUT, probes=PROBES, discovery_port=DISCOVERY_PORT):
+    """Broadcast probes for timeout seconds and return the servers that answered, best first.
+
+    A server's address is taken from where its answer came from, which is
+    the address the round trip was measured to, and its fastest answer counts.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sent = {}   # nonce: when that probe was sent
+    found = {}  # (ip, port): DiscoveredServer
+    try:
+        sock.bind(('', 0))
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            next_probe = started + len(sent) * timeout / probes
+            if len(sent) < probes and now >= next_probe:
+                nonce = os.urandom(4).hex()
+                sent[nonce] = now
+                sock.sendto(f"{PROBE_PREFIX}{nonce}".encode('utf-8'), ('<broadcast>', discovery_port))
+                continue
+            sock.settimeout((next_probe if len(sent) < probes else deadline) - now)
+            try:
+                data, addr = sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            received = time.monotonic()
+            answer = decode_server(data)
+            if answer is None or answer[2] not in sent:
+                continue
+            _, port, nonce, connections, load = answer
+            server = DiscoveredServer(addr[0], port, connections, load, received - sent[nonce])
+            best = found.get((server.ip, port))
+            if best is None or server.rtt < best.rtt:
+                found[(server.ip, port)] = server
+    finally:
+        sock.close()
+    return rank_servers(found.values())
+
+
+def open_announcement_socket(discovery_port=DISCOVERY_PORT):
+    """UDP socket that hears the servers' periodic announcements"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Shared with a server on this host
+    sock.bind(('', discovery_port))
+    return sock
+
+
+def receive_announcements(sock, duration):
+    """Collect the servers announced on sock in the next duration seconds"""
+    found = {}
+    deadline = time.monotonic() + duration
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        sock.settimeout(remaining)
+        try:
+            data, _ = sock.recvfrom(512)
+        except socket.timeout:
+            break
+        announcement = decode_server(data)
+        if announcement is not None and announcement[2] is None:
+            ip, port = announcement[:2]
+            found[(ip, port)] = DiscoveredServer(ip, port, None, None, None)
+    return list(found.values())
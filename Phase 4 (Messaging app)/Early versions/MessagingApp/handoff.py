@@ -0,0 +1,205 @@
+import os
+import select
+import socket
+import threading
+import time
+
+from connection import open_connections
+from jsonlog import error, info, warning
+from protocol import HEADER, HEADER_SIZE, encode_frame
+
+# Frames the running server sends to the process replacing it, over a Unix
+# socket. A frame that carries a socket has its descriptor attached to the
+# header bytes (SCM_RIGHTS).
+HANDOFF_LISTENER = 0x01  # The listening socket; payload: presence sequence number
+HANDOFF_CLIENT = 0x02    # One client socket; payload: see encode_client_state()
+HANDOFF_DONE = 0x03      # Everything has been sent
+
+DRAIN_TIMEOUT = 10  # Seconds to wait for readers to stop and outbound queues to be written
+
+
+def encode_client_state(username, compress_threshold, rooms, unread):
+    """Payload of a HANDOFF_CLIENT: "username", "threshold" and "room room" lines, then the unread bytes"""
+    threshold = "" if compress_threshold is None else str(compress_threshold)
+    return f"{username or ''}\n{threshold}\n{' '.join(rooms)}\n".encode('utf-8') + unread
+
+
+def decode_client_state(payload):
+    """Return (username or None, compress_threshold or None, rooms, unread bytes) from a HANDOFF_CLIENT"""
+    username, threshold, rooms, unread = payload.split(b"\n", 3)
+    return (username.decode('utf-8') or None, int(threshold) if threshold else None,
+            rooms.decode('utf-8').split(), unread)
+
+
+def send_with_socket(sock, frame_type, payload, fd=None):
+    """Send one handoff frame, with fd attached to its header if given"""
+    frame = encode_frame(frame_type, payload)
+    if fd is None:
+        sock.sendall(frame)
+        return
+    socket.send_fds(sock, [frame[:HEADER_SIZE]], [fd])
+    sock.sendall(memoryview(frame)[HEADER_SIZE:])
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Previous server closed the handoff early")
+        data += chunk
+    return bytes(data)
+
+
+def recv_with_socket(sock):
+    """Return (frame_type, payload, fd or None) for the next handoff frame.
+
+    The header is read on its own, and the payload with reads of exactly
+    its length, so no read runs on into the next frame's descriptor.
+    """
+    header, fds, _, _ = socket.recv_fds(sock, HEADER_SIZE, 1)
+    if not header:
+        raise ConnectionError("Previous server closed the handoff early")
+    header += recv_exactly(sock, HEADER_SIZE - len(header))
+    length, frame_type = HEADER.unpack(header)
+    return frame_type, recv_exactly(sock, length), fds[0] if fds else None
+
+
+def take_over(path):
+    """Receive the sockets of the server handing over on path.
+
+    Returns (listening socket, presence sequence number, [(client socket,
+    state payload)]), or None if no server is waiting there.
+    """
+    if not hasattr(socket, "send_fds"):
+        raise SystemExit("[ERROR] --handoff needs Unix sockets with SCM_RIGHTS (Linux, macOS or BSD)")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a server that did not exit cleanly
+        return None
+
+    listener, presence_seq, taken = None, 0, []
+    with sock:
+        while True:
+            frame_type, payload, fd = recv_with_socket(sock)
+            if frame_type == HANDOFF_LISTENER:
+                listener, presence_seq = socket.socket(fileno=fd), int(payload)
+            elif frame_type == HANDOFF_CLIENT:
+                taken.append((socket.socket(fileno=fd), payload))
+            elif frame_type == HANDOFF_DONE:
+                break
+            elif fd is not None:
+                os.close(fd)
+    if listener is None:
+        raise ConnectionError("Previous server did not hand over its listening socket")
+    info("taken_over", path=path, clients=len(taken))
+    return listener, presence_seq, taken
+
+
+class Handoff:
+    """Waits on a Unix socket for the server process that will replace this one.
+
+    The accept loop and every reader call ready(sock) before blocking in
+    accept() or recv(). Once a successor connects it returns False: a pipe
+    that all of them poll is made readable and never emptied, so one write
+    stops every thread. Readers then park(); hand_over() writes out their
+    outbound queues, sends the listening socket and each client socket with
+    its state, and lets the parked readers return without closing anything.
+    server_state() and client_state(client, unread) build the payloads;
+    on_drained() runs before the successor is told everything has been sent.
+    """
+
+    def __init__(self, path, server_state, client_state, on_drained=None):
+        self.path = path
+        self.server_state = server_state
+        self.client_state = client_state
+        self.on_drained = on_drained
+        self.wake_read, self.wake_write = os.pipe()
+        self.started = threading.Event()
+        self.finished = False
+        self.successor = None
+        self.lock = threading.Condition()
+        self.parked = {}  # connection: bytes received but not yet handled
+        self.handed_over = set()
+
+    def start(self):
+        """Listen on path for the next server process"""
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Whoever connects gets every client's socket: create it owner-only
+        # rather than chmod it afterwards, which leaves a window to connect in
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(1)
+        threading.Thread(target=self.wait_for_successor, args=(listener,), daemon=True).start()
+        info("handoff", path=self.path)
+
+    def wait_for_successor(self, listener):
+        with listener:
+            self.successor, _ = listener.accept()
+            os.unlink(self.path)  # Free the path for the successor's own handoff socket
+        info("handoff_started", clients=open_connections.get())
+        self.started.set()
+        os.write(self.wake_write, b"x")
+
+    def ready(self, sock):
+        """Wait until sock can be read from; returns False once the server is being handed over"""
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self.wake_read, select.POLLIN)
+        return all(fd != self.wake_read for fd, _ in poller.poll())
+
+    def park(self, client, unread):
+        """Called by a reader that stopped for the handoff; waits until it is over.
+
+        Returns True if the successor has the client now, in which case the
+        reader must leave it alone. Returns False straight away if no
+        handoff is under way.
+        """
+        if not self.started.is_set():
+            return False
+        with self.lock:
+            self.parked[client] = bytes(unread)
+            self.lock.notify_all()
+            while not self.finished:
+                self.lock.wait()
+            return client in self.handed_over
+
+    def hand_over(self, listener):
+        """Send the listening socket and every parked client to the successor (accept loop stopped)"""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        with self.lock:
+            # Connections still being set up or torn down are counted too, give them a moment
+            while len(self.parked) < open_connections.get() and time.monotonic() < deadline:
+                self.lock.wait(0.05)
+            parked = dict(self.parked)
+
+        handed_over = set()
+        try:
+            send_with_socket(self.successor, HANDOFF_LISTENER, self.server_state(), listener.fileno())
+            for client, unread in parked.items():
+                sock = client.detach(max(0.0, deadline - time.monotonic()))
+                if sock is None:
+                    warning("handoff_skipped", username=client.username, reason="outbound queue not written")
+                    continue
+                send_with_socket(self.successor, HANDOFF_CLIENT, self.client_state(client, unread), sock.fileno())
+                handed_over.add(client)
+                sock.close()  # Only our descriptor, the successor has its own
+            if self.on_drained is not None:
+                self.on_drained()
+            send_with_socket(self.successor, HANDOFF_DONE, b"")
+        except OSError as e:
+            error("handoff_failed", error=str(e), handed_over=len(handed_over), clients=len(parked))
+        finally:
+            self.successor.close()
+            with self.lock:
+                self.handed_over = handed_over
+                self.finished = True
+                self.lock.notify_all()
+        info("handed_over", clients=len(handed_over), not_handed_over=open_connections.get() - len(handed_over))
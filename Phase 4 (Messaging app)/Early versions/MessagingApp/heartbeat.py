@@ -0,0 +1,119 @@
+import threading
+import time
+from math import ceil
+
+from jsonlog import warning
+from metrics import Counter
+
+reaped_connections = Counter("chat_reaped_connections_total", "Connections closed for not answering heartbeats")
+
+
+class TimerWheel:
+    """Hashed timer wheel: one slot per tick, items due in a tick share its slot.
+
+    schedule(), cancel() and firing a timer are O(1) whatever the number of
+    items, so every connection can have a timer without a heap or a thread
+    each. Delays longer than the wheel wait in their slot for more turns.
+    """
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.slots = [{} for _ in range(slots)]  # item: tick it is due in
+        self.where = {}  # item: slot index
+        self.current = int(time.monotonic() / tick)  # Last tick processed
+
+    def schedule(self, item, delay):
+        """Fire item after delay seconds, replacing any timer it already has"""
+        due = max(self.current + 1, ceil((time.monotonic() + delay) / self.tick))
+        slot = due % len(self.slots)
+        with self.lock:
+            self.cancel_locked(item)
+            self.slots[slot][item] = due
+            self.where[item] = slot
+
+    def cancel(self, item):
+        with self.lock:
+            self.cancel_locked(item)
+
+    def cancel_locked(self, item):
+        slot = self.where.pop(item, None)
+        if slot is not None:
+            del self.slots[slot][item]
+
+    def advance(self, now=None):
+        """Move the wheel on to now and return the items that are due"""
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        expired = []
+        with self.lock:
+            if target - self.current >= len(self.slots):
+                # Fell a whole turn behind: every slot is due, look at them all once
+                slots = self.slots
+                self.current = target
+            else:
+                slots = []
+                while self.current < target:
+                    self.current += 1
+                    slots.append(self.slots[self.current % len(self.slots)])
+            for slot in slots:
+                due = [item for item, tick in slot.items() if tick <= target]
+                for item in due:
+                    del slot[item]
+                    del self.where[item]
+                expired.extend(due)
+        return expired
+
+    def __len__(self):
+        return len(self.where)
+
+
+class Heartbeats:
+    """Pings idle connections and closes the ones that stopped answering.
+
+    Every received frame sets a connection's last_seen, which costs nothing
+    on the read path; a connection's one timer only looks at it when it
+    fires. A connection quiet for interval seconds gets ping(connection);
+    if it is still quiet timeout seconds later it is aborted, and its
+    reader then unregisters it the usual way (leave announcement included).
+    """
+
+    def __init__(self, interval, timeout, ping, tick=1.0):
+        self.interval = interval
+        self.timeout = timeout
+        self.ping = ping
+        self.wheel = TimerWheel(tick, slots=max(8, ceil((interval + timeout) / tick) + 1))
+        self.thread = None
+
+    def add(self, client):
+        self.wheel.schedule(client, self.interval)
+
+    def remove(self, client):
+        self.wheel.cancel(client)
+
+    def check(self, client):
+        if client.closing:
+            return  # Closed since its timer was set; let the timer go
+        idle = time.monotonic() - client.last_seen
+        if idle < self.interval:
+            self.wheel.schedule(client, self.interval - idle)  # Heard from it since the timer was set
+        elif idle < self.interval + self.timeout:
+            self.ping(client)
+            self.wheel.schedule(client, self.interval + self.timeout - idle)
+        else:
+            warning("reaped", username=client.username, addr=client.addr, idle_s=round(idle, 1))
+            reaped_connections.inc()
+            client.abort()
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            for client in self.wheel.advance():
+                try:
+                    self.check(client)
+                except Exception as e:
+                    warning("heartbeat_error", username=client.username, error=str(e))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
@@ -0,0 +1,159 @@
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from metrics import Counter
+
+# Structured server logging. log() only puts a record on a bounded queue; a
+# background thread formats the records and writes them out, so a slow
+# stdout (a pipe, a container log driver) never holds up a client's thread.
+# When the queue is full records are dropped and counted, not waited for.
+#
+# Every record is one JSON object per line:
+#   {"ts": 1715420000.123, "level": "info", "event": "registered", "username": "alice", ...}
+# or, with the "text" format, "[REGISTERED] username=alice ..." for reading in a terminal.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+FORMATS = ("json", "text")
+MAX_BATCH = 256  # Records formatted and written together
+
+# Defaults, see configure_logging()
+level = INFO
+sample_rate = 1.0  # Share of per-message records (sampled()) that are kept
+log_format = "json"
+stream = sys.stdout
+queue_size = 10000
+
+records = queue.Queue(queue_size)
+writer = None
+writer_lock = threading.Lock()
+dropped_records = Counter("chat_log_dropped_records_total", "Log records dropped because the log queue was full")
+
+
+def configure_logging(min_level=None, rate=None, fmt=None, size=None, output=None):
+    """Change the level, per-message sample rate, format, queue size or output stream.
+
+    Call before the first record is logged if the queue size changes.
+    """
+    global level, sample_rate, log_format, queue_size, records, stream
+    if min_level is not None:
+        level = LEVELS[min_level] if isinstance(min_level, str) else min_level
+    if rate is not None:
+        if not 0 <= rate <= 1:
+            raise ValueError("Sample rate must be between 0 and 1")
+        sample_rate = rate
+    if fmt is not None:
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown log format: {fmt}")
+        log_format = fmt
+    if size is not None:
+        if size < 1:
+            raise ValueError("Log queue size must be at least 1")
+        queue_size = size
+        records = queue.Queue(size)
+    if output is not None:
+        stream = output
+
+
+def log(record_level, event, **fields):
+    """Queue one record if record_level passes the filter. Never blocks."""
+    if record_level < level:
+        return
+    if writer is None:
+        start_writer()
+    try:
+        records.put_nowait((time.time(), record_level, event, fields))
+    except queue.Full:
+        dropped_records.inc()
+
+
+def sampled(record_level, event, **fields):
+    """Like log(), but only keeps sample_rate of the records (for per-message logs)"""
+    if record_level >= level and (sample_rate >= 1 or random.random() < sample_rate):
+        log(record_level, event, **fields)
+
+
+def debug(event, **fields):
+    log(DEBUG, event, **fields)
+
+
+def info(event, **fields):
+    log(INFO, event, **fields)
+
+
+def warning(event, **fields):
+    log(WARNING, event, **fields)
+
+
+def error(event, **fields):
+    log(ERROR, event, **fields)
+
+
+def format_record(timestamp, record_level, event, fields):
+    if log_format == "text":
+        details = " ".join(f"{key}={value}" for key, value in fields.items())
+        return f"[{event.upper()}] {details}" if details else f"[{event.upper()}]"
+    record = {"ts": round(timestamp, 6), "level": LEVEL_NAMES.get(record_level, record_level), "event": event}
+    record.update(fields)
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def write_loop():
+    reported = 0
+    while True:
+        batch = [records.get()]
+        try:
+            while len(batch) < MAX_BATCH:
+                batch.append(records.get_nowait())
+        except queue.Empty:
+            pass
+        lines = [format_record(*record) for record in batch]
+        dropped = dropped_records.total()
+        if dropped > reported:
+            lines.append(format_record(time.time(), WARNING, "log_dropped", {"records": dropped - reported}))
+            reported = dropped
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            pass  # Nowhere left to log to
+        for _ in batch:
+            records.task_done()
+
+
+def start_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = threading.Thread(target=write_loop, daemon=True)
+            writer.start()
+
+
+def flush(timeout=1.0):
+    """Wait up to timeout seconds for the queued records to be written"""
+    deadline = time.monotonic() + timeout
+    while writer is not None and records.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def reset_after_fork():
+    """A forked child has no writer thread; start over with a fresh queue"""
+    global records, writer, writer_lock
+    records = queue.Queue(queue_size)
+    writer = None
+    writer_lock = threading.Lock()
+
+
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+    # Let the writer finish first so it cannot be holding the stream's lock when the child is forked
+    os.register_at_fork(before=flush, after_in_child=reset_after_fork)
@@ -0,0 +1,139 @@
+import os
+import struct
+import threading
+import time
+
+from jsonlog import info
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of this process share the mailboxes
+    fcntl = None
+
+# Private messages for users who are offline wait in one file per recipient,
+# named after the hex of the username. Each message is:
+#   header: timestamp, sender length, body length
+#   sender, body (UTF-8)
+# Nothing is kept in memory, so queued messages cost disk space only.
+MAIL_HEADER = struct.Struct(">dHI")
+MAILBOX_SUFFIX = ".box"
+
+MAX_MAILBOX_BYTES = 1024 * 1024  # Refuse new messages once a mailbox is this big
+MAILBOX_TTL = 7 * 24 * 3600      # Seconds a message waits before it is thrown away
+SWEEP_INTERVAL = 600             # Seconds between removals of expired mailboxes
+
+
+class Mailboxes:
+    """Store-and-forward queues of private messages, one file per offline user.
+
+    deposit() appends to the recipient's file and drain() takes the whole
+    file in one go when the user comes back. Each file is locked while it
+    is used, so worker processes may share the directory. A background
+    thread deletes mailboxes nobody has written to for longer than ttl.
+    """
+
+    def __init__(self, directory, max_bytes=MAX_MAILBOX_BYTES, ttl=MAILBOX_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.sweep_loop, daemon=True).start()
+
+    def path(self, username):
+        return os.path.join(self.directory, username.encode('utf-8').hex() + MAILBOX_SUFFIX)
+
+    def deposit(self, username, sender, body, timestamp=None):
+        """Queue a message for username. Returns False if the mailbox is full."""
+        sender = sender.encode('utf-8')
+        body = body.encode('utf-8')
+        record = MAIL_HEADER.pack(timestamp or time.time(), len(sender), len(body)) + sender + body
+        path = self.path(username)
+        with self.lock:
+            while True:
+                with open(path, "ab") as f:
+                    lock_file(f)
+                    if os.fstat(f.fileno()).st_nlink == 0:
+                        continue  # Drained while we waited for the lock, start a new file
+                    if f.tell() + len(record) > self.max_bytes:
+                        return False
+                    f.write(record)
+                    return True
+
+    def drain(self, username):
+        """Remove and return username's messages as (timestamp, sender, body), oldest first.
+
+        Messages older than ttl are skipped.
+        """
+        path = self.path(username)
+        with self.lock:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                return []
+            with f:
+                lock_file(f)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    return []  # Another process drained it first
+                data = f.read()
+                remove_locked(path)
+            if fcntl is None:
+                os.remove(path)  # Windows cannot delete an open file
+
+        messages = []
+        oldest = time.time() - self.ttl
+        offset = 0
+        while offset + MAIL_HEADER.size <= len(data):
+            timestamp, sender_len, body_len = MAIL_HEADER.unpack_from(data, offset)
+            offset += MAIL_HEADER.size
+            sender = data[offset:offset + sender_len].decode('utf-8')
+            offset += sender_len
+            body = data[offset:offset + body_len].decode('utf-8')
+            offset += body_len
+            if timestamp >= oldest:
+                messages.append((timestamp, sender, body))
+        return messages
+
+    def has_mail(self, username):
+        return os.path.exists(self.path(username))
+
+    def sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def sweep(self):
+        """Delete mailboxes whose newest message has expired"""
+        oldest = time.time() - self.ttl
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(MAILBOX_SUFFIX) or entry.stat().st_mtime >= oldest:
+                continue
+            with self.lock:
+                try:
+                    with open(entry.path, "rb") as f:
+                        lock_file(f)
+                        # Check again under the lock: a message may just have arrived
+                        stat = os.fstat(f.fileno())
+                        expired = stat.st_nlink > 0 and stat.st_mtime < oldest
+                        if expired:
+                            remove_locked(entry.path)
+                    if expired and fcntl is None:
+                        os.remove(entry.path)
+                    removed += expired
+                except OSError:
+                    pass
+        if removed:
+            info("mailbox_sweep", removed_mailboxes=removed)
+
+
+def lock_file(f):
+    """Hold an exclusive lock on an open file until it is closed"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def remove_locked(path):
+    """Delete a mailbox while its lock is held (not on Windows, see callers)"""
+    if fcntl is not None:
+        os.remove(path)
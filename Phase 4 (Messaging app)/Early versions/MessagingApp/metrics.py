@@ -0,0 +1,229 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Server metrics in the Prometheus text format, served over HTTP by
+# start_metrics_server(). Everything registers itself in REGISTRY when it
+# is created, so a module only has to create its metrics at import time.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)  # Seconds
+RATE_WINDOW = 10  # Seconds a per-second rate is averaged over
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Every metric of this process, rendered together for one scrape"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.rates = []
+        self.sampler = None
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+            if isinstance(metric, Rate):
+                self.rates.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    def sample_loop(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                rates = list(self.rates)
+            for rate in rates:
+                rate.sample()
+
+    def start_sampling(self):
+        """Start the thread that keeps the per-second rates up to date.
+
+        Not done on import: a pre-forking server must not start threads
+        before it forks.
+        """
+        with self.lock:
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+                self.sampler.start()
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """A total that only goes up, optionally split by label values"""
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {} if labelnames else {(): 0}
+        registry.add(self)
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def lines(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+                for labels, value in values]
+
+
+class Gauge:
+    """A value that goes up and down, or is read from function() at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name, help, function=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.lock = threading.Lock()
+        self.value = 0
+        registry.add(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+            return self.value
+
+    def dec(self, amount=1):
+        return self.inc(-amount)
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def lines(self):
+        return [f"{self.name} {format_value(self.get())}"]
+
+
+class CounterFunction(Gauge):
+    """A counter kept elsewhere (like connection.write_stats) and read at scrape time"""
+    type = "counter"
+
+
+class Rate(Gauge):
+    """Per-second rate of a growing total, averaged over the last RATE_WINDOW seconds.
+
+    Prometheus can work rates out from the counters itself; this is for
+    reading the endpoint directly. source() returns the current total; it
+    is sampled once a second once the registry is being served.
+    """
+
+    def __init__(self, name, help, source, registry=REGISTRY):
+        super().__init__(name, help, registry=registry)
+        self.source = source
+        self.samples = deque(maxlen=RATE_WINDOW + 1)
+
+    def sample(self):
+        self.samples.append((time.monotonic(), self.source()))
+
+    def get(self):
+        samples = list(self.samples)
+        if len(samples) < 2:
+            return 0.0
+        (start, first), (end, last) = samples[0], samples[-1]
+        return (last - first) / (end - start)
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, optionally split by labels"""
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}  # labels: [bucket counts..., +Inf count, sum]
+        registry.add(self)
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def lines(self):
+        with self.lock:
+            series = sorted((labels, list(values)) for labels, values in self.series.items())
+        lines = []
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = format_labels(self.labelnames, labels, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            plain = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain} {format_value(values[-1])}")
+            lines.append(f"{self.name}_count{plain} {cumulative}")
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per scrape would drown the chat log
+
+
+def start_metrics_server(host, port, registry=REGISTRY):
+    """Serve registry at http://host:port/metrics from a background thread"""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    registry.start_sampling()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,327 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from jsonlog import error, info, warning
+
+# A log is a directory of segment files named after the id of their first
+# record. Each record is:
+#   header: payload length, crc32, message id, timestamp
+#   payload: conversation length, sender length, conversation, sender, body
+# Records are only ever appended; old segments are deleted as a whole.
+RECORD_HEADER = struct.Struct(">IIQd")
+PAYLOAD_HEADER = struct.Struct(">HH")
+SEGMENT_SUFFIX = ".log"
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # Start a new segment after this many bytes
+FSYNC_INTERVAL = 0.05             # Seconds between group commits
+RETENTION_INTERVAL = 60           # Seconds between retention checks
+MAX_PAGE = 200                    # Most messages returned by one page()
+
+LogRecord = namedtuple("LogRecord", "msg_id timestamp conversation sender body")
+
+
+class LogCorruption(Exception):
+    """A record failed its checksum or runs past the end of its segment"""
+
+
+def encode_record(msg_id, timestamp, conversation, sender, body):
+    conversation = conversation.encode('utf-8')
+    sender = sender.encode('utf-8')
+    payload = (PAYLOAD_HEADER.pack(len(conversation), len(sender))
+               + conversation + sender + body.encode('utf-8'))
+    crc = zlib.crc32(payload, zlib.crc32(struct.pack(">Qd", msg_id, timestamp)))
+    return RECORD_HEADER.pack(len(payload), crc, msg_id, timestamp) + payload
+
+
+def decode_record(buffer, offset):
+    """Return (record, next offset) for the record starting at offset"""
+    if offset + RECORD_HEADER.size > len(buffer):
+        raise LogCorruption(f"Truncated header at offset {offset}")
+    length, crc, msg_id, timestamp = RECORD_HEADER.unpack_from(buffer, offset)
+    start = offset + RECORD_HEADER.size
+    end = start + length
+    if end > len(buffer):
+        raise LogCorruption(f"Truncated record at offset {offset}")
+    payload = buffer[start:end]
+    if zlib.crc32(payload, zlib.crc32(struct.pack(">Qd", msg_id, timestamp))) != crc:
+        raise LogCorruption(f"Bad checksum at offset {offset}")
+    conversation_len, sender_len = PAYLOAD_HEADER.unpack_from(payload)
+    pos = PAYLOAD_HEADER.size
+    conversation = bytes(payload[pos:pos + conversation_len]).decode('utf-8')
+    pos += conversation_len
+    sender = bytes(payload[pos:pos + sender_len]).decode('utf-8')
+    body = bytes(payload[pos + sender_len:]).decode('utf-8')
+    return LogRecord(msg_id, timestamp, conversation, sender, body), end
+
+
+class ConversationIndex:
+    """Where each conversation's messages are in the log.
+
+    Per conversation it keeps three parallel arrays (message id, segment,
+    offset) in id order, about 20 bytes per message, so fetching a page of
+    history is a binary search plus one mmap read per message.
+    """
+
+    def __init__(self):
+        self.conversations = {}  # conversation: (ids, segments, offsets)
+
+    def add(self, conversation, msg_id, first_id, offset):
+        entry = self.conversations.get(conversation)
+        if entry is None:
+            entry = self.conversations[conversation] = (array("Q"), array("Q"), array("L"))
+        ids, segments, offsets = entry
+        ids.append(msg_id)
+        segments.append(first_id)
+        offsets.append(offset)
+
+    def locate(self, conversation, before_id, limit, oldest_id):
+        """Locations of up to limit messages older than before_id, oldest first.
+
+        Also returns whether older messages remain. Ids below oldest_id were
+        dropped by retention and are skipped.
+        """
+        entry = self.conversations.get(conversation)
+        if entry is None:
+            return [], False
+        ids, segments, offsets = entry
+        end = len(ids) if before_id is None else bisect_left(ids, before_id)
+        floor = bisect_left(ids, oldest_id)
+        start = max(floor, end - limit)
+        return list(zip(segments[start:end], offsets[start:end])), start > floor
+
+    def prune(self, oldest_id):
+        """Forget entries for messages dropped by retention"""
+        for conversation, (ids, segments, offsets) in list(self.conversations.items()):
+            cut = bisect_left(ids, oldest_id)
+            if cut == len(ids):
+                del self.conversations[conversation]
+            elif cut:
+                del ids[:cut], segments[:cut], offsets[:cut]
+
+
+class Segment:
+    """One segment file and a read-only memory map of it"""
+
+    def __init__(self, path, first_id):
+        self.path = path
+        self.first_id = first_id
+        self.size = os.path.getsize(path)
+        self.map = None
+        self.mapped_size = 0
+
+    def view(self):
+        """Memory map covering everything written so far (remapped as the file grows)"""
+        if self.size == 0:
+            return b""
+        if self.map is None or self.mapped_size != self.size:
+            # An older map stays valid for readers still using it and is
+            # unmapped when the last of them lets go
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped_size = self.size
+        return self.map
+
+    def close_map(self):
+        self.map = None
+
+
+class MessageLog:
+    """Durable, append-only history of delivered messages.
+
+    append() only writes into the active segment's buffer; a background
+    thread flushes and fsyncs every FSYNC_INTERVAL seconds, so a burst of
+    messages costs one fsync (group commit). The same thread drops sealed
+    segments older than max_age seconds, or the oldest ones while the log
+    is bigger than max_bytes. page() serves history per conversation from
+    an in-memory ConversationIndex built when the log is opened.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync_interval=FSYNC_INTERVAL,
+                 max_age=None, max_bytes=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = [Segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+                         for name in sorted(os.listdir(directory)) if name.endswith(SEGMENT_SUFFIX)]
+        self.next_id = self.recover()
+        if not self.segments:
+            self.new_segment()
+        self.active = open(self.segments[-1].path, "ab")
+
+        self.index = ConversationIndex()
+        for first_id, offset, record in self.scan():
+            self.index.add(record.conversation, record.msg_id, first_id, offset)
+
+        self.committer = threading.Thread(target=self.commit_loop, daemon=True)
+        self.committer.start()
+
+    def recover(self):
+        """Find the next message id, cutting off a record torn by a crash"""
+        if not self.segments:
+            return 1
+        segment = self.segments[-1]
+        buffer = segment.view()
+        offset = 0
+        next_id = segment.first_id
+        while offset < len(buffer):
+            try:
+                record, offset_after = decode_record(buffer, offset)
+            except LogCorruption as e:
+                warning("history_truncated", path=segment.path, error=str(e))
+                segment.close_map()
+                os.truncate(segment.path, offset)
+                segment.size = offset
+                break
+            next_id = record.msg_id + 1
+            offset = offset_after
+        return next_id
+
+    def new_segment(self):
+        path = os.path.join(self.directory, f"{self.next_id:020d}{SEGMENT_SUFFIX}")
+        open(path, "ab").close()
+        self.segments.append(Segment(path, self.next_id))
+
+    def append(self, conversation, sender, body, timestamp=None):
+        """Add a message and return its id. It is on disk within fsync_interval."""
+        with self.lock:
+            msg_id = self.next_id
+            data = encode_record(msg_id, timestamp or time.time(), conversation, sender, body)
+            segment = self.segments[-1]
+            if segment.size and segment.size + len(data) > self.segment_bytes:
+                self.roll()
+                segment = self.segments[-1]
+            self.active.write(data)
+            self.index.add(conversation, msg_id, segment.first_id, segment.size)
+            segment.size += len(data)
+            self.next_id += 1
+            self.dirty = True
+            return msg_id
+
+    def roll(self):
+        """Seal the active segment and start a new one (lock held)"""
+        self.commit()
+        self.active.close()
+        self.new_segment()
+        self.active = open(self.segments[-1].path, "ab")
+
+    def commit(self):
+        """Flush and fsync everything appended so far (lock held)"""
+        if self.dirty:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.dirty = False
+
+    def commit_loop(self):
+        last_retention = time.monotonic()
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            with self.lock:
+                if self.closed:
+                    break
+                self.commit()
+            if time.monotonic() - last_retention >= RETENTION_INTERVAL:
+                self.apply_retention()
+                last_retention = time.monotonic()
+
+    def apply_retention(self):
+        """Delete sealed segments that are too old or push the log over max_bytes"""
+        with self.lock:
+            sealed = self.segments[:-1]
+            total = sum(segment.size for segment in self.segments)
+            now = time.time()
+            dropped = 0
+            for segment in sealed:
+                too_old = self.max_age is not None and now - os.path.getmtime(segment.path) > self.max_age
+                too_big = self.max_bytes is not None and total > self.max_bytes
+                if not (too_old or too_big):
+                    break  # Segments are in age order
+                segment.close_map()
+                try:
+                    os.remove(segment.path)
+                except OSError as e:  # Windows cannot delete a file that is still mapped
+                    error("history_error", path=segment.path, error=f"could not remove: {e}")
+                    break
+                total -= segment.size
+                dropped += 1
+            del self.segments[:dropped]
+            if dropped:
+                self.index.prune(self.segments[0].first_id)
+        if dropped:
+            info("history_retention", removed_segments=dropped)
+
+    def segment_view(self, first_id):
+        """Memory map of the segment starting at first_id, or None if it was deleted"""
+        with self.lock:
+            for segment in self.segments:
+                if segment.first_id == first_id:
+                    if segment is self.segments[-1] and self.dirty:
+                        self.active.flush()  # Make buffered records visible to the map
+                    return segment.view()
+        return None
+
+    def read_at(self, first_id, offset):
+        """Read the record at offset in the segment starting at first_id"""
+        view = self.segment_view(first_id)
+        if view is None:
+            return None
+        return decode_record(view, offset)[0]
+
+    def page(self, conversation, before_id=None, limit=50):
+        """Up to limit messages of conversation older than before_id, oldest first.
+
+        Returns (records, more) where more says whether older messages exist.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        with self.lock:
+            locations, more = self.index.locate(conversation, before_id, limit,
+                                                self.segments[0].first_id)
+        records = []
+        for first_id, offset in locations:
+            record = self.read_at(first_id, offset)
+            if record is not None:
+                records.append(record)
+        return records, more
+
+    def scan(self):
+        """Yield (segment first id, offset, record) for every readable record in the log.
+
+        A damaged record in a sealed segment (recover() only repairs the
+        active one) is logged and the rest of that segment is skipped, so
+        one bad file loses some history instead of stopping the server.
+        The file is left as it is for inspection.
+        """
+        with self.lock:
+            segments = [(segment.first_id, segment.path) for segment in self.segments]
+        for first_id, path in segments:
+            view = self.segment_view(first_id)
+            offset = 0
+            while view is not None and offset < len(view):
+                try:
+                    record, next_offset = decode_record(view, offset)
+                except LogCorruption as e:
+                    warning("history_corrupt", path=path, error=str(e), skipped_bytes=len(view) - offset)
+                    break
+                yield first_id, offset, record
+                offset = next_offset
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.closed = True
+            self.active.close()
+            for segment in self.segments:
+                segment.close_map()
@@ -0,0 +1,72 @@
+import os
+import signal
+import socket
+import tempfile
+import threading
+
+from bus import BusBroker
+from jsonlog import info
+
+
+def run_prefork(workers, start_worker, announce, open_history=None):
+    """Fork worker processes that share one listening port (SO_REUSEPORT).
+
+    The master keeps a BusBroker on a Unix socket so users on different
+    workers can still talk to each other, and runs announce(broker) for LAN
+    discovery. start_worker(worker_id, bus_address) runs in each child.
+    open_history() returns the message log the broker keeps for every
+    worker, or None; it is called after forking so its thread stays here.
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("[ERROR] --workers needs fork() and SO_REUSEPORT (Linux, macOS or BSD)")
+
+    bus_address = os.path.join(tempfile.gettempdir(), f"chat-bus-{os.getpid()}.sock")
+    if os.path.exists(bus_address):
+        os.unlink(bus_address)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(bus_address)
+    listener.listen()
+
+    # Fork before the broker and announcement threads start so the children do
+    # not inherit their locks. The log writer thread is already running; the
+    # fork hook in jsonlog.py waits for it to finish writing and gives each
+    # child a fresh queue and writer. Anything else started before this point
+    # would need the same care. The children's bus connections wait in the
+    # listen backlog until the broker runs.
+    children = {}
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            try:
+                start_worker(worker_id, bus_address)
+            finally:
+                os._exit(1)
+        children[pid] = worker_id
+        info("worker_started", worker_id=worker_id, pid=pid)
+
+    broker = BusBroker(listener, open_history() if open_history is not None else None)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    threading.Thread(target=announce, args=(broker,), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop_master)
+    try:
+        while children:
+            pid, status = os.wait()
+            worker_id = children.pop(pid, None)
+            if worker_id is not None:
+                info("worker_exited", worker_id=worker_id, pid=pid, status=status)
+    except (KeyboardInterrupt, SystemExit):
+        info("stopping", workers=len(children))
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        listener.close()
+        os.unlink(bus_address)
+
+
+def stop_master(signum, frame):
+    raise SystemExit(0)
@@ -0,0 +1,294 @@
+import struct
+import threading
+import time
+import zlib
+
+# Every message on the wire is one frame:
+#   4 byte big-endian payload length | 1 byte frame type | payload
+# The length prefix lets a reader split coalesced TCP segments back into
+# messages and wait for the rest of a message that arrived in pieces.
+# If the top bit of the type byte is set the payload is zlib compressed.
+HEADER = struct.Struct(">IB")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Refuse anything bigger than 16 MB
+RECV_SIZE = 65536
+
+# Frame types
+FRAME_TEXT = 0x01      # UTF-8 text: the username a client logs in with
+FRAME_USERS = 0x02     # Full online user list: "seq" line, then one username per line
+FRAME_PRESENCE = 0x03  # One presence change: "seq" line, then "+username" or "-username"
+FRAME_RESYNC = 0x04    # Client asks for a fresh FRAME_USERS after missing a change
+FRAME_HISTORY_REQUEST = 0x05  # Client asks for older messages: conversation, before id, limit lines
+FRAME_HISTORY = 0x06   # One page of history (see codec.encode_history)
+FRAME_ROOM = 0x07      # The client joined ("+#room") or left ("-#room") a room
+FRAME_HELLO = 0x08     # Optional first frame: client offers codecs ("zlib"), server
+                       # answers "codec" line + size threshold, or "" for none
+FRAME_MESSAGE = 0x09   # A typed chat message (see codec.py)
+FRAME_PING = 0x0A      # Heartbeat: are you still there? Either side may send it
+FRAME_PONG = 0x0B      # Answer to a FRAME_PING
+FRAME_SESSION = 0x0C   # Server -> client after logging in: resume token line, then grace seconds;
+                       # empty if a FRAME_RESUME was refused (the client then logs in by name)
+FRAME_RESUME = 0x0D    # Client -> server instead of its username: token line, presence seq line,
+                       # then one "seq conversation" line per conversation (see encode_resume)
+FLAG_COMPRESSED = 0x80
+
+GROUP_CHAT = "group"  # Conversation name of the group chat in history requests
+# Rooms are named "#room" everywhere: in messages, commands and history requests.
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame"""
+
+
+class CompressionStats:
+    """Bytes before and after compression and the CPU time it took.
+
+    Totals also go to parent, so one object can add up every connection.
+    """
+
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.parent = parent
+        self.frames = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+
+    def add(self, raw_bytes, wire_bytes, cpu_time=0.0):
+        with self.lock:
+            self.frames += 1
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_time += cpu_time
+        if self.parent is not None:
+            self.parent.add(raw_bytes, wire_bytes, cpu_time)
+
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def describe(self):
+        return (f"{self.frames} frame(s), {self.raw_bytes} -> {self.wire_bytes} bytes "
+                f"({self.ratio():.2f}x), {self.cpu_time * 1000:.1f} ms CPU")
+
+
+compression_totals = CompressionStats()  # Every connection's stats add up here
+
+
+def encode_frame(frame_type, payload):
+    """Build one frame from a str or bytes payload"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes is too large")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def compress_frame(frame, level=6):
+    """Compressed copy of one encoded frame, or None if compressing does not make it smaller"""
+    length, frame_type = HEADER.unpack_from(frame)
+    if HEADER_SIZE + length != len(frame):
+        return None  # Several frames joined together
+    body = zlib.compress(memoryview(frame)[HEADER_SIZE:], level)
+    if len(body) >= length:
+        return None
+    return HEADER.pack(len(body), frame_type | FLAG_COMPRESSED) + body
+
+
+def send_frame(sock, payload, frame_type=FRAME_TEXT, compress_threshold=None):
+    """Send one frame over a connected socket"""
+    send_encoded(sock, encode_frame(frame_type, payload), compress_threshold)
+
+
+def send_encoded(sock, frame, compress_threshold=None):
+    """Send an already encoded frame over a connected socket.
+
+    compress_threshold is what the server agreed to in its FRAME_HELLO;
+    payloads at least that big are sent compressed.
+    """
+    if compress_threshold is not None and len(frame) - HEADER_SIZE >= compress_threshold:
+        frame = compress_frame(frame) or frame
+    sock.sendall(frame)
+
+
+def decode_hello(payload):
+    """Return (codec, threshold) from the server's FRAME_HELLO, or (None, None) for no compression"""
+    if not payload:
+        return None, None
+    codec, threshold = payload.decode('utf-8').split("\n")
+    return codec, int(threshold)
+
+
+class FrameReader:
+    """Buffers received bytes and hands back complete frames.
+
+    Compressed frames are inflated here; stats (a CompressionStats) counts
+    what that cost. received, if given, is a counter (metrics.Counter) of
+    the bytes fed in.
+    """
+
+    def __init__(self, stats=None, received=None):
+        self.buffer = bytearray()
+        self.stats = stats
+        self.received = received
+
+    def feed(self, data):
+        """Add received bytes and return a list of (frame_type, payload) tuples"""
+        if self.received is not None:
+            self.received.inc(len(data))
+        self.buffer += data
+        frames = []
+        start = 0
+        end = len(self.buffer)
+        while end - start >= HEADER_SIZE:
+            length, frame_type = HEADER.unpack_from(self.buffer, start)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes is too large")
+            if end - start - HEADER_SIZE < length:
+                break  # Wait for the rest of this frame
+            body_start = start + HEADER_SIZE
+            payload = bytes(self.buffer[body_start:body_start + length])
+            if frame_type & FLAG_COMPRESSED:
+                frame_type &= ~FLAG_COMPRESSED
+                payload = self.inflate(payload)
+            frames.append((frame_type, payload))
+            start = body_start + length
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def inflate(self, payload):
+        started = time.perf_counter()
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"Bad compressed frame: {e}") from None
+        if inflater.unconsumed_tail:
+            raise ProtocolError(f"Compressed frame inflates to more than {MAX_FRAME_SIZE} bytes")
+        if self.stats is not None:
+            self.stats.add(len(data), len(payload), time.perf_counter() - started)
+        return data
+
+
+def decode_text(payload):
+    """Decode a FRAME_TEXT payload"""
+    return payload.decode('utf-8')
+
+
+def encode_users(seq, usernames):
+    """Build a FRAME_USERS snapshot"""
+    return encode_frame(FRAME_USERS, "\n".join([str(seq), *usernames]))
+
+
+def encode_presence(seq, username, online):
+    """Build a FRAME_PRESENCE change"""
+    return encode_frame(FRAME_PRESENCE, f"{seq}\n{'+' if online else '-'}{username}")
+
+
+def decode_users(payload):
+    """Return (seq, usernames) from a FRAME_USERS payload"""
+    seq, *usernames = payload.decode('utf-8').split("\n")
+    return int(seq), usernames
+
+
+def decode_presence(payload):
+    """Return (seq, username, online) from a FRAME_PRESENCE payload"""
+    seq, change = payload.decode('utf-8').split("\n", 1)
+    return int(seq), change[1:], change[0] == "+"
+
+
+def encode_session(token, grace):
+    """Build a FRAME_SESSION; no token means a resume was refused"""
+    return encode_frame(FRAME_SESSION, f"{token}\n{grace:g}" if token else b"")
+
+
+def decode_session(payload):
+    """Return (token, grace seconds) from a FRAME_SESSION payload, or (None, None) if the resume was refused"""
+    if not payload:
+        return None, None
+    token, grace = payload.decode('utf-8').split("\n")
+    return token, float(grace)
+
+
+def encode_resume(token, presence_seq, seqs):
+    """Build a FRAME_RESUME.
+
+    seqs maps each conversation the client has seen (GROUP_CHAT, "#room"
+    or the other user's name) to the sequence number of its last message.
+    """
+    lines = [token, str(presence_seq or 0)]
+    lines.extend(f"{seq} {conversation}" for conversation, seq in seqs.items())
+    return encode_frame(FRAME_RESUME, "\n".join(lines))
+
+
+def decode_resume(payload):
+    """Return (token, presence_seq, {conversation: seq}) from a FRAME_RESUME payload"""
+    try:
+        token, presence_seq, *lines = payload.decode('utf-8').split("\n")
+        seqs = {}
+        for line in lines:
+            seq, conversation = line.split(" ", 1)
+            seqs[conversation] = int(seq)
+        return token, int(presence_seq), seqs
+    except ValueError as e:  # Also covers UnicodeDecodeError
+        raise ProtocolError(f"Bad resume request: {e}") from None
+
+
+def encode_room(room, joined):
+    """Build a FRAME_ROOM membership change"""
+    return encode_frame(FRAME_ROOM, f"{'+' if joined else '-'}{room}")
+
+
+def decode_room(payload):
+    """Return (room, joined) from a FRAME_ROOM payload"""
+    change = payload.decode('utf-8')
+    return change[1:], change[0] == "+"
+
+
+def encode_history_request(conversation, before_id=None, limit=50):
+    """Build a FRAME_HISTORY_REQUEST.
+
+    conversation is GROUP_CHAT or the other user's name. Without before_id
+    the newest page is returned.
+    """
+    before = "" if before_id is None else str(before_id)
+    return encode_frame(FRAME_HISTORY_REQUEST, f"{conversation}\n{before}\n{limit}")
+
+
+def decode_history_request(payload):
+    """Return (conversation, before_id or None, limit) from a FRAME_HISTORY_REQUEST payload"""
+    try:
+        conversation, before, limit = payload.decode('utf-8').split("\n")
+        return conversation, int(before) if before else None, int(limit)
+    except ValueError as e:  # Also covers UnicodeDecodeError
+        raise ProtocolError(f"Bad history request: {e}") from None
+
+
+def recv_frames(sock, reader):
+    """Block for the next chunk of data and return the frames it completes.
+
+    Returns None when the peer has closed the connection.
+    """
+    data = sock.recv(RECV_SIZE)
+    if not data:
+        return None
+    return reader.feed(data)
+
+
+def recv_frame(sock, reader, pending, ready=None):
+    """Return the next (frame_type, payload), reading from the socket as needed.
+
+    pending is a deque the caller keeps between calls so frames that arrived
+    together with the returned one are not lost. Returns None on disconnect.
+    ready, if given, is called with sock before each read and waits for data;
+    if it returns False no read is made and None is returned as well.
+    """
+    while not pending:
+        if ready is not None and not ready(sock):
+            return None
+        frames = recv_frames(sock, reader)
+        if frames is None:
+            return None
+        pending.extend(frames)
+    return pending.popleft()
+
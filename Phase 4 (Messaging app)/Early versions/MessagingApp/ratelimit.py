@@ -0,0 +1,57 @@
+import time
+
+from metrics import Counter
+
+throttled_pauses = Counter("chat_throttled_pauses_total",
+                           "Times reading from a client was paused for going over its rate limit", ("limit",))
+throttled_seconds = Counter("chat_throttled_seconds_total", "Seconds clients' sockets were left unread for going "
+                            "over their rate limits")
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst.
+
+    take() always succeeds but may leave the bucket in debt; the debt is
+    how long the caller has to wait before the bucket is back at zero.
+    That lets a frame bigger than the burst through, followed by a
+    correspondingly long pause, instead of refusing it forever.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount, now):
+        """Take amount tokens and return the seconds until the bucket is out of debt"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+    """A client's message and byte buckets; a rate of None means no limit on that"""
+
+    def __init__(self, messages=None, message_burst=None, nbytes=None, byte_burst=None):
+        self.messages = TokenBucket(messages, message_burst or messages) if messages else None
+        self.bytes = TokenBucket(nbytes, byte_burst or nbytes) if nbytes else None
+
+    def charge(self, frame_size):
+        """Count one received frame and return how long to stop reading (0 to carry on)"""
+        now = time.monotonic()
+        delay = 0.0
+        limit = None
+        if self.messages is not None:
+            delay = self.messages.take(1, now)
+            if delay:
+                limit = "messages"
+        if self.bytes is not None:
+            byte_delay = self.bytes.take(frame_size, now)
+            if byte_delay > delay:
+                delay, limit = byte_delay, "bytes"
+        if delay:
+            throttled_pauses.inc(1, (limit,))
+            throttled_seconds.inc(delay)
+        return delay
@@ -0,0 +1,81 @@
+import threading
+
+# Usernames go into newline-separated user lists and bus payloads, and into
+# mailbox file names as hex (2 characters per UTF-8 byte, so 30 characters
+# stay well under the usual 255 byte file name limit).
+MAX_USERNAME = 30
+
+
+def user_name(name):
+    """Strip a requested username, or return None if it is not valid"""
+    name = name.strip()
+    if not name or len(name) > MAX_USERNAME or not name.isprintable() or name.startswith("#"):
+        return None
+    return name
+
+
+class ClientRegistry:
+    """Thread-safe map of username -> connection.
+
+    Handler threads register and unregister while others fan out messages,
+    so every change happens under one lock. Fan-out does not hold the lock:
+    snapshot() hands back an immutable tuple of connections that is only
+    rebuilt after the registry has changed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = {}
+        self.cached_snapshot = ()
+
+    def register(self, username, client):
+        """Add client under username. Returns False if the name is already taken."""
+        with self.lock:
+            if username in self.by_name:
+                return False
+            self.by_name[username] = client
+            self.cached_snapshot = None
+            return True
+
+    def unregister(self, username, client):
+        """Remove username if it still belongs to client. Returns True if it was removed."""
+        with self.lock:
+            if self.by_name.get(username) is not client:
+                return False
+            del self.by_name[username]
+            self.cached_snapshot = None
+            return True
+
+    def replace(self, username, old, new):
+        """Put new under username if old still has it. Returns False otherwise."""
+        with self.lock:
+            if self.by_name.get(username) is not old:
+                return False
+            self.by_name[username] = new
+            self.cached_snapshot = None
+            return True
+
+    def get(self, username):
+        """Connection registered under username, or None"""
+        return self.by_name.get(username)
+
+    def snapshot(self):
+        """Tuple of all connections at this moment, safe to iterate while others change the registry"""
+        snapshot = self.cached_snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.cached_snapshot
+                if snapshot is None:
+                    snapshot = self.cached_snapshot = tuple(self.by_name.values())
+        return snapshot
+
+    def usernames(self):
+        """List of registered usernames"""
+        with self.lock:
+            return list(self.by_name)
+
+    def __contains__(self, username):
+        return username in self.by_name
+
+    def __len__(self):
+        return len(self.by_name)
@@ -0,0 +1,100 @@
+import threading
+
+MAX_ROOM_NAME = 32
+
+
+def room_name(name):
+    """Normalise a room name to "#name", or return None if it is not valid"""
+    name = name.strip().lstrip("#")
+    if not name or len(name) > MAX_ROOM_NAME or any(c.isspace() or c in ":#@" for c in name):
+        return None
+    return "#" + name
+
+
+class RoomIndex:
+    """Thread-safe map of room -> member connections, and back.
+
+    A room message only goes to the connections in members(room), so it
+    costs O(room members) rather than O(all users). Like ClientRegistry,
+    members() returns a cached tuple that is only rebuilt after the room
+    has changed. on_open(room) and on_close(room) are called with the lock
+    held when a room gets its first member and loses its last one.
+    """
+
+    def __init__(self, on_open=None, on_close=None):
+        self.lock = threading.Lock()
+        self.by_room = {}     # room: set of connections
+        self.by_client = {}   # connection: set of rooms
+        self.cached_members = {}
+        self.on_open = on_open
+        self.on_close = on_close
+
+    def join(self, room, client):
+        """Add client to room. Returns False if it was already a member."""
+        with self.lock:
+            members = self.by_room.get(room)
+            if members is None:
+                members = self.by_room[room] = set()
+                if self.on_open is not None:
+                    self.on_open(room)
+            elif client in members:
+                return False
+            members.add(client)
+            self.by_client.setdefault(client, set()).add(room)
+            self.cached_members.pop(room, None)
+            return True
+
+    def leave(self, room, client):
+        """Remove client from room. Returns False if it was not a member."""
+        with self.lock:
+            return self.remove(room, client)
+
+    def leave_all(self, client):
+        """Remove client from every room it is in and return those rooms"""
+        with self.lock:
+            rooms = list(self.by_client.get(client, ()))
+            for room in rooms:
+                self.remove(room, client)
+            return rooms
+
+    def remove(self, room, client):
+        """Remove client from room (lock held)"""
+        members = self.by_room.get(room)
+        if members is None or client not in members:
+            return False
+        members.discard(client)
+        rooms = self.by_client[client]
+        rooms.discard(room)
+        if not rooms:
+            del self.by_client[client]
+        if not members:
+            del self.by_room[room]
+            if self.on_close is not None:
+                self.on_close(room)
+        self.cached_members.pop(room, None)
+        return True
+
+    def members(self, room):
+        """Tuple of room's connections at this moment, safe to iterate while rooms change"""
+        members = self.cached_members.get(room)
+        if members is None:
+            with self.lock:
+                members = self.cached_members.get(room)
+                if members is None:
+                    members = tuple(self.by_room.get(room, ()))
+                    if members:
+                        self.cached_members[room] = members
+        return members
+
+    def is_member(self, room, client):
+        return room in self.by_client.get(client, ())
+
+    def rooms_of(self, client):
+        """Sorted list of the rooms client is in"""
+        with self.lock:
+            return sorted(self.by_client.get(client, ()))
+
+    def counts(self):
+        """{room: number of members} for every open room"""
+        with self.lock:
+            return {room: len(members) for room, members in self.by_room.items()}
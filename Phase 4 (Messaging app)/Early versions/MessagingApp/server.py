@@ -1,11 +1,112 @@
+import argparse
+import os
 import socket
 import threading
 import time
+from collections import deque
+
+import connection
+import jsonlog
+from connection import OVERFLOW_POLICIES, SocketConnection, bytes_received, open_connections
+from codec import (ACK, CHAT, INFO, JOIN, KIND_NAMES, LEAVE, LIST_ROOMS, NOTICE, PRIVATE, ROOM, Message,
+                   decode_message, dispatch, encode_history, encode_message)
+from dedupe import SeenMessages
+from protocol import (FRAME_HELLO, FRAME_HISTORY_REQUEST, FRAME_MESSAGE, FRAME_PING, FRAME_PONG, FRAME_RESUME,
+                      FRAME_RESYNC, FRAME_TEXT, GROUP_CHAT, HEADER_SIZE, FrameReader, ProtocolError,
+                      compression_totals, decode_history_request, decode_resume, decode_text, encode_frame,
+                      encode_presence, encode_room, encode_session, encode_users, recv_frame)
+from jsonlog import error, flush, info, sampled, warning
+from metrics import Counter, Gauge, Histogram, Rate, start_metrics_server
+from registry import MAX_USERNAME, ClientRegistry, user_name
+from rooms import RoomIndex, room_name
 
 HOST = '0.0.0.0'
 PORT = 12345
-BROADCAST_PORT = 12346
-clients = {}  # username: connection
+clients = ClientRegistry()  # username: connection
+rooms = RoomIndex()  # "#room": member connections, see /join and /leave
+
+# Every join and leave bumps presence_seq. Clients get a full user list once
+# and then only the +user/-user changes, so they can spot a missed change by
+# a gap in the sequence numbers and ask for a resync.
+presence_seq = 0
+presence_lock = threading.Lock()  # Keeps changes numbered in the order they are sent
+
+# Set when this process is one node of several: a pre-fork worker (--workers)
+# or a cluster host (--cluster). The broker then owns usernames and numbers
+# presence changes, and network_users mirrors the users on every node.
+bus = None
+network_users = set()
+
+# Durable history of delivered messages (see msglog.py), None when disabled.
+# With several workers or cluster nodes the broker keeps the one log for
+# all of them (bus.py), so message ids are the same on every node.
+GROUP_CONVERSATION = GROUP_CHAT
+history = None
+history_dir = "chat_history"
+history_options = {}  # Retention settings passed to MessageLog
+
+# Private messages for offline users wait on disk (see mailboxes.py) until
+# the user registers again. None when disabled. Workers share the directory.
+mailboxes = None
+mailbox_dir = "mailboxes"
+mailbox_options = {}  # Size and TTL settings passed to Mailboxes
+
+# Clients number their chat messages and resend them until they get an ACK;
+# the answer to every recent id is kept so a resend is answered, not delivered again.
+NUMBERED_KINDS = (CHAT, PRIVATE, ROOM)
+seen_messages = SeenMessages()
+
+stats_interval = None  # Seconds between [STATS] lines, None for none
+
+# Clients find the server by probing the LAN (see discovery.py). Announcing
+# it as well is a low-rate fallback for clients that only listen; None for none.
+announce_interval = 30.0
+
+# Registered clients quiet for heartbeat_interval seconds are pinged and
+# reaped if they stay quiet for heartbeat_timeout more (see heartbeat.py),
+# so half-open connections do not keep their username. None disables it.
+heartbeats = None
+heartbeat_interval = 30.0
+heartbeat_timeout = 10.0
+PING = encode_frame(FRAME_PING, b"")
+PONG = encode_frame(FRAME_PONG, b"")
+
+# Resumable sessions (see sessions.py). A client whose link drops stays
+# logged in for resume_grace seconds; if it reconnects with its token in
+# that time it gets only the presence changes and messages it missed, in
+# one write, and nobody sees it leave and join. The backlog numbers every
+# delivered message per conversation (PRESENCE holds the presence changes).
+# None when disabled; single server only.
+sessions = None
+backlog = None
+resume_grace = 30.0
+sequence_lock = threading.Lock()  # Keeps messages numbered in the order they are sent
+PRESENCE = "presence"
+
+# Graceful restart (see handoff.py). The server listens on handoff_path for
+# its replacement: a new server started with the same path takes over the
+# listening socket and every client, so users never see a disconnect.
+handoff = None
+handoff_path = None
+
+# Prometheus metrics on http://metrics_host:metrics_port/metrics, None for
+# none. Worker n of a pre-forked server uses metrics_port + n.
+metrics_host = "127.0.0.1"
+metrics_port = None
+metrics_server = None
+messages_received = Counter("chat_received_messages_total", "Typed messages received from clients", ("kind",))
+duplicate_messages = Counter("chat_duplicate_messages_total", "Resent messages answered without delivering them again")
+received_rate = Rate("chat_received_messages_per_second", "Messages received per second", messages_received.total)
+sent_rate = Rate("chat_sent_frames_per_second", "Frames written to clients per second",
+                 lambda: connection.write_stats.snapshot()["frames"])
+fan_out_seconds = Histogram("chat_fan_out_seconds", "Time to queue one frame for every recipient on this node",
+                            ("scope",))
+Gauge("chat_connected_clients", "Users logged in on this node", lambda: len(clients))
+Gauge("chat_outbound_queue_frames", "Frames waiting in all outbound queues", lambda: sum(queue_depths().values()))
+Gauge("chat_outbound_queue_frames_max", "Frames waiting in the longest outbound queue",
+      lambda: max(queue_depths().values(), default=0))
+Gauge("chat_outbound_queue_bytes", "Bytes waiting in all outbound queues",
+      lambda: sum(client.queued_bytes for client in clients.snapshot()))
 
 def get_local_ip():
     try:
@@ -17,143 +118,902 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
-def broadcast_server_ip():
-    """Broadcast server IP periodically for auto-discovery"""
-    ip = get_local_ip()
-    print(f"[BROADCASTING] Server IP: {ip} on port {BROADCAST_PORT}")
-    
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    s.bind(('', 0))  # Bind to any available port
-    
-    # Broadcast message format: "CHAT_SERVER:IP:PORT"
-    message = f"CHAT_SERVER:{ip}:{PORT}".encode('utf-8')
-    
-    try:
-        while True:
-            s.sendto(message, ('<broadcast>', BROADCAST_PORT))
-            time.sleep(2)  # Broadcast every 2 seconds
-    except Exception as e:
-        print(f"[ERROR] Broadcasting stopped: {e}")
-    finally:
-        s.close()
+def serve_discovery(port=PORT, connections=open_connections.get):
+    """Answer LAN discovery probes with this server's address and load"""
+    from discovery import answer_probes
+    answer_probes(get_local_ip(), port, connections, announce_interval)
+
+def register_client(client, username):
+    """Add a client under its username and announce it. Returns False if the name is taken."""
+    global presence_seq
+    if bus is not None:
+        # The broker checks the name on every node; on_claimed() adds it here
+        if username in clients or not bus.claim(username, client):
+            send_info(client, f"Username {username} already taken.")
+            return False
+        info("registered", username=username, addr=client.addr)
+        notice(f"{username} has joined the chat", exclude=client)
+        deliver_mail(client)
+        watch_client(client)
+        return True
+
+    if sessions is not None:
+        detached = sessions.take_detached(username)
+        if detached is not None:
+            expire_session(detached)  # The user logged in again without its token
+    with presence_lock:
+        client.username = username
+        if not clients.register(username, client):
+            client.username = None
+            send_info(client, f"Username {username} already taken.")
+            return False
+        presence_seq += 1
+
+        # Send list of active users to new client, everyone else just gets the change
+        client.send(encode_users(presence_seq, clients.usernames()))
+        change = encode_presence(presence_seq, username, True)
+        keep(PRESENCE, presence_seq, change)
+        fan_out(change, exclude=client)
+    info("registered", username=username, addr=client.addr)
+    if sessions is not None:
+        client.send(encode_session(sessions.open(username, client).token, resume_grace))
+
+    # Announce new user
+    notice(f"{username} has joined the chat", exclude=client)
+    deliver_mail(client)
+    watch_client(client)
+    return True
+
+def handle_frame(client, frame_type, payload):
+    """Handle one frame from a registered client"""
+    handler = FRAME_HANDLERS.get(frame_type)
+    if handler is not None:
+        handler(client, payload)
+
+def handle_message(client, payload):
+    """Route one typed chat message from a registered client"""
+    message = decode_message(payload)
+    messages_received.inc(1, (KIND_NAMES.get(message.kind, "unknown"),))
+    sampled(jsonlog.INFO, "message", username=client.username, kind=KIND_NAMES.get(message.kind, message.kind),
+            target=message.target, body=message.body)
+    if message.msg_id and message.kind in NUMBERED_KINDS:
+        seen = seen_messages.answer(client.username, message.msg_id)
+        if seen is not None:
+            # A resend of something already handled: the ACK must have been lost
+            duplicate_messages.inc()
+            send_ack(client, message.msg_id, *seen)
+            return
+    if not dispatch(MESSAGE_HANDLERS, message, client):
+        send_info(client, f"Unsupported message kind {message.kind}.")
+
+def send_ack(client, msg_id, answer, seq=0):
+    client.send(encode_message(ACK, answer, msg_id=msg_id, timestamp=time.time(), seq=seq))
+
+def acknowledge(client, message, answer="", seq=0):
+    """Answer a numbered message: "" if it was delivered, otherwise why it was refused.
+
+    seq is the number the delivered message got in its conversation.
+    """
+    seen_messages.record(client.username, message.msg_id, answer, seq)
+    send_ack(client, message.msg_id, answer, seq)
+
+def refuse(client, message, reason):
+    """Turn a message down, in its ACK if the client numbered it"""
+    if message.msg_id:
+        acknowledge(client, message, reason)
+    else:
+        send_info(client, reason)
+
+def sender_copy(client, message):
+    """Who to leave out of a fan-out: a client that numbers its messages gets an ACK instead of its echo"""
+    return client if message.msg_id else None
 
-def handle_client(conn, addr):
-    print(f"[NEW CONNECTION] {addr} connected.")
-    username = None
+def send_group_message(client, message):
+    """Send a group chat line to everyone"""
+    now = time.time()
+    msg_id = record_message(GROUP_CONVERSATION, client.username, message.body, now)
+    with sequence_lock:
+        seq = next_seq(GROUP_CHAT)
+        frame = encode_message(CHAT, message.body, client.username, msg_id=msg_id, timestamp=now, seq=seq)
+        keep(GROUP_CHAT, seq, frame)
+        broadcast(frame, sender_copy(client, message))
+        if message.msg_id:
+            acknowledge(client, message, seq=seq)
+
+def send_private_message(client, message):
+    """Deliver a private message, or keep it in the target's mailbox while they are offline"""
+    username = client.username
+    target = message.target.strip()
+    target_client = clients.get(target)
+    online = target_client is not None or (bus is not None and target in network_users)
+    if not target or not (online or mailboxes is not None):
+        refuse(client, message, f"User '{target}' not found.")
+        return
+    if not online and not mailboxes.deposit(target, username, message.body):
+        refuse(client, message, f"User '{target}' is offline and their mailbox is full.")
+        return
+
+    now = time.time()
+    conversation = private_conversation(username, target)
+    msg_id = record_message(conversation, username, message.body, now)
+    with sequence_lock:
+        seq = next_seq(conversation)
+        frame = encode_message(PRIVATE, message.body, username, target, msg_id, now, seq)
+        keep(conversation, seq, frame)
+        if sessions is not None:
+            for user, other in ((username, target), (target, username)):
+                session = sessions.get(user)
+                if session is not None:
+                    session.conversations.add(other)
+        if target_client is None:
+            if online:
+                bus.direct(target, frame)
+        elif target_client is not sender_copy(client, message):
+            target_client.send(frame)
+        if message.msg_id:
+            acknowledge(client, message, seq=seq)
+        elif target_client is not client:
+            client.send(frame)  # The sender's copy confirms it was delivered or stored
+
+    if not online:
+        send_info(client, f"User '{target}' is offline, they will get your message when they return.")
+        # They may have registered while we were storing it
+        target_client = clients.get(target)
+        if target_client is not None:
+            deliver_mail(target_client)
+
+def send_room_message(client, message):
+    """Send a message to the members of a room the client is in"""
+    room = room_name(message.target)
+    if room is None:
+        refuse(client, message, "Invalid room name.")
+    elif not rooms.is_member(room, client):
+        refuse(client, message, f"You are not in {room}. Join it first.")
+    else:
+        now = time.time()
+        msg_id = record_message(room, client.username, message.body, now)
+        with sequence_lock:
+            seq = next_seq(room)
+            frame = encode_message(ROOM, message.body, client.username, room, msg_id, now, seq)
+            keep(room, seq, frame)
+            room_broadcast(room, frame, sender_copy(client, message))
+            if message.msg_id:
+                acknowledge(client, message, seq=seq)
+
+def list_rooms(client, message):
+    """Tell a client which rooms are open"""
+    counts = rooms.counts()
+    if not counts:
+        send_info(client, "No open rooms. Join one to create it.")
+    else:
+        send_info(client, "Rooms: " + ", ".join(f"{room} ({count})" for room, count in sorted(counts.items())))
+
+def join_room(client, message):
+    """Add a client to a room and tell the room's members"""
+    room = room_name(message.target)
+    if room is None:
+        send_info(client, "Invalid room name.")
+    elif not rooms.join(room, client):
+        send_info(client, f"You are already in {room}.")
+    else:
+        client.send(encode_room(room, True))
+        room_notice(room, f"{client.username} has joined {room}")
+
+def leave_room(client, message):
+    """Take a client out of a room and tell the remaining members"""
+    room = room_name(message.target)
+    if room is None or not rooms.leave(room, client):
+        send_info(client, f"You are not in {message.target}.")
+    else:
+        client.send(encode_room(room, False))
+        room_notice(room, f"{client.username} has left {room}")
+
+def private_conversation(user_a, user_b):
+    """History key of the private conversation between two users"""
+    return "@" + "|".join(sorted((user_a, user_b)))
+
+def record_message(conversation, sender, body, timestamp):
+    """Append a delivered message to the history log and return its id (0 without a log)"""
+    if bus is not None:
+        return bus.record(conversation, sender, body, timestamp)
+    if history is not None:
+        try:
+            return history.append(conversation, sender, body, timestamp)
+        except OSError as e:
+            error("history_error", error=str(e))
+    return 0
+
+def next_seq(conversation):
+    """Sequence number for the next message of conversation, 0 if sessions cannot be resumed"""
+    return 0 if backlog is None else backlog.next_seq(conversation)
+
+def keep(conversation, seq, frame):
+    """Keep a delivered frame for clients that resume their session"""
+    if backlog is not None:
+        backlog.append(conversation, seq, frame)
+
+def send_history(client, conversation, before_id, limit):
+    """Send a client one page of the group chat or of one of its private chats"""
+    if conversation == GROUP_CHAT:
+        key, kind = GROUP_CONVERSATION, CHAT
+    elif conversation.startswith("#"):
+        key, kind = (conversation if rooms.is_member(conversation, client) else None), ROOM
+    else:
+        key, kind = private_conversation(client.username, conversation), PRIVATE
+    if key is None or (history is None and bus is None):
+        messages, more = [], False
+    else:
+        # Ask the broker when it keeps the log for every node, so pages match whichever node the client is on
+        records, more = history.page(key, before_id, limit) if bus is None else bus.history(key, before_id, limit)
+        messages = []
+        for r in records:
+            if kind == CHAT:
+                target = ""
+            elif kind == ROOM:
+                target = conversation
+            else:
+                target = conversation if r.sender == client.username else client.username
+            messages.append(Message(kind, r.msg_id, r.timestamp, r.sender, target, r.body))
+    client.send(encode_history(conversation, messages, more))
+
+def mail_frames(username):
+    """Take username's offline messages out of its mailbox as one batch of encoded frames"""
+    messages = mailboxes.drain(username)
+    if not messages:
+        return None
+    frames = [encode_message(INFO, f"{len(messages)} private message(s) arrived while you were away")]
+    frames.extend(encode_message(PRIVATE, body, sender, username, timestamp=timestamp)
+                  for timestamp, sender, body in messages)
+    return b"".join(frames)
+
+def deliver_mail(client):
+    """Send a client everything that waited in its mailbox in a single write"""
+    if mailboxes is None:
+        return
     try:
-        username = conn.recv(1024).decode('utf-8').strip()
-        if username in clients:
-            conn.sendall(f"Username {username} already taken.".encode('utf-8'))
-            conn.close()
+        frames = mail_frames(client.username)
+    except (OSError, ValueError) as e:
+        error("mailbox_error", username=client.username, error=str(e))
+        return
+    if frames is not None:
+        client.send(frames)
+
+def open_mailboxes():
+    """Start the offline mailboxes if they are enabled"""
+    global mailboxes
+    if mailbox_dir is None:
+        return
+    from mailboxes import Mailboxes
+    mailboxes = Mailboxes(mailbox_dir, **mailbox_options)
+    info("mailbox", directory=mailbox_dir)
+
+def open_history():
+    """Start the history log if it is enabled and return it"""
+    global history
+    if history_dir is None:
+        return None
+    from msglog import MessageLog
+    history = MessageLog(history_dir, **history_options)
+    info("history", directory=history_dir)
+    return history
+
+def unregister_client(client):
+    """Remove a client whose connection closed and tell everyone it left, unless it may still resume"""
+    username = client.username
+    if heartbeats is not None:
+        heartbeats.remove(client)
+    stats = client.compression_stats
+    if stats.frames:
+        info("compression", client=username or client.addr, frames=stats.frames, raw_bytes=stats.raw_bytes,
+             wire_bytes=stats.wire_bytes, ratio=round(stats.ratio(), 2), cpu_ms=round(stats.cpu_time * 1000, 1))
+    if sessions is not None and sessions.detach(client):
+        info("detached", username=username, addr=client.addr, grace=resume_grace)
+        return
+    remove_client(client)
+
+def remove_client(client):
+    """Take a client out of its rooms and the registry and tell everyone it left"""
+    global presence_seq
+    username = client.username
+    session = client.session
+    if session is not None and session.client is client:
+        sessions.close(session)
+    for room in rooms.leave_all(client):
+        room_notice(room, f"{username} has left {room}")
+    if bus is not None:
+        if username and clients.unregister(username, client):
+            bus.release(username)  # The broker sends the presence change back to every node
+            notice(f"{username} has left the chat")
+        return
+
+    with presence_lock:
+        if not username or not clients.unregister(username, client):
             return
-            
-        clients[username] = conn
-        print(f"[REGISTERED] {username} connected from {addr}")
-        
-        # Send list of active users to new client
-        send_user_list(conn)
-        
-        # Announce new user
-        announcement = f"*** {username} has joined the chat ***"
-        broadcast(announcement, exclude=conn)
-        
-        # Update all clients with new user list
-        update_all_users()
-        
+        presence_seq += 1
+        change = encode_presence(presence_seq, username, False)
+        keep(PRESENCE, presence_seq, change)
+        fan_out(change)
+    notice(f"{username} has left the chat")
+
+def expire_session(session):
+    """A detached client did not come back in time: keep its missed private messages and log it out"""
+    username = session.username
+    if mailboxes is not None:
+        try:
+            for other in session.conversations:
+                for frame in backlog.sent_after(private_conversation(username, other), session.detached_at):
+                    message = decode_message(frame[HEADER_SIZE:])
+                    if message.target == username:
+                        mailboxes.deposit(username, message.sender, message.body, message.timestamp)
+        except (OSError, ValueError) as e:
+            error("mailbox_error", username=username, error=str(e))
+    info("session_expired", username=username)
+    remove_client(session.client)
+
+def end_detached_sessions():
+    """Expire the sessions waiting for their client to come back.
+
+    Sessions are not handed over to the next server process, so their
+    users have to leave (and everyone be told) before the presence
+    sequence number is passed on.
+    """
+    if sessions is not None:
+        for session in sessions.take_all_detached():
+            expire_session(session)
+
+def log_in(client, frame_type, payload):
+    """Handle a frame from a client that has not logged in yet.
+
+    Returns True once it is logged in, False if it has to be disconnected
+    and None while it still has to log in.
+    """
+    if frame_type == FRAME_HELLO:
+        client.negotiate(payload)
+        return None
+    if frame_type == FRAME_TEXT:
+        username = user_name(decode_text(payload))
+        if username is None:
+            send_info(client, f"Usernames must be 1 to {MAX_USERNAME} printable characters, not starting with #.")
+            return False
+        return register_client(client, username)
+    if frame_type == FRAME_RESUME:
+        if sessions is not None and resume_session(client, *decode_resume(payload)):
+            return True
+        client.send(encode_session(None, 0))  # Unknown or expired token: log in by name instead
+        return None
+    return False
+
+def resume_session(client, token, seen_presence, seen):
+    """Put a reconnected client in place of its session's old connection.
+
+    Sends it, in one write, the presence changes and messages it missed:
+    seen_presence and seen ({conversation: seq}) say how far it got. Returns
+    False if token belongs to no session.
+    """
+    with presence_lock, sequence_lock:
+        session, previous, detached_at = sessions.resume(token, client)
+        if session is None:
+            return False
+        username = client.username = session.username
+        clients.replace(username, previous, client)
+        joined = rooms.leave_all(previous)
+        for room in joined:
+            rooms.join(room, client)
+
+        batch = [encode_session(token, resume_grace)]
+        missed, complete = backlog.since(PRESENCE, seen_presence)
+        if complete and 0 < seen_presence and len(missed) == presence_seq - seen_presence:
+            batch.extend(missed)
+        else:
+            batch.append(encode_users(presence_seq, clients.usernames()))
+
+        away_since = time.time() if detached_at is None else detached_at
+        conversations = [(GROUP_CHAT, GROUP_CHAT)] + [(room, room) for room in joined]
+        conversations += [(other, private_conversation(username, other)) for other in session.conversations]
+        gaps = []
+        for name, key in conversations:
+            if name in seen:
+                missed, complete = backlog.since(key, seen[name])
+                if not complete:
+                    gaps.append(name)
+            else:
+                missed = backlog.sent_after(key, away_since)  # Nothing from it seen yet
+            batch.extend(missed)
+        if gaps:
+            batch.append(encode_message(INFO, f"Some messages in {', '.join(gaps)} are older than the server "
+                                              "keeps for reconnecting clients; see the history.",
+                                        timestamp=time.time()))
+        client.send(b"".join(batch))
+
+    if previous is not client:
+        previous.abort()  # Its link was half-open; its reader finds the session gone and leaves quietly
+    watch_client(client)
+    info("session_resumed", username=username, addr=client.addr, frames=len(batch) - 1,
+         away=None if detached_at is None else round(time.time() - detached_at, 1))
+    return True
+
+def handle_client(conn, addr, taken_over=None):
+    """Serve one client; taken_over is its state if the previous server process handed it to us"""
+    client = SocketConnection(conn, addr)
+    reader = FrameReader(client.compression_stats, bytes_received)
+    pending = deque()
+    ready = handoff.ready if handoff is not None else None
+    try:
+        if taken_over is None:
+            info("new_connection", addr=addr)
+        else:
+            resume_client(client, reader, pending, taken_over)
+        if client.username is None:
+            logged_in = None
+            while logged_in is None:
+                frame = recv_frame(conn, reader, pending, ready)
+                if frame is None:
+                    return
+                logged_in = log_in(client, *frame)
+            if not logged_in:
+                return
+
         while True:
-            msg = conn.recv(1024).decode('utf-8')
-            if not msg:
+            frame = recv_frame(conn, reader, pending, ready)
+            if frame is None:
                 break
-                
-            print(f"[{username}] {msg}")
-            
-            # Check for private message format: @username: message
-            if msg.startswith("@"):
-                try:
-                    # Split at the first colon
-                    parts = msg.split(":", 1)
-                    if len(parts) != 2:
-                        conn.sendall("Invalid format. Use @username: message".encode('utf-8'))
-                        continue
-                        
-                    target = parts[0][1:].strip()  # Remove the @ and whitespace
-                    content = parts[1].strip()
-                    
-                    if target in clients:
-                        # Send to target
-                        private_msg = f"[Private from {username}] {content}"
-                        clients[target].sendall(private_msg.encode('utf-8'))
-                        
-                        # Send confirmation to sender
-                        confirmation = f"[Private to {target}] {content}"
-                        conn.sendall(confirmation.encode('utf-8'))
-                    else:
-                        conn.sendall(f"User '{target}' not found.".encode('utf-8'))
-                except Exception as e:
-                    print(f"Private message error: {e}")
-                    conn.sendall("Error processing private message.".encode('utf-8'))
-            else:
-                # Normal broadcast message
-                broadcast(f"{username}: {msg}")
+            client.last_seen = time.monotonic()
+            handle_frame(client, *frame)
+            delay = client.charge(HEADER_SIZE + len(frame[1]))
+            if delay:
+                time.sleep(delay)  # Backpressure: the client's sends back up into its socket
+    except ProtocolError as e:
+        warning("protocol_error", addr=addr, error=str(e))
     except Exception as e:
-        print(f"[ERROR] {username} | {e}")
+        error("client_error", username=client.username, error=str(e))
     finally:
-        if username and username in clients:
-            del clients[username]
-            leave_msg = f"*** {username} has left the chat ***"
-            broadcast(leave_msg)
-            update_all_users()  # Update user lists after someone leaves
-        conn.close()
-        print(f"[DISCONNECT] {addr} disconnected.")
-
-def send_user_list(conn):
-    """Send list of active users to a specific client"""
-    users = ",".join(clients.keys())
-    msg = f"/users {users}"
+        # A client handed to the next server process stays registered and open
+        if handoff is None or not handoff.park(client, reader.buffer):
+            unregister_client(client)
+            client.close()
+            open_connections.dec()
+            info("disconnect", addr=addr)
+
+def resume_client(client, reader, pending, state):
+    """Pick up a client handed over by the previous server process, without announcing it again"""
+    from handoff import decode_client_state
+    username, client.compress_threshold, joined, unread = decode_client_state(state)
+    for room in joined:
+        rooms.join(room, client)
+    if username is not None:
+        client.username = username
+        clients.register(username, client)
+        watch_client(client)
+        if sessions is not None:
+            # Sessions do not survive the restart, but the client can resume from now on
+            client.send(encode_session(sessions.open(username, client).token, resume_grace))
+    pending.extend(reader.feed(unread))
+    info("resumed", username=username, addr=client.addr)
+
+def send_info(client, text):
+    """Send a message from the server meant for this client only"""
+    client.send(encode_message(INFO, text, timestamp=time.time()))
+
+def send_user_list(client):
+    """Send a full snapshot of active users to a specific client"""
     try:
-        conn.sendall(msg.encode('utf-8'))
+        with presence_lock:
+            users = network_users if bus is not None else clients.usernames()
+            client.send(encode_users(presence_seq, users))
     except Exception as e:
-        print(f"Error sending user list: {e}")
+        error("user_list_error", error=str(e))
+
+def queue_depths():
+    """Outbound queue depth of every connected client, by username"""
+    return {client.username: client.queue_depth() for client in clients.snapshot()}
+
+def log_stats(interval):
+    """Print write coalescing figures every interval seconds"""
+    while True:
+        time.sleep(interval)
+        stats = connection.write_stats.snapshot()
+        info("stats", clients=len(clients), writes=stats["writes"], frames=stats["frames"],
+             frames_per_write=round(stats["frames_per_write"], 2), bytes_per_write=round(stats["bytes_per_write"]),
+             window_ms=connection.flush_window * 1000, nodelay=connection.tcp_nodelay,
+             compressed_frames=compression_totals.frames, compression_ratio=round(compression_totals.ratio(), 2),
+             compression_cpu_ms=round(compression_totals.cpu_time * 1000, 1))
+
+def start_stats():
+    if stats_interval:
+        threading.Thread(target=log_stats, args=(stats_interval,), daemon=True).start()
 
-def update_all_users():
-    """Send updated user list to all clients"""
-    for conn in clients.values():
-        send_user_list(conn)
+def watch_client(client):
+    """Start checking a registered client's heartbeat"""
+    if heartbeats is not None:
+        heartbeats.add(client)
 
-def broadcast(message, exclude=None):
-    """Send message to all clients except excluded one"""
-    for user_conn in clients.values():
-        if user_conn != exclude:
+def start_heartbeats():
+    """Start pinging idle clients and reaping dead ones if it is enabled"""
+    global heartbeats
+    if not heartbeat_interval:
+        return
+    from heartbeat import Heartbeats
+    heartbeats = Heartbeats(heartbeat_interval, heartbeat_timeout, lambda client: client.send(PING))
+    heartbeats.start()
+
+def handoff_state():
+    return str(presence_seq)
+
+def handoff_client_state(client, unread):
+    from handoff import encode_client_state
+    return encode_client_state(client.username, client.compress_threshold, rooms.rooms_of(client), unread)
+
+def release_for_successor():
+    """Close the history log and the metrics port so the next server process can open them"""
+    global history
+    log, history = history, None
+    if log is not None:
+        log.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+
+def resume_clients(listener, seq, taken_clients):
+    """Serve the clients taken over from the previous server process and return its listening socket"""
+    global presence_seq
+    presence_seq = seq  # Clients carry on from the last presence change they saw
+    for sock, state in taken_clients:
+        try:
+            addr = sock.getpeername()
+        except OSError:
+            sock.close()  # Gone while it was being handed over
+            continue
+        open_connections.inc()
+        threading.Thread(target=handle_client, args=(sock, addr, state), daemon=True).start()
+    return listener
+
+def start_sessions():
+    """Let clients whose link drops resume their session if it is enabled"""
+    global sessions, backlog
+    if not resume_grace:
+        return
+    from sessions import Backlog, Sessions
+    backlog = Backlog()
+    sessions = Sessions(resume_grace, expire_session)
+    sessions.start()
+    info("sessions", grace=resume_grace)
+
+def start_handoff():
+    """Wait on handoff_path for the server process that will replace this one"""
+    global handoff
+    from handoff import Handoff
+    handoff = Handoff(handoff_path, handoff_state, handoff_client_state, release_for_successor)
+    handoff.start()
+
+def start_metrics(port_offset=0):
+    """Serve the Prometheus metrics if they are enabled"""
+    global metrics_server
+    if metrics_port is None:
+        return
+    port = metrics_port + port_offset
+    try:
+        metrics_server = start_metrics_server(metrics_host, port)
+    except OSError as e:
+        error("metrics_error", host=metrics_host, port=port, error=str(e))
+        return
+    info("metrics", url=f"http://{metrics_host}:{port}/metrics")
+
+def fan_out(frame, exclude=None):
+    """Queue one encoded frame for every client except the excluded one.
+
+    Every recipient gets the same bytes object, so a message is encoded once
+    no matter how many clients receive it.
+    """
+    started = time.perf_counter()
+    for client in clients.snapshot():
+        if client is not exclude:
             try:
-                user_conn.sendall(message.encode('utf-8'))
+                client.send(frame)
             except Exception as e:
-                print(f"Broadcast error: {e}")
+                error("broadcast_error", username=client.username, error=str(e))
+    fan_out_seconds.observe(time.perf_counter() - started, ("all",))
 
-def start_server():
-    ip = get_local_ip()
-    print(f"[STARTING] Server running at {ip}:{PORT}")
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of address
-    server.bind((HOST, PORT))
-    server.listen()
-    print(f"[LISTENING] Server is listening on port {PORT}")
-    print(f"[INFO] Clients should connect to {ip}:{PORT}")
-    
-    # Start broadcasting server IP for auto-discovery
-    broadcast_thread = threading.Thread(target=broadcast_server_ip, daemon=True)
-    broadcast_thread.start()
-    
-    while True:
+def broadcast(frame, exclude=None):
+    """Send an encoded frame to all clients, on this node and the others, except the excluded one"""
+    fan_out(frame, exclude)
+    if bus is not None:
+        bus.publish(frame)
+
+def fan_out_room(room, frame, exclude=None):
+    """Queue one encoded frame for every member of room on this node"""
+    started = time.perf_counter()
+    for client in rooms.members(room):
+        if client is not exclude:
+            try:
+                client.send(frame)
+            except Exception as e:
+                error("room_broadcast_error", room=room, username=client.username, error=str(e))
+    fan_out_seconds.observe(time.perf_counter() - started, ("room",))
+
+def room_broadcast(room, frame, exclude=None):
+    """Send an encoded frame to every member of room, on this node and the others, except the excluded one"""
+    fan_out_room(room, frame, exclude)
+    if bus is not None:
+        bus.publish_room(room, frame)
+
+def notice(text, exclude=None):
+    """Tell everyone that somebody joined or left the chat"""
+    broadcast(encode_message(NOTICE, text, timestamp=time.time()), exclude)
+
+def room_notice(room, text):
+    """Tell a room's members that somebody joined or left it"""
+    room_broadcast(room, encode_message(NOTICE, text, target=room, timestamp=time.time()))
+
+def on_bus_snapshot(seq, usernames):
+    """Start the network-wide user list from the broker's directory"""
+    global presence_seq, network_users
+    with presence_lock:
+        presence_seq = seq
+        network_users = set(usernames)
+
+def on_bus_claimed(username, client):
+    """The broker gave us username; register it before its presence change arrives"""
+    client.username = username
+    clients.register(username, client)
+
+def on_bus_presence(seq, username, online):
+    """A user joined or left on some node"""
+    global presence_seq
+    with presence_lock:
+        presence_seq = seq
+        if online:
+            network_users.add(username)
+        else:
+            network_users.discard(username)
+        local = clients.get(username) if online else None
+        if local is not None:
+            local.send(encode_users(seq, network_users))
+        fan_out(encode_presence(seq, username, online), exclude=local)
+
+    if online and local is None and mailboxes is not None and mailboxes.has_mail(username):
+        # The user is back on another node: forward what was left here
+        frames = mail_frames(username)
+        if frames is not None:
+            bus.direct(username, frames)
+
+def on_bus_direct(target, frame):
+    """A private message from another node for one of our users"""
+    client = clients.get(target)
+    if client is not None:
+        client.send(frame)
+
+def on_bus_lost():
+    """Without the broker this node cannot reach the others, so stop it"""
+    error("cluster_lost", action="stopping")
+    flush()
+    os._exit(1)
+
+def connect_bus(address, node_id, backend="broker"):
+    """Join the other nodes through the given cluster backend"""
+    global bus
+    from bus import BACKENDS
+    bus = BACKENDS[backend](address, node_id, on_bus_snapshot, on_bus_claimed, on_bus_presence,
+                            fan_out, on_bus_direct, fan_out_room, on_bus_lost)
+    # Only get a room's messages from the other nodes while someone here is in it
+    rooms.on_open = bus.subscribe
+    rooms.on_close = bus.unsubscribe
+
+def handle_resync(client, payload):
+    send_user_list(client)
+
+def handle_history_request(client, payload):
+    send_history(client, *decode_history_request(payload))
+
+def handle_ping(client, payload):
+    client.send(PONG)
+
+def handle_pong(client, payload):
+    pass  # Receiving it already counted as a sign of life
+
+# What a registered client's frames and typed messages are handled by
+FRAME_HANDLERS = {
+    FRAME_MESSAGE: handle_message,
+    FRAME_RESYNC: handle_resync,
+    FRAME_HISTORY_REQUEST: handle_history_request,
+    FRAME_PING: handle_ping,
+    FRAME_PONG: handle_pong,
+}
+MESSAGE_HANDLERS = {
+    CHAT: send_group_message,
+    PRIVATE: send_private_message,
+    ROOM: send_room_message,
+    JOIN: join_room,
+    LEAVE: leave_room,
+    LIST_ROOMS: list_rooms,
+}
+
+def serve(mode, port, reuse_port=False, server=None):
+    """Accept clients on port (or the given listening socket) until the process is stopped or handed over"""
+    if mode == "async":
+        from async_server import run_async_server
+        run_async_server(HOST, port, log_in, handle_frame, unregister_client, reuse_port)
+        return
+
+    if server is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of address
+        if reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Share the port with the other workers
+        server.bind((HOST, port))
+        server.listen()
+
+    while handoff is None or handoff.ready(server):
         try:
             conn, addr = server.accept()
+            active = open_connections.inc()
             thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
             thread.start()
-            print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 2}")  # -2 for main and broadcast threads
+            info("active_connections", count=active)
         except Exception as e:
-            print(f"Error accepting connection: {e}")
+            error("accept_error", error=str(e))
+    end_detached_sessions()
+    handoff.hand_over(server)
+
+def start_worker(worker_id, bus_address, mode, port):
+    """Entry point of a forked worker process"""
+    connect_bus(bus_address, worker_id)  # The master keeps the message log
+    open_mailboxes()
+    start_stats()
+    start_heartbeats()
+    start_metrics(worker_id)
+    serve(mode, port, reuse_port=True)
+
+def start_server(mode="thread", port=PORT, workers=1, cluster=None, node_id=None, backend="broker"):
+    ip = get_local_ip()
+    info("starting", ip=ip, port=port, mode=mode, workers=workers)
+
+    if workers > 1:
+        from prefork import run_prefork
+        run_prefork(workers, lambda worker_id, bus_address: start_worker(worker_id, bus_address, mode, port),
+                    lambda broker: serve_discovery(port, broker.user_count), open_history)
+        return
+
+    if cluster is not None:
+        node_id = node_id or f"{socket.gethostname()}:{port}"
+        connect_bus(cluster, node_id, backend)
+        info("cluster", broker=cluster, node_id=node_id)
+
+    taken = None
+    if handoff_path is not None:
+        from handoff import take_over
+        taken = take_over(handoff_path)  # The previous server closes its history log and metrics port first
+
+    if bus is None:
+        open_history()  # Otherwise the cluster's broker keeps it (python bus.py --history-dir)
+    open_mailboxes()
+    start_stats()
+    start_heartbeats()
+    start_metrics()
+    if bus is None:
+        start_sessions()
+
+    listener = None
+    if taken is not None:
+        listener = resume_clients(*taken)
+    if handoff_path is not None:
+        start_handoff()
+
+    # Let clients on the LAN find this server
+    discovery_thread = threading.Thread(target=serve_discovery, args=(port,), daemon=True)
+    discovery_thread.start()
+
+    serve(mode, port, server=listener)
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="MessagingApp chat server")
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread",
+                        help="thread: one thread per client, async: one event loop for all clients")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT (Unix only)")
+    parser.add_argument("--cluster", metavar="ADDRESS",
+                        help="join a cluster through the broker at host:port (run it with python bus.py)")
+    parser.add_argument("--node-id", help="name of this node in the cluster (default hostname:port)")
+    parser.add_argument("--cluster-backend", default="broker",
+                        help="cluster pub/sub and presence backend (see bus.BACKENDS)")
+    parser.add_argument("--queue-size", type=int, default=connection.queue_size,
+                        help="outbound frames buffered per client before the overflow policy applies")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=connection.overflow_policy,
+                        help="what to do with a client whose outbound queue is full")
+    parser.add_argument("--flush-ms", type=float, default=connection.flush_window * 1000,
+                        help="milliseconds a client's writer waits to batch more frames into one write")
+    parser.add_argument("--flush-kb", type=float, default=connection.flush_bytes / 1024,
+                        help="write straight away once this many KB are queued for a client")
+    parser.add_argument("--nodelay", action=argparse.BooleanOptionalAction, default=connection.tcp_nodelay,
+                        help="set TCP_NODELAY on client sockets (--no-nodelay leaves Nagle's algorithm on)")
+    parser.add_argument("--compress-threshold", type=int, default=connection.compression_threshold,
+                        help="compress frames with payloads of at least this many bytes for clients that support it")
+    parser.add_argument("--compress-level", type=int, default=connection.compression_level,
+                        help="zlib level, 1 (fastest) to 9 (smallest)")
+    parser.add_argument("--no-compression", action="store_true", help="never compress frames")
+    parser.add_argument("--stats-interval", type=float,
+                        help="print write coalescing statistics every this many seconds")
+    parser.add_argument("--announce-interval", type=float, default=announce_interval,
+                        help="also broadcast the server's address every this many seconds for clients that "
+                             "do not probe (0 to only answer probes)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on this HTTP port (workers use port + worker number)")
+    parser.add_argument("--metrics-host", default=metrics_host,
+                        help="address the metrics port listens on")
+    parser.add_argument("--log-level", choices=jsonlog.LEVELS, default="info",
+                        help="leave out log records below this level")
+    parser.add_argument("--log-sample", type=float, default=jsonlog.sample_rate,
+                        help="share (0 to 1) of per-message log records to keep")
+    parser.add_argument("--log-format", choices=jsonlog.FORMATS, default=jsonlog.log_format,
+                        help="json: one JSON object per line, text: [EVENT] key=value lines")
+    parser.add_argument("--log-queue", type=int, default=jsonlog.queue_size,
+                        help="log records buffered for the log writer before new ones are dropped")
+    parser.add_argument("--heartbeat-interval", type=float, default=heartbeat_interval,
+                        help="ping clients that have been quiet for this many seconds (0 to never ping)")
+    parser.add_argument("--heartbeat-timeout", type=float, default=heartbeat_timeout,
+                        help="disconnect a pinged client that stays quiet for this many more seconds")
+    parser.add_argument("--rate-messages", type=float, default=connection.rate_messages,
+                        help="frames per second a client may send before the server stops reading it (0 for no limit)")
+    parser.add_argument("--rate-burst", type=float, default=connection.rate_message_burst,
+                        help="frames a client may send at once before --rate-messages applies")
+    parser.add_argument("--rate-kb", type=float, default=connection.rate_bytes / 1024,
+                        help="KB per second a client may send (0 for no limit)")
+    parser.add_argument("--rate-burst-kb", type=float, default=connection.rate_byte_burst / 1024,
+                        help="KB a client may send at once before --rate-kb applies")
+    parser.add_argument("--resume-grace", type=float, default=resume_grace,
+                        help="seconds a client whose connection dropped stays logged in and can resume its "
+                             "session (0 to log it out straight away; single server only)")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="restart without disconnecting anyone: take over from the server waiting on this "
+                             "Unix socket, if any, then wait there for the next one (thread mode only)")
+    parser.add_argument("--history-dir", default=history_dir,
+                        help="directory for the message log (with --cluster the broker keeps it, see bus.py)")
+    parser.add_argument("--no-history", action="store_true", help="do not keep a message log")
+    parser.add_argument("--retention-hours", type=float,
+                        help="delete log segments older than this")
+    parser.add_argument("--retention-mb", type=float,
+                        help="delete the oldest log segments while the log is bigger than this")
+    parser.add_argument("--fsync-ms", type=float,
+                        help="milliseconds between group commits of the message log")
+    parser.add_argument("--mailbox-dir", default=mailbox_dir,
+                        help="directory for private messages waiting for offline users")
+    parser.add_argument("--no-mailbox", action="store_true",
+                        help="reject private messages to offline users instead of storing them")
+    parser.add_argument("--mailbox-kb", type=float,
+                        help="largest mailbox per user before new messages are refused")
+    parser.add_argument("--mailbox-ttl-hours", type=float,
+                        help="throw away offline messages older than this")
+    args = parser.parse_args()
+    jsonlog.configure_logging(args.log_level, args.log_sample, args.log_format, args.log_queue)
+    if args.cluster and args.workers > 1:
+        parser.error("--cluster and --workers cannot be combined")
+    if args.handoff and (args.mode != "thread" or args.cluster or args.workers > 1):
+        parser.error("--handoff only works with a single --mode thread server")
+    connection.configure_outbound(args.queue_size, args.overflow)
+    connection.configure_writes(args.flush_ms / 1000, int(args.flush_kb * 1024), args.nodelay)
+    connection.configure_rate_limits(args.rate_messages, args.rate_burst, args.rate_kb * 1024,
+                                     args.rate_burst_kb * 1024)
+    connection.configure_compression(args.compress_threshold, args.compress_level, not args.no_compression)
+    stats_interval = args.stats_interval
+    announce_interval = args.announce_interval or None
+    metrics_port = args.metrics_port
+    heartbeat_interval = args.heartbeat_interval
+    heartbeat_timeout = args.heartbeat_timeout
+    metrics_host = args.metrics_host
+    handoff_path = args.handoff
+    resume_grace = args.resume_grace or None
+    history_dir = None if args.no_history else args.history_dir
+    if args.retention_hours is not None:
+        history_options["max_age"] = args.retention_hours * 3600
+    if args.retention_mb is not None:
+        history_options["max_bytes"] = int(args.retention_mb * 1024 * 1024)
+    if args.fsync_ms is not None:
+        history_options["fsync_interval"] = args.fsync_ms / 1000
+    mailbox_dir = None if args.no_mailbox else args.mailbox_dir
+    if args.mailbox_kb is not None:
+        mailbox_options["max_bytes"] = int(args.mailbox_kb * 1024)
+    if args.mailbox_ttl_hours is not None:
+        mailbox_options["ttl"] = args.mailbox_ttl_hours * 3600
+    start_server(args.mode, args.port, args.workers, args.cluster, args.node_id, args.cluster_backend)
 
     #Current version: 11:43 11 May 2025
\ No newline at end of file
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from heartbeat import TimerWheel
+from jsonlog import warning
+
+REPLAY_MESSAGES = 256       # Recent messages kept per conversation for resuming clients
+MAX_CONVERSATIONS = 10000   # Conversations with a backlog, least recently used dropped first
+
+
+class Backlog:
+    """Numbers the messages of every conversation and keeps the last few.
+
+    Every delivered message gets the next sequence number of its
+    conversation, so a client that lost its link can say how far it got in
+    each one and be sent only what it missed. since() answers from the
+    kept frames; if older ones are needed it says the replay is incomplete.
+    sent_after() finds what went out while a client was away in
+    conversations it has no number for yet.
+    The caller serialises next_seq() and append() for a conversation so the
+    numbers go out in order.
+    """
+
+    def __init__(self, per_conversation=REPLAY_MESSAGES, conversations=MAX_CONVERSATIONS):
+        self.per_conversation = per_conversation
+        self.conversations = conversations
+        self.lock = threading.Lock()
+        self.by_conversation = OrderedDict()  # conversation: [last seq, deque of (seq, time sent, frame)]
+
+    def next_seq(self, conversation):
+        """Sequence number the next message of conversation gets"""
+        with self.lock:
+            entry = self.by_conversation.get(conversation)
+            return 1 if entry is None else entry[0] + 1
+
+    def append(self, conversation, seq, frame, sent=None):
+        """Keep frame as message seq of conversation, sent at time.time() sent"""
+        with self.lock:
+            entry = self.by_conversation.get(conversation)
+            if entry is None:
+                entry = self.by_conversation[conversation] = [0, deque(maxlen=self.per_conversation)]
+                if len(self.by_conversation) > self.conversations:
+                    self.by_conversation.popitem(last=False)
+            else:
+                self.by_conversation.move_to_end(conversation)
+            entry[0] = seq
+            entry[1].append((seq, time.time() if sent is None else sent, frame))
+
+    def since(self, conversation, seq):
+        """Return (frames after message seq, oldest first; whether none are missing)"""
+        with self.lock:
+            entry = self.by_conversation.get(conversation)
+            if entry is None:
+                return [], True
+            if seq > entry[0]:
+                seq = 0  # Numbered by an earlier server process: everything here is new to the client
+            kept = entry[1]
+            frames = [frame for frame_seq, _, frame in kept if frame_seq > seq]
+            return frames, not kept or kept[0][0] <= seq + 1
+
+    def sent_after(self, conversation, when):
+        """Frames of conversation kept from time.time() when on, oldest first"""
+        with self.lock:
+            entry = self.by_conversation.get(conversation)
+            if entry is None:
+                return []
+            return [frame for _, sent, frame in entry[1] if sent >= when]
+
+
+class Session:
+    """A logged-in user that may come back on a new connection with token"""
+    __slots__ = ("token", "username", "client", "conversations", "detached_at")
+
+    def __init__(self, token, username, client):
+        self.token = token
+        self.username = username
+        self.client = client
+        self.conversations = set()  # Users it exchanged private messages with, for replaying them
+        self.detached_at = None     # time.time() its link dropped, None while connected
+
+
+class Sessions:
+    """Resume tokens of logged-in users.
+
+    When a session's connection drops it is kept, still registered, for
+    grace seconds. A client that reconnects with the token in that time
+    takes it over; otherwise the session is closed and on_expire(session)
+    is called. Expiry uses a timer wheel like the heartbeats, so detaching
+    costs O(1).
+    """
+
+    def __init__(self, grace, on_expire, tick=1.0):
+        self.grace = grace
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        self.by_token = {}
+        self.by_username = {}
+        self.wheel = TimerWheel(tick, slots=max(8, int(grace / tick) + 2))
+        self.thread = None
+
+    def open(self, username, client):
+        """Start a session for a client that just registered and return it"""
+        session = Session(os.urandom(16).hex(), username, client)
+        with self.lock:
+            self.by_token[session.token] = session
+            self.by_username[username] = session
+        client.session = session
+        return session
+
+    def get(self, username):
+        """Session of username, or None"""
+        return self.by_username.get(username)
+
+    def detach(self, client):
+        """Keep client's session for the grace period. Returns False if it has none to keep."""
+        session = client.session
+        with self.lock:
+            if session is None or session.client is not client or self.by_token.get(session.token) is not session:
+                return False
+            session.detached_at = time.time()
+        self.wheel.schedule(session, self.grace)
+        return True
+
+    def resume(self, token, client):
+        """Move the session with token over to client.
+
+        Returns (session, previous client, when it detached or None if it
+        never noticed), or (None, None, None) if the token is unknown.
+        """
+        with self.lock:
+            session = self.by_token.get(token)
+            if session is None:
+                return None, None, None
+            previous, detached_at = session.client, session.detached_at
+            session.client, session.detached_at = client, None
+        self.wheel.cancel(session)
+        client.session = session
+        return session, previous, detached_at
+
+    def take_detached(self, username):
+        """Forget username's session if its link is down and return it, otherwise return None"""
+        with self.lock:
+            session = self.by_username.get(username)
+            if session is None or session.detached_at is None:
+                return None
+            del self.by_username[username]
+            del self.by_token[session.token]
+        self.wheel.cancel(session)
+        return session
+
+    def take_all_detached(self):
+        """Forget every session whose link is down and return them"""
+        with self.lock:
+            detached = [session for session in self.by_token.values() if session.detached_at is not None]
+            for session in detached:
+                del self.by_token[session.token]
+                if self.by_username.get(session.username) is session:
+                    del self.by_username[session.username]
+        for session in detached:
+            self.wheel.cancel(session)
+        return detached
+
+    def close(self, session):
+        """Forget session; its token no longer resumes anything"""
+        with self.lock:
+            if self.by_token.get(session.token) is session:
+                del self.by_token[session.token]
+            if self.by_username.get(session.username) is session:
+                del self.by_username[session.username]
+        self.wheel.cancel(session)
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            for session in self.wheel.advance():
+                with self.lock:
+                    if session.detached_at is None or self.by_token.get(session.token) is not session:
+                        continue  # Resumed or closed since its timer was set
+                    del self.by_token[session.token]
+                    if self.by_username.get(session.username) is session:
+                        del self.by_username[session.username]
+                try:
+                    self.on_expire(session)
+                except Exception as e:
+                    warning("session_expiry_error", username=session.username, error=str(e))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import jsonlog
+import server
+from async_server import raise_open_file_limit
+from codec import CHAT, encode_message
+from connection import open_connections
+from protocol import FRAME_TEXT, FRAME_USERS, FrameReader, encode_frame
+
+# Stress test for the client registry: thousands of clients connect,
+# register from a small pool of usernames (so many race for the same name),
+# maybe send a group message and disconnect, all at once, while a checker
+# thread keeps verifying the registry. The server runs in this process so
+# the registry and the open_connections gauge can be inspected directly:
+#   python stress_registry.py --cycles 5000 --concurrency 500
+#   python stress_registry.py --mode async
+# Prints the result as JSON and exits with status 1 if anything is off.
+
+HOST = "127.0.0.1"
+PORT = 12399
+
+
+async def cycle(port, username, stats, abrupt):
+    """Connect, try to register as username, maybe chat, then leave"""
+    try:
+        reader, writer = await asyncio.open_connection(HOST, port)
+    except OSError:
+        stats["connect_errors"] += 1
+        return
+    try:
+        writer.write(encode_frame(FRAME_TEXT, username))
+        await writer.drain()
+        if abrupt:
+            return  # Leave before the server has answered
+        frames = FrameReader()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                stats["refused"] += 1  # Name taken: the server closed the connection
+                return
+            if any(frame_type == FRAME_USERS for frame_type, _ in frames.feed(data)):
+                break
+        stats["registered"] += 1
+        if random.random() < 0.5:
+            writer.write(encode_message(CHAT, f"stress {username}"))
+            await writer.drain()
+    except OSError:
+        stats["io_errors"] += 1
+    finally:
+        writer.close()
+
+
+def check_registry(problems):
+    """Every name maps to a client registered under it, and the snapshot has no duplicates"""
+    registry = server.clients
+    with registry.lock:
+        entries = list(registry.by_name.items())
+    for username, client in entries:
+        if client.username != username:
+            problems.append(f"{username} is registered to a client named {client.username}")
+    snapshot = registry.snapshot()
+    if len(set(map(id, snapshot))) != len(snapshot):
+        problems.append("snapshot lists a client twice")
+
+
+def watch(stop, problems, interval):
+    while not stop.is_set():
+        check_registry(problems)
+        time.sleep(interval)
+
+
+async def run(args, stats):
+    limit = asyncio.Semaphore(args.concurrency)
+    usernames = [f"s{i}" for i in range(args.names)]
+
+    async def one():
+        async with limit:
+            await cycle(args.port, random.choice(usernames), stats, random.random() < args.abrupt)
+
+    await asyncio.gather(*(one() for _ in range(args.cycles)))
+
+
+def wait_for_server(port):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"[ERROR] Server did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent connect/disconnect stress test of the client registry")
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cycles", type=int, default=5000, help="connect/register/disconnect cycles")
+    parser.add_argument("--concurrency", type=int, default=500, help="cycles running at once")
+    parser.add_argument("--names", type=int, default=200, help="usernames the clients pick from")
+    parser.add_argument("--abrupt", type=float, default=0.2,
+                        help="share of clients that disconnect without waiting for the answer")
+    parser.add_argument("--settle", type=float, default=10.0,
+                        help="seconds to wait for the server to notice every disconnect")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # Clients that leave abruptly each log a client_error; keep them out of the result
+    jsonlog.configure_logging(jsonlog.ERROR + 1, output=sys.stderr)
+    server.history_dir = None
+    server.mailbox_dir = None
+    raise_open_file_limit()
+    threading.Thread(target=server.serve, args=(args.mode, args.port), daemon=True).start()
+    wait_for_server(args.port)
+
+    stats = {"registered": 0, "refused": 0, "connect_errors": 0, "io_errors": 0}
+    problems = []
+    stop = threading.Event()
+    checker = threading.Thread(target=watch, args=(stop, problems, 0.01), daemon=True)
+    checker.start()
+    started = time.monotonic()
+    asyncio.run(run(args, stats))
+    elapsed = time.monotonic() - started
+
+    # Every client has gone: the registry and the connection count must drain to zero
+    deadline = time.monotonic() + args.settle
+    while (len(server.clients) or open_connections.get()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    checker.join()
+    check_registry(problems)
+    if len(server.clients):
+        problems.append(f"{len(server.clients)} users still registered: {server.clients.usernames()[:10]}")
+    if server.clients.snapshot():
+        problems.append("snapshot still lists clients")
+    if open_connections.get():
+        problems.append(f"open_connections is {open_connections.get()}, expected 0")
+    if not stats["registered"]:
+        problems.append("no client managed to register")
+
+    result = {"mode": args.mode, "cycles": args.cycles, "concurrency": args.concurrency, "names": args.names,
+              "seconds": round(elapsed, 2), "cycles_per_s": round(args.cycles / elapsed, 1), **stats,
+              "ok": not problems, "problems": problems[:20]}
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if not problems else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -215,7 +215,6 @@ class ChatClientGUI:
     def connect_to_server(self):
         try:
             sio.connect("https://new-chat-app-2wtj.onrender.com")  # Change to your deployed server URL
-            sio.emit('register', username)  # Register after connecting
         except Exception as e:
             self.display_group_message(f"[Error] Could not connect: {e}")
 
@@ -230,6 +229,8 @@ class ChatClientGUI:
 # --- SOCKET.IO EVENTS ---
 @sio.event
 def connect():
+    # Also runs after socket.io reconnects on its own, so register again each time
+    sio.emit('register', username)
     gui.display_group_message("[System] Connected to server.")
 
 @sio.event